@@ -9,7 +9,7 @@ from aiogram.filters import Command
 
 from src.bot.keyboards.main import get_admin_keyboard
 from src.database.crud import UserCRUD, PaymentCRUD, GenerationCRUD
-from src.generator.gpu_balancer import gpu_balancer
+from src.generator.gpu_balancer import get_gpu_balancer
 from src.generator.models_manager import model_manager
 from src.shared.redis_client import redis_client
 from src.shared.config import settings
@@ -78,7 +78,7 @@ async def admin_system_stats(callback: CallbackQuery, user: dict):
         users_stats = await user_crud.get_users_statistics()
         payments_stats = await payment_crud.get_payments_statistics()
         generations_stats = await generation_crud.get_generations_statistics()
-        gpu_stats = await gpu_balancer.get_gpu_stats()
+        gpu_stats = await get_gpu_balancer().get_gpu_stats()
         redis_stats = await redis_client.get_statistics()
         
         stats_text = f"""
@@ -103,8 +103,8 @@ async def admin_system_stats(callback: CallbackQuery, user: dict):
 • Среднее время: {generations_stats.get('avg_time', 0):.1f}с
 
 🖥️ <b>GPU ({gpu_stats.get('gpu_count', 0)} шт.):</b>
-• Доступно: {sum(1 for avail in gpu_stats.get('availability', {}).values() if avail)}
-• В работе: {sum(1 for avail in gpu_stats.get('availability', {}).values() if not avail)}
+• Доступно: {sum(1 for status in gpu_stats.get('gpu_status', {}).values() if not status['busy'])}
+• В работе: {sum(1 for status in gpu_stats.get('gpu_status', {}).values() if status['busy'])}
 • Среднее время генерации: {gpu_stats.get('average_generation_time', 0):.1f}с
 
 🔄 <b>Redis:</b>
@@ -287,7 +287,7 @@ async def admin_generation_monitoring(callback: CallbackQuery, user: dict):
     """Мониторинг генерации изображений"""
     try:
         # GPU статистика
-        gpu_stats = await gpu_balancer.get_gpu_stats()
+        gpu_stats = await get_gpu_balancer().get_gpu_stats()
         model_info = model_manager.get_model_info()
         
         # Очередь генерации
@@ -8,6 +8,7 @@ from aiogram import Router, F
 from aiogram.types import CallbackQuery, Message, FSInputFile
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from src.bot.keyboards.main import (
     get_generation_keyboard, get_generation_result_keyboard,
@@ -15,7 +16,7 @@ from src.bot.keyboards.main import (
 )
 from src.database.crud import UserCRUD, GenerationCRUD
 from src.generator.tasks import generate_image_task
-from src.shared.config import QUALITY_SETTINGS, IMAGE_STYLES
+from src.shared.config import ALLOWED_SIZES, QUALITY_SETTINGS, IMAGE_STYLES
 
 logger = logging.getLogger(__name__)
 router = Router()
@@ -96,7 +97,7 @@ async def generate_image_handler(callback: CallbackQuery, user: dict, state: FSM
 
 
 @router.message(GenerationStates.waiting_prompt)
-async def process_generation_prompt(message: Message, user: dict, state: FSMContext):
+async def process_generation_prompt(message: Message, user: dict, state: FSMContext, session: AsyncSession):
     """Обработка промпта для генерации"""
     try:
         prompt = message.text.strip()
@@ -115,7 +116,8 @@ async def process_generation_prompt(message: Message, user: dict, state: FSMCont
             return
         
         # Проверяем баланс еще раз
-        fresh_user = await user_crud.get_by_telegram_id(user['telegram_id'])
+        fresh_user = await user_crud.get_by_telegram_id(session, user['telegram_id'])
+        await session.commit()
         if not fresh_user or fresh_user.balance <= 0:
             await message.answer(
                 "❌ Недостаточно средств! Пополните баланс для генерации изображений."
@@ -208,7 +210,7 @@ async def process_style_selection(callback: CallbackQuery, user: dict, state: FS
 
 
 @router.callback_query(GenerationStates.selecting_quality, F.data.startswith("quality_"))
-async def process_quality_selection(callback: CallbackQuery, user: dict, state: FSMContext):
+async def process_quality_selection(callback: CallbackQuery, user: dict, state: FSMContext, session: AsyncSession):
     """Обработка выбора качества и запуск генерации"""
     try:
         quality = callback.data.replace("quality_", "")
@@ -233,9 +235,32 @@ async def process_quality_selection(callback: CallbackQuery, user: dict, state:
         prompt = data.get('prompt', '')
         style = data.get('style', 'realistic')
         
+        # Определяем параметры генерации до списания баланса
+        size = "512x512"
+        priority = False
+        
+        if user.get('subscription_type') == "premium":
+            size = "768x768"
+            priority = True
+        elif user.get('subscription_type') == "pro":
+            size = "1024x1024" 
+            priority = True
+        
+        # Генератор принимает только размеры тарифов: неверный размер отклоняем здесь,
+        # а не ошибкой генерации на GPU
+        if size not in ALLOWED_SIZES:
+            logger.error(f"Неподдерживаемый размер {size} для пользователя {user['telegram_id']}")
+            await callback.message.edit_text(
+                "❌ Этот размер изображения не поддерживается.",
+                reply_markup=get_back_keyboard()
+            )
+            await state.clear()
+            return
+        
         # Финальная проверка баланса и списание
-        fresh_user = await user_crud.get_by_telegram_id(user['telegram_id'])
+        fresh_user = await user_crud.get_by_telegram_id(session, user['telegram_id'])
         if not fresh_user or fresh_user.balance <= 0:
+            await session.commit()
             await callback.message.edit_text(
                 "❌ Недостаточно средств! Пополните баланс для генерации.",
                 reply_markup=get_back_keyboard()
@@ -245,7 +270,9 @@ async def process_quality_selection(callback: CallbackQuery, user: dict, state:
         
         # Списываем баланс
         new_balance = fresh_user.balance - 1
-        await user_crud.update_balance(user['telegram_id'], new_balance)
+        await user_crud.update_balance(session, user['telegram_id'], new_balance)
+        # Списание фиксируем до сообщений и очереди: блокировка строки users снимается
+        await session.commit()
         
         # Отправляем сообщение о начале генерации
         processing_keyboard = get_generation_keyboard()
@@ -260,17 +287,6 @@ async def process_quality_selection(callback: CallbackQuery, user: dict, state:
             reply_markup=processing_keyboard
         )
         
-        # Определяем параметры генерации
-        size = "512x512"
-        priority = False
-        
-        if user.get('subscription_type') == "premium":
-            size = "768x768"
-            priority = True
-        elif user.get('subscription_type') == "pro":
-            size = "1024x1024" 
-            priority = True
-        
         # Создаем задачу генерации
         generation_task = {
             "user_id": user['telegram_id'],
@@ -321,16 +337,18 @@ async def process_quality_selection(callback: CallbackQuery, user: dict, state:
 
 
 @router.callback_query(F.data == "cancel_generation")
-async def cancel_generation_handler(callback: CallbackQuery, user: dict):
+async def cancel_generation_handler(callback: CallbackQuery, user: dict, session: AsyncSession):
     """Отмена генерации изображения"""
     try:
         # Возвращаем баланс (если генерация еще не началась)
-        fresh_user = await user_crud.get_by_telegram_id(user['telegram_id'])
+        fresh_user = await user_crud.get_by_telegram_id(session, user['telegram_id'])
         if fresh_user:
             await user_crud.update_balance(
+                session,
                 user['telegram_id'], 
                 fresh_user.balance + 1
             )
+        await session.commit()
         
         from src.bot.keyboards.main import get_main_keyboard
         keyboard = get_main_keyboard()
@@ -349,14 +367,16 @@ async def cancel_generation_handler(callback: CallbackQuery, user: dict):
 
 
 @router.callback_query(F.data == "history")
-async def history_handler(callback: CallbackQuery, user: dict):
+async def history_handler(callback: CallbackQuery, user: dict, session: AsyncSession):
     """История генераций пользователя"""
     try:
         # Получаем последние генерации
         generations = await generation_crud.get_user_generations(
+            session,
             user['telegram_id'], 
             limit=10
         )
+        await session.commit()
         
         if not generations:
             from src.bot.keyboards.main import get_main_keyboard
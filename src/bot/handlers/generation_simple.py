@@ -1,16 +1,17 @@
 """
 Упрощенный обработчик генерации AI изображений (без PyTorch зависимостей в боте)
 """
-import json
 import logging
 from datetime import datetime, timezone
 from aiogram import Router, F
 from aiogram.types import CallbackQuery, Message
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from src.bot.keyboards.main import get_back_keyboard, get_main_keyboard
 from src.database.crud import UserCRUD
+from src.shared.config import ALLOWED_SIZES
 from src.shared.redis_client import redis_client
 
 logger = logging.getLogger(__name__)
@@ -25,7 +26,7 @@ class GenerationStates(StatesGroup):
 
 
 @router.callback_query(F.data == "generate_image")
-async def generate_image_handler(callback: CallbackQuery, user: dict, state: FSMContext):
+async def generate_image_handler(callback: CallbackQuery, user: dict, state: FSMContext, session: AsyncSession):
     """Начало процесса генерации изображения"""
     try:
         # Проверяем баланс
@@ -33,7 +34,8 @@ async def generate_image_handler(callback: CallbackQuery, user: dict, state: FSM
             from src.bot.keyboards.payment import get_buy_packages_keyboard
             from src.payment.service import payment_service
             
-            tariffs = await payment_service.get_tariffs()
+            tariffs = await payment_service.get_tariffs(session)
+            await session.commit()
             keyboard = get_buy_packages_keyboard(tariffs)
             
             await callback.message.edit_text(
@@ -78,7 +80,7 @@ async def generate_image_handler(callback: CallbackQuery, user: dict, state: FSM
 
 
 @router.message(GenerationStates.waiting_prompt)
-async def process_generation_prompt(message: Message, user: dict, state: FSMContext):
+async def process_generation_prompt(message: Message, user: dict, state: FSMContext, session: AsyncSession):
     """Обработка промпта для генерации"""
     try:
         prompt = message.text.strip()
@@ -96,9 +98,32 @@ async def process_generation_prompt(message: Message, user: dict, state: FSMCont
             )
             return
         
+        # Определяем параметры генерации до списания баланса
+        size = "512x512"
+        priority = False
+        
+        if user.get('subscription_type') == "premium":
+            size = "768x768"
+            priority = True
+        elif user.get('subscription_type') == "pro":
+            size = "1024x1024" 
+            priority = True
+        
+        # Генератор принимает только размеры тарифов: неверный размер отклоняем здесь,
+        # а не ошибкой генерации на GPU
+        if size not in ALLOWED_SIZES:
+            logger.error(f"Неподдерживаемый размер {size} для пользователя {user['telegram_id']}")
+            await message.answer(
+                "❌ Этот размер изображения не поддерживается.",
+                reply_markup=get_main_keyboard()
+            )
+            await state.clear()
+            return
+        
         # Проверяем баланс еще раз
-        fresh_user = await user_crud.get_by_telegram_id(user['telegram_id'])
+        fresh_user = await user_crud.get_by_telegram_id(session, user['telegram_id'])
         if not fresh_user or fresh_user.balance <= 0:
+            await session.commit()
             await message.answer(
                 "❌ Недостаточно средств! Пополните баланс для генерации изображений."
             )
@@ -107,7 +132,9 @@ async def process_generation_prompt(message: Message, user: dict, state: FSMCont
         
         # Списываем баланс
         new_balance = fresh_user.balance - 1
-        await user_crud.update_balance(user['telegram_id'], new_balance)
+        await user_crud.update_balance(session, user['telegram_id'], new_balance)
+        # Списание фиксируем до сообщений и очереди: блокировка строки users снимается
+        await session.commit()
         
         # Отправляем сообщение о начале генерации
         processing_msg = await message.answer(
@@ -119,17 +146,6 @@ async def process_generation_prompt(message: Message, user: dict, state: FSMCont
             reply_markup=get_back_keyboard()
         )
         
-        # Определяем параметры генерации
-        size = "512x512"
-        priority = False
-        
-        if user.get('subscription_type') == "premium":
-            size = "768x768"
-            priority = True
-        elif user.get('subscription_type') == "pro":
-            size = "1024x1024" 
-            priority = True
-        
         # Создаем задачу генерации
         generation_task = {
             "user_id": user['telegram_id'],
@@ -144,8 +160,8 @@ async def process_generation_prompt(message: Message, user: dict, state: FSMCont
             "task_id": f"{user['telegram_id']}_{int(datetime.now(timezone.utc).timestamp())}"
         }
         
-        # Добавляем в очередь Redis (Celery подхватит)
-        await redis_client.lpush("generation_queue", json.dumps(generation_task))
+        # Добавляем в очередь Redis (Celery подхватит); lpush сам сериализует в JSON
+        await redis_client.add_to_generation_queue(generation_task, priority=priority)
         
         logger.info(
             f"Создана задача генерации для пользователя {user['telegram_id']}: "
@@ -165,16 +181,18 @@ async def process_generation_prompt(message: Message, user: dict, state: FSMCont
 
 
 @router.callback_query(F.data == "cancel_generation")
-async def cancel_generation_handler(callback: CallbackQuery, user: dict):
+async def cancel_generation_handler(callback: CallbackQuery, user: dict, session: AsyncSession):
     """Отмена генерации изображения"""
     try:
         # Возвращаем баланс (если генерация еще не началась)
-        fresh_user = await user_crud.get_by_telegram_id(user['telegram_id'])
+        fresh_user = await user_crud.get_by_telegram_id(session, user['telegram_id'])
         if fresh_user:
             await user_crud.update_balance(
+                session,
                 user['telegram_id'], 
                 fresh_user.balance + 1
             )
+        await session.commit()
         
         keyboard = get_main_keyboard()
         
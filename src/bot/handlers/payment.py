@@ -6,6 +6,7 @@ from aiogram import Router, F
 from aiogram.types import CallbackQuery
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from src.bot.keyboards.payment import get_buy_packages_keyboard, get_package_details_keyboard
 from src.payment.service import payment_service
@@ -19,8 +20,9 @@ class PaymentStates(StatesGroup):
     selecting_method = State()
 
 @router.callback_query(F.data == "buy_images")
-async def buy_images_handler(callback: CallbackQuery, state: FSMContext):
-    tariffs = await payment_service.get_tariffs()
+async def buy_images_handler(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
+    tariffs = await payment_service.get_tariffs(session)
+    await session.commit()
     text = f"""💳 <b>Купить изображения</b>
 
 Выберите пакет:"""
@@ -30,9 +32,10 @@ async def buy_images_handler(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 @router.callback_query(PaymentStates.selecting_package, F.data.startswith("buy_"))
-async def tariff_selection_handler(callback: CallbackQuery, state: FSMContext):
+async def tariff_selection_handler(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
     tariff_id = int(callback.data.replace("buy_", ""))
-    tariffs = await payment_service.get_tariffs()
+    tariffs = await payment_service.get_tariffs(session)
+    await session.commit()
     tariff = next((t for t in tariffs if t.id == tariff_id), None)
     if not tariff:
         await callback.answer("Тариф не найден", show_alert=True)
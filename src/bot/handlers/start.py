@@ -5,6 +5,7 @@ import logging
 from aiogram import Router, F
 from aiogram.filters import CommandStart, Command
 from aiogram.types import Message, CallbackQuery
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from src.bot.keyboards.main import get_main_keyboard
 from src.database.crud import UserCRUD, GenerationCRUD
@@ -16,11 +17,12 @@ router = Router()
 user_crud = UserCRUD()
 
 @router.message(CommandStart())
-async def start_handler(message: Message, user: dict):
+async def start_handler(message: Message, user: dict, session: AsyncSession):
     """Обработчик команды /start"""
     try:
         keyboard = get_main_keyboard()
-        tariffs = await payment_service.get_tariffs()
+        tariffs = await payment_service.get_tariffs(session)
+        await session.commit()
         tariffs_text = "\n".join([f"- {t.name} ({t.price}₽)" for t in tariffs])
         
         welcome_text = f"""🤖 <b>Добро пожаловать!</b>
@@ -57,13 +59,11 @@ async def back_to_main_handler(callback: CallbackQuery, user: dict):
 
 @router.message(Command("history"))
 @router.callback_query(F.data == "history")
-async def history_handler(message: Message | CallbackQuery, user: dict):
+async def history_handler(message: Message | CallbackQuery, user: dict, session: AsyncSession):
     """История генераций"""
-    from src.database.connection import get_session
     generation_crud = GenerationCRUD()
-    
-    async with get_session() as session:
-        generations = await generation_crud.get_user_generations(session, user['telegram_id'], limit=5)
+    generations = await generation_crud.get_user_generations(session, user['telegram_id'], limit=5)
+    await session.commit()
     
     if not generations:
         text = "У вас еще нет генераций."
@@ -3,6 +3,12 @@
 """
 import asyncio
 import logging
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from multiprocessing.connection import wait
 from aiohttp import web
 
 from aiogram import Bot, Dispatcher
@@ -21,10 +27,13 @@ from src.bot.handlers import generation_simple
 # admin handler временно отключен (требует PyTorch)
 # from src.bot.handlers import admin
 from src.bot.middlewares.auth import AuthMiddleware
+from src.bot.middlewares.database import DatabaseMiddleware
 from src.bot.middlewares.rate_limit import RateLimitMiddleware
 from src.shared.config import settings
 from src.shared.redis_client import redis_client
-from src.database.connection import init_database
+from src.payment.fiscal import atol_fiscal_service
+from src.payment.providers.cloudpayments import cloudpayments_provider
+from src.database.connection import init_database, prepare_database, start_partition_maintenance
 from src.bot.webapp.routes import setup_webapp_routes
 
 # Настройка логирования
@@ -34,11 +43,21 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Пауза перед перезапуском упавшего воркера и ожидание остановки воркеров (секунды)
+WORKER_RESTART_DELAY = 1
+WORKER_STOP_TIMEOUT = 10
+
 
 class TelegramBot:
     """Основной класс Telegram бота"""
     
-    def __init__(self):
+    def __init__(self, primary: bool = True, init_schema: bool = True):
+        # Только основной воркер обслуживает партиции БД; webhook в Telegram
+        # ставит родительский процесс (см. _webhook_ctl), а не воркеры
+        self.primary = primary
+        # В многопроцессном режиме схему БД готовит родительский процесс до fork
+        self.init_schema = init_schema
+        
         # Создание бота
         self.bot = Bot(
             token=settings.BOT_TOKEN,
@@ -64,6 +83,10 @@ class TelegramBot:
     
     def _setup_middlewares(self):
         """Настройка middleware"""
+        # Сессия БД на update (должна идти первой: ее использует авторизация)
+        self.dp.message.middleware(DatabaseMiddleware())
+        self.dp.callback_query.middleware(DatabaseMiddleware())
+        
         # Middleware авторизации
         self.dp.message.middleware(AuthMiddleware())
         self.dp.callback_query.middleware(AuthMiddleware())
@@ -111,19 +134,12 @@ class TelegramBot:
         try:
             # Инициализация Redis
             await redis_client.connect()
+            await RateLimitMiddleware.load_functions()
             
             # Инициализация базы данных
-            await init_database()
-            
-            # Настройка webhook
-            if settings.ENVIRONMENT == "production":
-                webhook_url = f"{settings.BOT_WEBHOOK_URL}/webhook/telegram"
-                await self.bot.set_webhook(
-                    url=webhook_url,
-                    drop_pending_updates=True,
-                    secret_token=settings.WEBHOOK_SECRET
-                )
-                logger.info(f"Webhook установлен: {webhook_url}")
+            await init_database(create_schema=self.init_schema)
+            if self.primary:
+                start_partition_maintenance()
             
             # Запускаем слушателя результатов
             self.results_listener_task = asyncio.create_task(self.results_listener())
@@ -137,8 +153,9 @@ class TelegramBot:
     async def on_shutdown(self):
         """Очистка при остановке"""
         try:
-            await self.bot.delete_webhook()
             await self.dp.fsm.storage.close()
+            await atol_fiscal_service.close()
+            await cloudpayments_provider.aclose()
             await redis_client.disconnect()
 
             # Останавливаем слушателя
@@ -188,23 +205,119 @@ class TelegramBot:
             await self.on_shutdown()
 
 
-async def main():
+def _install_uvloop():
+    """Переключение на uvloop, если он установлен"""
+    try:
+        import uvloop
+    except ImportError:
+        logger.info("uvloop не установлен, используется стандартный event loop")
+        return
+    uvloop.install()
+
+
+def _reuseport_socket(host: str, port: int) -> socket.socket:
+    """Слушающий сокет с SO_REUSEPORT: ядро распределяет соединения между воркерами"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+
+def _run_webhook_worker(worker_id: int):
+    """Запуск одного webhook воркера на общем порту"""
+    _install_uvloop()
+    bot_instance = TelegramBot(primary=worker_id == 0, init_schema=False)
+    app = bot_instance.create_app()
+    web.run_app(
+        app,
+        sock=_reuseport_socket("0.0.0.0", 8000),
+        access_log=logger
+    )
+
+
+def main():
     """Главная функция запуска"""
-    bot_instance = TelegramBot()
-    
     if settings.ENVIRONMENT == "development":
         # Режим polling для разработки
-        await bot_instance.start_polling()
-    else:
-        # Режим webhook для production
-        app = bot_instance.create_app()
-        web.run_app(
-            app,
-            host="0.0.0.0",
-            port=8000,
-            access_log=logger
-        )
+        _install_uvloop()
+        asyncio.run(TelegramBot().start_polling())
+        return
+    
+    # Схема БД и webhook - один раз, до запуска воркеров: перезапуск отдельного
+    # воркера не должен снимать webhook и сбрасывать накопленные Telegram updates
+    asyncio.run(prepare_database())
+    asyncio.run(_webhook_ctl(install=True))
+    
+    # Режим webhook для production: N процессов на одном порту (SO_REUSEPORT),
+    # родительский процесс только следит за ними и перезапускает упавшие
+    workers = settings.WEB_WORKERS or os.cpu_count() or 1
+    logger.info(f"Запуск webhook сервера: воркеров {workers}")
+    try:
+        _supervise_workers(workers)
+    finally:
+        asyncio.run(_webhook_ctl(install=False))
+
+
+async def _webhook_ctl(install: bool):
+    """Установка или снятие webhook в Telegram (только из родительского процесса)"""
+    bot = Bot(token=settings.BOT_TOKEN)
+    try:
+        if install:
+            webhook_url = f"{settings.BOT_WEBHOOK_URL}/webhook/telegram"
+            # Updates, пришедшие пока webhook был снят (деплой), не выбрасываем
+            await bot.set_webhook(
+                url=webhook_url,
+                drop_pending_updates=False,
+                secret_token=settings.WEBHOOK_SECRET
+            )
+            logger.info(f"Webhook установлен: {webhook_url}")
+        else:
+            await bot.delete_webhook()
+            logger.info("Webhook снят")
+    except Exception as e:
+        logger.error(f"Ошибка управления webhook: {e}")
+        if install:
+            raise
+    finally:
+        await bot.session.close()
+
+
+def _start_worker(worker_id: int) -> multiprocessing.Process:
+    process = multiprocessing.Process(
+        target=_run_webhook_worker, args=(worker_id,), name=f"webhook-{worker_id}"
+    )
+    process.start()
+    return process
+
+
+def _supervise_workers(workers: int):
+    """Запуск воркеров и перезапуск завершившихся; SIGTERM/SIGINT останавливает все"""
+    def _stop(signum, frame):
+        raise SystemExit(0)
+    
+    signal.signal(signal.SIGTERM, _stop)
+    processes = {worker_id: _start_worker(worker_id) for worker_id in range(workers)}
+    try:
+        while True:
+            wait([process.sentinel for process in processes.values()])
+            for worker_id, process in processes.items():
+                if process.is_alive():
+                    continue
+                logger.error(f"Воркер {worker_id} завершился с кодом {process.exitcode}, перезапуск")
+                # Пауза - чтобы воркер, падающий при старте, не крутился в цикле
+                time.sleep(WORKER_RESTART_DELAY)
+                processes[worker_id] = _start_worker(worker_id)
+    except (KeyboardInterrupt, SystemExit):
+        logger.info("Остановка воркеров...")
+    finally:
+        # aiohttp в воркерах обрабатывает SIGTERM штатно (on_cleanup)
+        for process in processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in processes.values():
+            process.join(WORKER_STOP_TIMEOUT)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -35,8 +35,10 @@ class AuthMiddleware(BaseMiddleware):
             return await handler(event, data)
         
         try:
-            # Получаем или создаем пользователя в базе данных
+            # Получаем или создаем пользователя в базе данных (заодно обновляется last_activity)
+            session = data['session']
             user = await self.user_crud.get_or_create_user(
+                session,
                 telegram_id=telegram_user.id,
                 username=telegram_user.username,
                 first_name=telegram_user.first_name or "Unknown",
@@ -46,9 +48,9 @@ class AuthMiddleware(BaseMiddleware):
             if not user:
                 logger.error(f"Не удалось создать/получить пользователя {telegram_user.id}")
                 return
-            
-            # Обновляем последнюю активность
-            await self.user_crud.update_last_activity(user.telegram_id)
+            # Фиксируем сразу: блокировка строки users и соединение не держатся,
+            # пока handler ходит в Telegram, Celery и Redis
+            await session.commit()
             
             # Добавляем пользователя в контекст
             data['user'] = {
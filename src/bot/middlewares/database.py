@@ -0,0 +1,30 @@
+"""
+Middleware для сессии базы данных на время обработки update
+"""
+from typing import Callable, Dict, Any, Awaitable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from src.database.connection import DatabaseSession
+
+
+class DatabaseMiddleware(BaseMiddleware):
+    """Одна сессия и одна транзакция БД на update.
+
+    Сессия передается в middleware и handlers как data['session'].
+    Middleware и handlers фиксируют транзакцию (session.commit()) сразу после
+    своей работы с БД и до сетевого I/O: иначе соединение из пула и блокировки
+    строк держались бы все время ответа в Telegram, Celery и Redis.
+    COMMIT при выходе из DatabaseSession фиксирует то, что осталось.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        async with DatabaseSession() as session:
+            data['session'] = session
+            return await handler(event, data)
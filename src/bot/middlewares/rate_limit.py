@@ -2,20 +2,58 @@
 Middleware для ограничения частоты запросов (Rate Limiting)
 """
 import logging
-from typing import Callable, Dict, Any, Awaitable
+import time
+from pathlib import Path
+from types import MappingProxyType
+from typing import Callable, ClassVar, Dict, Any, Awaitable, Mapping
 from datetime import datetime, timedelta
 
 from aiogram import BaseMiddleware
 from aiogram.types import Message, CallbackQuery, TelegramObject
+from redis.exceptions import ResponseError
 
 from src.shared.redis_client import redis_client
 
 logger = logging.getLogger(__name__)
 
+# Библиотека Redis Functions с логикой скользящего окна (FUNCTION LOAD)
+RATE_LIMIT_LIBRARY = Path(__file__).with_name("ratelimit_lib.lua").read_text(encoding="utf-8")
+
+# Ключевые слова для классификации действий (кортежи создаются один раз)
+_PAYMENT_CALLBACK_KEYWORDS = ('buy', 'pay')
+_GENERATION_CALLBACK_KEYWORDS = ('generate', 'style', 'quality')
+_GENERATION_MESSAGE_KEYWORDS = ('/generate', 'генерир', 'создай', 'нарисуй')
+
 
 class RateLimitMiddleware(BaseMiddleware):
     """Middleware для ограничения частоты запросов пользователей"""
     
+    # Сообщения об ограничениях (read-only, создаются один раз)
+    _MESSAGES: ClassVar[Mapping[str, str]] = MappingProxyType({
+        'message': (
+            "⚠️ Слишком много сообщений!\n\n"
+            "Пожалуйста, подождите немного перед отправкой следующего сообщения."
+        ),
+        'callback': (
+            "⚠️ Слишком быстро!\n\n"
+            "Пожалуйста, не нажимайте кнопки так часто."
+        ),
+        'generation': (
+            "⚠️ Лимит генераций превышен!\n\n"
+            "Максимум 5 запросов на генерацию за 5 минут.\n"
+            "Попробуйте позже или купите премиум для увеличения лимитов."
+        ),
+        'payment': (
+            "⚠️ Слишком много попыток оплаты!\n\n"
+            "Максимум 10 платежных запросов в час.\n"
+            "Если возникли проблемы, обратитесь в поддержку."
+        ),
+        'admin': (
+            "⚠️ Превышен лимит админских действий!\n\n"
+            "Подождите минуту перед следующей командой."
+        )
+    })
+    
     def __init__(self):
         # Лимиты по типам действий (requests per minute)
         self.limits = {
@@ -35,6 +73,15 @@ class RateLimitMiddleware(BaseMiddleware):
             'admin': 60         # 1 минута
         }
     
+    @staticmethod
+    async def load_functions():
+        """Регистрация библиотеки ratelimit в Redis (один раз при старте)"""
+        try:
+            await redis_client.function_load(RATE_LIMIT_LIBRARY, replace=True)
+            logger.info("✅ Redis Functions для rate limiting загружены")
+        except ResponseError as e:
+            logger.warning(f"Redis Functions недоступны, rate limiting по фиксированному окну: {e}")
+    
     async def __call__(
         self,
         handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
@@ -58,14 +105,11 @@ class RateLimitMiddleware(BaseMiddleware):
             # Определяем тип действия
             action_type = self._get_action_type(event, data)
             
-            # Проверяем лимиты
+            # Проверяем лимит (счетчик инкрементируется атомарно на стороне Redis)
             if not await self._check_rate_limit(user_id, action_type):
                 await self._handle_rate_limit_exceeded(event, action_type)
                 return
             
-            # Инкрементируем счетчик
-            await self._increment_counter(user_id, action_type)
-            
             return await handler(event, data)
             
         except Exception as e:
@@ -79,12 +123,12 @@ class RateLimitMiddleware(BaseMiddleware):
         if isinstance(event, CallbackQuery):
             callback_data = event.data or ""
             
-            # Платежные действия
-            if any(keyword in callback_data for keyword in ['buy', 'payment', 'pay']):
+            # Платежные действия ('pay' покрывает и 'payment')
+            if any(keyword in callback_data for keyword in _PAYMENT_CALLBACK_KEYWORDS):
                 return 'payment'
             
             # Генерация изображений
-            if any(keyword in callback_data for keyword in ['generate', 'style', 'quality']):
+            if any(keyword in callback_data for keyword in _GENERATION_CALLBACK_KEYWORDS):
                 return 'generation'
             
             # Админские действия
@@ -99,7 +143,7 @@ class RateLimitMiddleware(BaseMiddleware):
                 text = event.text.lower()
                 
                 # Команды генерации
-                if any(keyword in text for keyword in ['/generate', 'генерир', 'создай', 'нарисуй']):
+                if any(keyword in text for keyword in _GENERATION_MESSAGE_KEYWORDS):
                     return 'generation'
                 
                 # Админские команды
@@ -111,18 +155,25 @@ class RateLimitMiddleware(BaseMiddleware):
         return 'message'
     
     async def _check_rate_limit(self, user_id: int, action_type: str) -> bool:
-        """Проверка лимита запросов"""
+        """Проверка лимита запросов с инкрементом счетчика (FCALL rl_check)"""
         try:
             limit = self.limits.get(action_type, 30)
             window = self.windows.get(action_type, 60)
             
-            # Проверяем текущий счетчик
-            current_count = await redis_client.get(f"rate_limit:{user_id}:{action_type}")
-            
-            if current_count is None:
-                return True
+            try:
+                allowed, current_count = await redis_client.fcall(
+                    'rl_check', 1,
+                    f"rl:{user_id}",
+                    limit, window * 1000, int(time.time() * 1000), action_type
+                )
+            except ResponseError:
+                # Redis без Functions (< 7): фиксированное окно, SET NX + INCR за один round-trip
+                current_count = await redis_client.increment_counter(
+                    f"rl:{user_id}:{action_type}", ttl=window
+                )
+                allowed = current_count <= limit
             
-            if int(current_count) >= limit:
+            if not allowed:
                 logger.warning(
                     f"Rate limit exceeded: user {user_id}, action {action_type}, "
                     f"count {current_count}, limit {limit}"
@@ -135,51 +186,10 @@ class RateLimitMiddleware(BaseMiddleware):
             logger.error(f"Ошибка проверки rate limit: {e}")
             return True  # В случае ошибки разрешаем запрос
     
-    async def _increment_counter(self, user_id: int, action_type: str):
-        """Инкремент счетчика запросов"""
-        try:
-            key = f"rate_limit:{user_id}:{action_type}"
-            window = self.windows.get(action_type, 60)
-            
-            current = await redis_client.increment_counter(key)
-            
-            # Устанавливаем TTL только для первого запроса
-            if current == 1:
-                await redis_client.expire(key, window)
-            
-        except Exception as e:
-            logger.error(f"Ошибка инкремента счетчика rate limit: {e}")
-    
     async def _handle_rate_limit_exceeded(self, event: TelegramObject, action_type: str):
         """Обработка превышения лимита"""
         try:
-            # Сообщения об ограничениях
-            messages = {
-                'message': (
-                    "⚠️ Слишком много сообщений!\n\n"
-                    "Пожалуйста, подождите немного перед отправкой следующего сообщения."
-                ),
-                'callback': (
-                    "⚠️ Слишком быстро!\n\n"
-                    "Пожалуйста, не нажимайте кнопки так часто."
-                ),
-                'generation': (
-                    "⚠️ Лимит генераций превышен!\n\n"
-                    "Максимум 5 запросов на генерацию за 5 минут.\n"
-                    "Попробуйте позже или купите премиум для увеличения лимитов."
-                ),
-                'payment': (
-                    "⚠️ Слишком много попыток оплаты!\n\n"
-                    "Максимум 10 платежных запросов в час.\n"
-                    "Если возникли проблемы, обратитесь в поддержку."
-                ),
-                'admin': (
-                    "⚠️ Превышен лимит админских действий!\n\n"
-                    "Подождите минуту перед следующей командой."
-                )
-            }
-            
-            message_text = messages.get(action_type, messages['message'])
+            message_text = self._MESSAGES.get(action_type, self._MESSAGES['message'])
             
             if isinstance(event, Message):
                 await event.answer(message_text)
@@ -193,17 +203,30 @@ class RateLimitMiddleware(BaseMiddleware):
         """Получение информации о текущих лимитах пользователя"""
         try:
             limits_info = {}
+            now_ms = int(time.time() * 1000)
+            
+            # Все счетчики пользователя - одним HGETALL
+            state = await redis_client.hgetall(f"rl:{user_id}")
             
             for action_type in self.limits:
-                key = f"rate_limit:{user_id}:{action_type}"
-                current = await redis_client.get(key)
-                ttl = await redis_client.ttl(key)
+                current = state.get(f"{action_type}:c")
+                previous = state.get(f"{action_type}:p")
+                expires = state.get(f"{action_type}:exp")
+                window_ms = self.windows[action_type] * 1000
+                
+                # Та же оценка скользящего окна, что и в rl_check
+                count, remaining_ms = 0, 0
+                if expires and now_ms < int(expires):
+                    remaining_ms = int(expires) - now_ms
+                    count = int(int(previous or 0) * remaining_ms / window_ms + int(current or 0))
+                elif expires and now_ms < int(expires) + window_ms:
+                    count = int(int(current or 0) * (int(expires) + window_ms - now_ms) / window_ms)
                 
                 limits_info[action_type] = {
-                    'current': int(current) if current else 0,
+                    'current': count,
                     'limit': self.limits[action_type],
-                    'remaining_time': ttl if ttl > 0 else 0,
-                    'remaining_requests': max(0, self.limits[action_type] - (int(current) if current else 0))
+                    'remaining_time': remaining_ms // 1000,
+                    'remaining_requests': max(0, self.limits[action_type] - count)
                 }
             
             return limits_info
@@ -216,13 +239,17 @@ class RateLimitMiddleware(BaseMiddleware):
         """Сброс лимитов пользователя (для админов)"""
         try:
             if action_type:
-                key = f"rate_limit:{user_id}:{action_type}"
-                await redis_client.delete(key)
+                await redis_client.hdel(
+                    f"rl:{user_id}",
+                    f"{action_type}:c", f"{action_type}:p", f"{action_type}:exp"
+                )
+                await redis_client.delete(f"rl:{user_id}:{action_type}")
             else:
-                # Сбрасываем все лимиты
-                for action in self.limits:
-                    key = f"rate_limit:{user_id}:{action}"
-                    await redis_client.delete(key)
+                # Сбрасываем все лимиты (включая счетчики фиксированного окна)
+                await redis_client.delete(
+                    f"rl:{user_id}",
+                    *(f"rl:{user_id}:{action}" for action in self.limits)
+                )
             
             logger.info(f"Сброшены лимиты для пользователя {user_id}, тип: {action_type or 'все'}")
             
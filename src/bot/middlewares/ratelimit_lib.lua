@@ -0,0 +1,57 @@
+#!lua name=ratelimit
+
+-- Rate limiting по скользящему окну из двух корзин (текущая + предыдущая).
+-- Все лимиты пользователя хранятся в одном hash rl:{user_id}, поля на
+-- каждый тип действия: {action}:c - счетчик текущей корзины,
+-- {action}:p - счетчик предыдущей корзины, {action}:exp - конец текущей
+-- корзины (мс).
+--
+-- KEYS[1] - hash лимитов пользователя
+-- ARGV[1] - лимит запросов в окне
+-- ARGV[2] - размер окна (мс)
+-- ARGV[3] - текущее время (мс)
+-- ARGV[4] - тип действия
+--
+-- Возвращает {allowed, count}: allowed = 1 если запрос разрешен
+-- (счетчик уже увеличен), count - оценка числа запросов в окне.
+local function rl_check(keys, args)
+    local key = keys[1]
+    local limit = tonumber(args[1])
+    local window = tonumber(args[2])
+    local now = tonumber(args[3])
+    local f_count = args[4] .. ':c'
+    local f_prev = args[4] .. ':p'
+    local f_exp = args[4] .. ':exp'
+
+    local state = redis.call('HMGET', key, f_count, f_prev, f_exp)
+    local current = tonumber(state[1]) or 0
+    local previous = tonumber(state[2]) or 0
+    local expires = tonumber(state[3]) or 0
+
+    if now >= expires then
+        -- Текущая корзина закрылась: сдвигаем окно
+        if now < expires + window then
+            previous = current
+        else
+            previous = 0
+        end
+        current = 0
+        expires = now - (now % window) + window
+    end
+
+    -- Вес предыдущей корзины убывает по мере продвижения по текущей
+    local estimate = math.floor(previous * (expires - now) / window + current)
+    if estimate >= limit then
+        return {0, estimate}
+    end
+
+    redis.call('HSET', key, f_count, current + 1, f_prev, previous, f_exp, expires)
+
+    -- TTL ключа - по самому долгому окну среди действий
+    if redis.call('PEXPIRETIME', key) < expires + window then
+        redis.call('PEXPIREAT', key, expires + window)
+    end
+    return {1, estimate + 1}
+end
+
+redis.register_function('rl_check', rl_check)
@@ -1,6 +1,7 @@
 """
 Web App маршруты для интерфейса платежей
 """
+import html
 import json
 import logging
 from datetime import datetime
@@ -9,6 +10,7 @@ from aiohttp.web import RouteTableDef
 
 from src.shared.config import settings, PACKAGES
 from src.payment.providers.yookassa import YooKassaProvider
+from src.database.connection import DatabaseSession
 from src.database.crud import UserCRUD, PaymentCRUD
 
 logger = logging.getLogger(__name__)
@@ -25,25 +27,37 @@ def setup_webapp_routes(app: web.Application):
     app.router.add_routes(routes)
 
 
-@routes.get('/webapp/payment/{package}')
-async def payment_webapp(request: web.Request):
-    """Главная страница Web App для оплаты"""
-    package = request.match_info['package']
-    
-    if package not in PACKAGES:
-        raise web.HTTPNotFound(text="Package not found")
-    
-    package_info = PACKAGES[package]
-    
-    # HTML страница для оплаты
-    html_content = f"""
+def _html_response(body: bytes) -> web.Response:
+    """HTML-ответ из готовых байтов с явным Content-Length (без chunked-кодирования)"""
+    return web.Response(
+        body=body,
+        content_type='text/html',
+        charset='utf-8',
+        headers={'Content-Length': str(len(body))}
+    )
+
+
+# Маркер места динамической вставки в заранее собранных страницах
+_SLOT = "\x00"
+
+
+def _split_page(page: str) -> tuple[bytes, bytes]:
+    """Разбиение страницы на байтовые части до и после динамической вставки"""
+    head, tail = page.encode('utf-8').split(_SLOT.encode('utf-8'))
+    return head, tail
+
+
+def _render_payment_page(package: str, package_info: dict) -> str:
+    """HTML страница Web App для оплаты пакета"""
+    return f"""
 <!DOCTYPE html>
 <html lang="ru">
 <head>
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Оплата - {package_info['name']}</title>
-    <script src="https://telegram.org/js/telegram-web-app.js"></script>
+    <link rel="preconnect" href="https://telegram.org">
+    <script id="tg-sdk" src="https://telegram.org/js/telegram-web-app.js" async></script>
     <style>
         * {{
             margin: 0;
@@ -245,12 +259,8 @@ async def payment_webapp(request: web.Request):
     </div>
 
     <script>
-        // Инициализация Telegram WebApp
-        let tg = window.Telegram?.WebApp;
-        if (tg) {{
-            tg.ready();
-            tg.expand();
-        }}
+        // Telegram WebApp SDK грузится async - tg появится после initTelegram()
+        let tg = null;
         
         const package = '{package}';
         
@@ -315,8 +325,16 @@ async def payment_webapp(request: web.Request):
             }}
         }}
         
-        // Обработка закрытия WebApp
-        if (tg) {{
+        // Инициализация Telegram WebApp
+        function initTelegram() {{
+            tg = window.Telegram?.WebApp;
+            if (!tg) {{
+                return;
+            }}
+            tg.ready();
+            tg.expand();
+            
+            // Обработка закрытия WebApp
             tg.onEvent('webAppClose', function() {{
                 // Уведомляем бота о закрытии WebApp
                 fetch('/api/webapp/close', {{
@@ -329,12 +347,33 @@ async def payment_webapp(request: web.Request):
                 }}).catch(console.error);
             }});
         }}
+        
+        if (window.Telegram) {{
+            initTelegram();
+        }} else {{
+            document.getElementById('tg-sdk').addEventListener('load', initTelegram);
+        }}
     </script>
 </body>
 </html>
 """
+
+
+# Страницы оплаты не зависят от запроса - собираем байты один раз при импорте
+_PAYMENT_PAGES: dict[str, bytes] = {
+    package: _render_payment_page(package, package_info).encode('utf-8')
+    for package, package_info in PACKAGES.items()
+}
+
+
+@routes.get('/webapp/payment/{package}')
+async def payment_webapp(request: web.Request):
+    """Главная страница Web App для оплаты"""
+    body = _PAYMENT_PAGES.get(request.match_info['package'])
+    if body is None:
+        raise web.HTTPNotFound(text="Package not found")
     
-    return web.Response(text=html_content, content_type='text/html')
+    return _html_response(body)
 
 
 @routes.post('/api/payment/create')
@@ -362,13 +401,15 @@ async def create_payment_api(request: web.Request):
                 'error': 'Не удалось определить пользователя'
             }, status=400)
         
-        user = await user_crud.get_or_create_user(
-            telegram_id=user_id,
-            username=user_info.get('username'),
-            first_name=user_info.get('first_name', 'Unknown'),
-            last_name=user_info.get('last_name'),
-            language_code=user_info.get('language_code', 'ru')
-        )
+        async with DatabaseSession() as session:
+            user = await user_crud.get_or_create_user(
+                session,
+                telegram_id=user_id,
+                username=user_info.get('username'),
+                first_name=user_info.get('first_name', 'Unknown'),
+                last_name=user_info.get('last_name'),
+                language_code=user_info.get('language_code', 'ru')
+            )
         
         # Создаем платеж
         payment_result = await yookassa_provider.create_payment(
@@ -392,19 +433,18 @@ async def create_payment_api(request: web.Request):
         }, status=500)
 
 
-@routes.get('/webapp/success')
-async def payment_success_webapp(request: web.Request):
-    """Страница успешной оплаты"""
-    payment_id = request.query.get('payment_id', 'unknown')
-    
-    html_content = f"""
+
+def _render_success_page(payment_id: str) -> str:
+    """HTML страница успешной оплаты"""
+    return f"""
 <!DOCTYPE html>
 <html lang="ru">
 <head>
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Оплата успешна!</title>
-    <script src="https://telegram.org/js/telegram-web-app.js"></script>
+    <link rel="preconnect" href="https://telegram.org">
+    <script id="tg-sdk" src="https://telegram.org/js/telegram-web-app.js" async></script>
     <style>
         body {{
             font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif;
@@ -488,10 +528,19 @@ async def payment_success_webapp(request: web.Request):
     </div>
 
     <script>
-        let tg = window.Telegram?.WebApp;
-        if (tg) {{
-            tg.ready();
-            tg.expand();
+        // Telegram WebApp SDK грузится async - инициализируемся по готовности
+        let tg = null;
+        function initTelegram() {{
+            tg = window.Telegram?.WebApp;
+            if (tg) {{
+                tg.ready();
+                tg.expand();
+            }}
+        }}
+        if (window.Telegram) {{
+            initTelegram();
+        }} else {{
+            document.getElementById('tg-sdk').addEventListener('load', initTelegram);
         }}
         
         function closeWebApp() {{
@@ -508,8 +557,18 @@ async def payment_success_webapp(request: web.Request):
 </body>
 </html>
 """
+
+
+_SUCCESS_PAGE = _split_page(_render_success_page(_SLOT))
+
+
+@routes.get('/webapp/success')
+async def payment_success_webapp(request: web.Request):
+    """Страница успешной оплаты"""
+    payment_id = html.escape(request.query.get('payment_id', 'unknown'))
+    head, tail = _SUCCESS_PAGE
     
-    return web.Response(text=html_content, content_type='text/html')
+    return _html_response(b"".join((head, payment_id.encode('utf-8'), tail)))
 
 
 @routes.post('/api/webapp/close')
@@ -524,19 +583,18 @@ async def webapp_close_api(request: web.Request):
         return web.json_response({'success': False}, status=500)
 
 
-@routes.get('/webapp/error')
-async def payment_error_webapp(request: web.Request):
-    """Страница ошибки оплаты"""
-    error_message = request.query.get('error', 'Неизвестная ошибка')
-    
-    html_content = f"""
+
+def _render_error_page(error_message: str) -> str:
+    """HTML страница ошибки оплаты"""
+    return f"""
 <!DOCTYPE html>
 <html lang="ru">
 <head>
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Ошибка оплаты</title>
-    <script src="https://telegram.org/js/telegram-web-app.js"></script>
+    <link rel="preconnect" href="https://telegram.org">
+    <script id="tg-sdk" src="https://telegram.org/js/telegram-web-app.js" async></script>
     <style>
         body {{
             font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif;
@@ -622,10 +680,19 @@ async def payment_error_webapp(request: web.Request):
     </div>
 
     <script>
-        let tg = window.Telegram?.WebApp;
-        if (tg) {{
-            tg.ready();
-            tg.expand();
+        // Telegram WebApp SDK грузится async - инициализируемся по готовности
+        let tg = null;
+        function initTelegram() {{
+            tg = window.Telegram?.WebApp;
+            if (tg) {{
+                tg.ready();
+                tg.expand();
+            }}
+        }}
+        if (window.Telegram) {{
+            initTelegram();
+        }} else {{
+            document.getElementById('tg-sdk').addEventListener('load', initTelegram);
         }}
         
         function goBack() {{
@@ -643,5 +710,15 @@ async def payment_error_webapp(request: web.Request):
 </body>
 </html>
 """
+
+
+_ERROR_PAGE = _split_page(_render_error_page(_SLOT))
+
+
+@routes.get('/webapp/error')
+async def payment_error_webapp(request: web.Request):
+    """Страница ошибки оплаты"""
+    error_message = html.escape(request.query.get('error', 'Неизвестная ошибка'))
+    head, tail = _ERROR_PAGE
     
-    return web.Response(text=html_content, content_type='text/html')
\ No newline at end of file
+    return _html_response(b"".join((head, error_message.encode('utf-8'), tail)))
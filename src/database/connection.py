@@ -3,23 +3,223 @@
 """
 import asyncio
 import logging
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker
+import uuid
+from datetime import date, timedelta
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession, AsyncConnection
+from sqlalchemy import text, column, JSON
 from sqlalchemy.pool import NullPool
-from sqlalchemy import text
 
 from src.shared.config import settings
-from src.database.models import Base
+from src.database.models import Base, PaymentStatus
 
 logger = logging.getLogger(__name__)
 
 # Глобальные переменные для движка и сессий
 engine = None
 async_session = None
+partitions_task = None
 
+# Размеры кэшей подготовленных выражений asyncpg и скомпилированного SQL
+STATEMENT_CACHE_SIZE = 1024
+QUERY_CACHE_SIZE = 2048
 
-async def init_database():
-    """Инициализация подключения к базе данных"""
+# SQL-выражения создаются один раз на модуль, а не на каждый вызов
+PING_QUERY = text("SELECT 1")
+TARIFF_COUNT_QUERY = text("SELECT COUNT(*) FROM tariffs")
+DB_VERSION_QUERY = text("SELECT version()")
+DB_SIZE_QUERY = text("SELECT pg_size_pretty(pg_database_size(current_database()))")
+DB_CONNECTIONS_QUERY = text("SELECT count(*) FROM pg_stat_activity WHERE datname = current_database()")
+
+MIGRATIONS_TABLE_DDL = text("""
+    CREATE TABLE IF NOT EXISTS migrations (
+        id SERIAL PRIMARY KEY,
+        name VARCHAR(255) NOT NULL UNIQUE,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+""")
+MIGRATION_EXISTS_QUERY = text("SELECT id FROM migrations WHERE name = :name")
+MIGRATION_INSERT_QUERY = text("INSERT INTO migrations (name) VALUES (:name)")
+MIGRATIONS_LIST_QUERY = text("SELECT name, applied_at FROM migrations ORDER BY applied_at")
+GENERATIONS_PARTITIONED_QUERY = text(
+    "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'generations'::regclass)"
+)
+
+# Переход со старого типа paymentstatus (метки - имена членов) на payment_status
+# с метками-значениями: переименование типа и меток без перезаписи строк
+PAYMENT_STATUS_ENUM_MIGRATION = text(
+    "DO $$ BEGIN "
+    "IF EXISTS (SELECT 1 FROM pg_type WHERE typname = 'paymentstatus') "
+    "AND NOT EXISTS (SELECT 1 FROM pg_type WHERE typname = 'payment_status') THEN "
+    "ALTER TYPE paymentstatus RENAME TO payment_status; "
+    + "".join(
+        f"ALTER TYPE payment_status RENAME VALUE '{status.name}' TO '{status.value}'; "
+        for status in PaymentStatus
+    )
+    + "END IF; END $$"
+)
+
+# create_all не меняет существующие таблицы: серверные default для колонок,
+# которые раньше заполнялись на стороне Python (gen_random_uuid встроена с PostgreSQL 13),
+# и индексы, добавленные в модели позже создания таблиц
+SCHEMA_UPGRADE_DDL = (
+    text("ALTER TABLE payments ALTER COLUMN id SET DEFAULT gen_random_uuid()"),
+    text("ALTER TABLE payments ALTER COLUMN created_at SET DEFAULT now()"),
+    text("ALTER TABLE users ALTER COLUMN created_at SET DEFAULT now()"),
+    text("ALTER TABLE users ALTER COLUMN last_activity SET DEFAULT now()"),
+    text("ALTER TABLE generations ALTER COLUMN created_at SET DEFAULT now()"),
+    # ON CONFLICT (name) в seed тарифов требует уникального индекса; в таблицах,
+    # созданных до unique=True, его нет (имя совпадает с constraint из create_all)
+    text("CREATE UNIQUE INDEX IF NOT EXISTS tariffs_name_key ON tariffs (name)"),
+    # Колонка payment_metadata (json) переименована в metadata (jsonb): jsonb || в
+    # _merge_metadata и GIN-индекс работают только с jsonb
+    text(
+        "DO $$ BEGIN "
+        "IF EXISTS (SELECT 1 FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name = 'payments' "
+        "AND column_name = 'payment_metadata') THEN "
+        "ALTER TABLE payments RENAME COLUMN payment_metadata TO metadata; "
+        "END IF; "
+        "IF EXISTS (SELECT 1 FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name = 'payments' "
+        "AND column_name = 'metadata' AND data_type <> 'jsonb') THEN "
+        "ALTER TABLE payments ALTER COLUMN metadata TYPE jsonb USING metadata::jsonb; "
+        "END IF; END $$"
+    ),
+    text("ALTER TABLE payments ALTER COLUMN metadata SET DEFAULT '{}'::jsonb"),
+    text("CREATE INDEX IF NOT EXISTS ix_payments_user_status ON payments (user_id, status)"),
+    text("CREATE INDEX IF NOT EXISTS ix_payments_created ON payments (created_at)"),
+    text("CREATE INDEX IF NOT EXISTS ix_payments_metadata_gin ON payments USING gin (metadata jsonb_path_ops)"),
+)
+
+# Сколько месячных партиций generations держать созданными наперед
+# и как часто основной воркер проверяет их наличие (секунды)
+GENERATION_PARTITIONS_AHEAD = 3
+GENERATION_PARTITIONS_CHECK_INTERVAL = 6 * 3600
+
+PARTITION_EXISTS_QUERY = text("SELECT to_regclass(:name) IS NOT NULL")
+
+# Переход с непартиционированной generations (PK id, тип generationstatus с метками-
+# именами) на партиционированную: старая таблица со своими индексами и sequence
+# переименовывается до create_all, строки переносятся после создания партиций
+GENERATIONS_LEGACY_RENAME = text(
+    "DO $$ BEGIN "
+    "IF EXISTS (SELECT 1 FROM pg_class WHERE oid = to_regclass('generations') AND relkind = 'r') THEN "
+    "ALTER TABLE generations RENAME TO generations_legacy; "
+    "IF EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'generations_pkey') THEN "
+    "ALTER TABLE generations_legacy RENAME CONSTRAINT generations_pkey TO generations_legacy_pkey; "
+    "END IF; "
+    "ALTER INDEX IF EXISTS ix_gen_user_created RENAME TO ix_gen_legacy_user_created; "
+    "ALTER INDEX IF EXISTS ix_gen_pending RENAME TO ix_gen_legacy_pending; "
+    "ALTER SEQUENCE IF EXISTS generations_id_seq RENAME TO generations_legacy_id_seq; "
+    "END IF; END $$"
+)
+GENERATIONS_LEGACY_COPY = text(
+    "DO $$ BEGIN "
+    "IF to_regclass('generations_legacy') IS NOT NULL THEN "
+    "INSERT INTO generations "
+    "(id, user_id, prompt, style, quality, size, status, image_url, created_at, completed_at) "
+    "SELECT id, user_id, prompt, style, quality, size, lower(status::text)::gen_status, "
+    "image_url, created_at, completed_at FROM generations_legacy; "
+    "PERFORM setval(pg_get_serial_sequence('generations', 'id'), "
+    "coalesce((SELECT max(id) FROM generations), 0) + 1, false); "
+    "DROP TABLE generations_legacy; "
+    "DROP TYPE IF EXISTS generationstatus; "
+    "END IF; END $$"
+)
+
+# Статистика таблиц, подключений и размера БД одним запросом
+DATABASE_STATS_QUERY = text("""
+    SELECT
+        (
+            SELECT coalesce(json_agg(t ORDER BY t.n_live_tup DESC), '[]'::json)
+            FROM (
+                SELECT
+                    schemaname,
+                    relname AS tablename,
+                    n_tup_ins,
+                    n_tup_upd,
+                    n_tup_del,
+                    n_live_tup,
+                    n_dead_tup
+                FROM pg_stat_user_tables
+            ) t
+        ) AS tables,
+        (
+            SELECT row_to_json(c)
+            FROM (
+                SELECT
+                    count(*) AS total_connections,
+                    count(*) FILTER (WHERE state = 'active') AS active_connections,
+                    count(*) FILTER (WHERE state = 'idle') AS idle_connections
+                FROM pg_stat_activity
+                WHERE datname = current_database()
+            ) c
+        ) AS connections,
+        (
+            SELECT row_to_json(d)
+            FROM (
+                SELECT
+                    pg_size_pretty(pg_database_size(current_database())) AS db_size,
+                    pg_database_size(current_database()) AS db_size_bytes
+            ) d
+        ) AS size
+""").columns(
+    column("tables", JSON),
+    column("connections", JSON),
+    column("size", JSON)
+)
+
+
+def _engine_pool_options() -> dict:
+    """Параметры пула и подключения для create_async_engine"""
+    server_settings = {
+        "application_name": "telegram_ai_bot",
+        "jit": "off"
+    }
+    
+    if settings.USE_PGBOUNCER:
+        # PgBouncer в режиме transaction pooling сам мультиплексирует
+        # соединения: локальный пул не держим, а подготовленные выражения
+        # не переживают смену серверного соединения между транзакциями.
+        # Незнакомые startup-параметры PgBouncer отвергает ("unsupported startup
+        # parameter: jit"), поэтому jit=off задается на сервере: ALTER ROLE ... SET jit = off
+        server_settings = {"application_name": server_settings["application_name"]}
+        return {
+            "poolclass": NullPool,
+            "connect_args": {
+                "command_timeout": 60,
+                "statement_cache_size": 0,
+                "prepared_statement_cache_size": 0,
+                "prepared_statement_name_func": lambda: f"__asyncpg_{uuid.uuid4()}__",
+                "server_settings": server_settings
+            }
+        }
+    
+    return {
+        # Пул на процесс: pool_size + max_overflow не должно превышать
+        # max_connections PostgreSQL, деленный на число процессов/реплик
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_timeout": settings.DB_POOL_TIMEOUT,
+        "pool_use_lifo": True,  # Переиспользуем самые "горячие" соединения
+        # Соединения, разорванные сервером или сетью, отсеиваются на checkout
+        "pool_pre_ping": True,
+        "pool_recycle": 3600,  # 1 час
+        "connect_args": {
+            "command_timeout": 60,
+            "statement_cache_size": STATEMENT_CACHE_SIZE,
+            "prepared_statement_cache_size": STATEMENT_CACHE_SIZE,
+            "server_settings": server_settings
+        }
+    }
+
+
+async def init_database(create_schema: bool = True):
+    """Инициализация подключения к базе данных.
+
+    create_schema=False - схему уже подготовил prepare_database() (многопроцессный
+    запуск): воркер только создает движок и не выполняет DDL.
+    """
     global engine, async_session
     
     try:
@@ -28,98 +228,196 @@ async def init_database():
             settings.DATABASE_URL,
             echo=settings.DEBUG,
             future=True,
-            pool_size=settings.DB_POOL_SIZE,
-            max_overflow=settings.DB_MAX_OVERFLOW,
-            pool_pre_ping=True,
-            pool_recycle=3600,  # 1 час
-            connect_args={
-                "command_timeout": 60,
-                "server_settings": {
-                    "application_name": "telegram_ai_bot",
-                    "jit": "off"
-                }
-            }
+            query_cache_size=QUERY_CACHE_SIZE,
+            **_engine_pool_options()
         )
         
-        # Создаем фабрику сессий
-        async_session = sessionmaker(
-            engine, 
-            class_=AsyncSession,
-            expire_on_commit=False
+        # Создаем фабрику сессий; CRUD пишет Core-выражениями, поэтому
+        # autoflush перед каждым запросом не нужен
+        async_session = async_sessionmaker(
+            engine,
+            expire_on_commit=False,
+            autoflush=False
         )
         
-        # Создаем таблицы
-        async with engine.begin() as conn:
-            await conn.run_sync(Base.metadata.create_all)
-        
-        logger.info("✅ База данных инициализирована успешно")
-        
-        # Проверяем подключение
-        async with async_session() as session:
-            await session.execute(text("SELECT 1"))
+        if create_schema:
+            await _create_schema(engine)
+        else:
+            async with engine.connect() as conn:
+                await conn.execute(PING_QUERY)
             logger.info("✅ Подключение к базе данных проверено")
-        
-        # Инициализируем тарифы по умолчанию
-        await _init_default_tariffs()
             
     except Exception as e:
         logger.error(f"❌ Ошибка инициализации базы данных: {e}")
         raise
 
 
-async def _init_default_tariffs():
+async def _create_schema(db_engine):
+    """Таблицы, миграции, партиции и тарифы - одно соединение и одна транзакция"""
+    async with db_engine.begin() as conn:
+        # До create_all: иначе тип payment_status будет создан заново,
+        # а партиционированная generations столкнется со старой таблицей
+        await conn.execute(PAYMENT_STATUS_ENUM_MIGRATION)
+        await conn.execute(GENERATIONS_LEGACY_RENAME)
+        await conn.run_sync(Base.metadata.create_all)
+        for ddl in SCHEMA_UPGRADE_DDL:
+            await conn.execute(ddl)
+        logger.info("✅ База данных инициализирована успешно")
+        
+        await conn.execute(PING_QUERY)
+        logger.info("✅ Подключение к базе данных проверено")
+        
+        # Партиции генераций на ближайшие месяцы, затем перенос строк старой таблицы
+        await _ensure_generation_partitions(conn)
+        await conn.execute(GENERATIONS_LEGACY_COPY)
+        
+        # Инициализируем тарифы по умолчанию
+        await _init_default_tariffs(conn)
+
+
+async def prepare_database():
+    """Подготовка схемы БД один раз до запуска воркеров.
+
+    Воркеры стартуют одновременно: DDL из каждого гонялся бы на CREATE TYPE/TABLE
+    и брал бы ACCESS EXCLUSIVE блокировки на каждом старте. Отдельный движок
+    без пула закрывается до fork - дочерним процессам соединения не достаются.
+    """
+    # connect_args те же, что у рабочего движка: за PgBouncer - без кеша выражений
+    schema_engine = create_async_engine(
+        settings.DATABASE_URL,
+        poolclass=NullPool,
+        connect_args=_engine_pool_options()["connect_args"]
+    )
+    try:
+        await _create_schema(schema_engine)
+    finally:
+        await schema_engine.dispose()
+
+
+async def _ensure_generation_partitions(conn: AsyncConnection, months_ahead: int = GENERATION_PARTITIONS_AHEAD):
+    """Создание месячных партиций generations: текущий месяц и months_ahead вперед.
+
+    DEFAULT-партиция принимает строки вне созданных диапазонов, но пока в ней есть
+    строки месяца, партицию этого месяца создать нельзя. Поэтому такие строки
+    переносятся: DEFAULT отсоединяется, создается партиция месяца, строки
+    переезжают в нее, DEFAULT присоединяется обратно. Каждый месяц - в своем
+    savepoint: ошибка одного не мешает остальным.
+    """
+    if not await conn.scalar(GENERATIONS_PARTITIONED_QUERY):
+        logger.error("Таблица generations не партиционирована, партиции не создаются")
+        return
+    
+    await conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS generations_default PARTITION OF generations DEFAULT"
+    ))
+    
+    month = date.today().replace(day=1)
+    for _ in range(months_ahead + 1):
+        next_month = (month + timedelta(days=32)).replace(day=1)
+        name = f"generations_{month:%Y_%m}"
+        
+        if not await conn.scalar(PARTITION_EXISTS_QUERY, {"name": name}):
+            bounds = f"FOR VALUES FROM ('{month}') TO ('{next_month}')"
+            in_month = f"created_at >= '{month}' AND created_at < '{next_month}'"
+            try:
+                async with conn.begin_nested():
+                    stranded = await conn.scalar(text(
+                        f"SELECT EXISTS (SELECT 1 FROM generations_default WHERE {in_month})"
+                    ))
+                    if not stranded:
+                        await conn.execute(text(f"CREATE TABLE {name} PARTITION OF generations {bounds}"))
+                    else:
+                        await conn.execute(text("ALTER TABLE generations DETACH PARTITION generations_default"))
+                        await conn.execute(text(f"CREATE TABLE {name} PARTITION OF generations {bounds}"))
+                        await conn.execute(text(
+                            f"WITH moved AS (DELETE FROM generations_default WHERE {in_month} RETURNING *) "
+                            f"INSERT INTO {name} SELECT * FROM moved"
+                        ))
+                        await conn.execute(text("ALTER TABLE generations ATTACH PARTITION generations_default DEFAULT"))
+                        logger.warning(f"Строки {month:%Y-%m} перенесены из generations_default в {name}")
+            except Exception as e:
+                logger.error(f"Ошибка при создании партиции {name}: {e}")
+        
+        month = next_month
+
+
+async def _maintain_generation_partitions():
+    """Периодическое создание партиций наперед: процесс может работать месяцами без рестарта"""
+    while True:
+        await asyncio.sleep(GENERATION_PARTITIONS_CHECK_INTERVAL)
+        try:
+            async with engine.begin() as conn:
+                await _ensure_generation_partitions(conn)
+        except Exception as e:
+            logger.error(f"Ошибка обслуживания партиций generations: {e}")
+
+
+def start_partition_maintenance():
+    """Запуск фонового обслуживания партиций (только в одном процессе - основном воркере)"""
+    global partitions_task
+    if partitions_task is None:
+        partitions_task = asyncio.create_task(_maintain_generation_partitions())
+
+
+async def _init_default_tariffs(conn: AsyncConnection):
     """Создание тарифов по умолчанию если их нет"""
+    from sqlalchemy.dialects.postgresql import insert as pg_insert
     from src.database.models import Tariff
     from decimal import Decimal
     
     try:
-        async with get_session() as session:
+        # Savepoint: ошибка seed не откатывает создание таблиц
+        async with conn.begin_nested():
             # Проверяем есть ли тарифы
-            result = await session.execute(text("SELECT COUNT(*) FROM tariffs"))
+            result = await conn.execute(TARIFF_COUNT_QUERY)
             count = result.scalar()
             
             if count == 0:
                 logger.info("Создаю тарифы по умолчанию...")
                 
                 default_tariffs = [
-                    Tariff(
-                        name="Базовый",
-                        price=Decimal("100.00"),
-                        generations=10,
-                        image_size="512x512",
-                        priority=False,
-                        is_active=True
-                    ),
-                    Tariff(
-                        name="Стандарт",
-                        price=Decimal("300.00"),
-                        generations=35,
-                        image_size="768x768",
-                        priority=False,
-                        is_active=True
-                    ),
-                    Tariff(
-                        name="Премиум",
-                        price=Decimal("500.00"),
-                        generations=65,
-                        image_size="1024x1024",
-                        priority=True,
-                        is_active=True
-                    ),
-                    Tariff(
-                        name="Профи",
-                        price=Decimal("1000.00"),
-                        generations=150,
-                        image_size="1024x1024",
-                        priority=True,
-                        is_active=True
-                    )
+                    {
+                        "name": "Базовый",
+                        "price": Decimal("100.00"),
+                        "generations": 10,
+                        "image_size": "512x512",
+                        "priority": False,
+                        "is_active": True
+                    },
+                    {
+                        "name": "Стандарт",
+                        "price": Decimal("300.00"),
+                        "generations": 35,
+                        "image_size": "768x768",
+                        "priority": False,
+                        "is_active": True
+                    },
+                    {
+                        "name": "Премиум",
+                        "price": Decimal("500.00"),
+                        "generations": 65,
+                        "image_size": "1024x1024",
+                        "priority": True,
+                        "is_active": True
+                    },
+                    {
+                        "name": "Профи",
+                        "price": Decimal("1000.00"),
+                        "generations": 150,
+                        "image_size": "1024x1024",
+                        "priority": True,
+                        "is_active": True
+                    }
                 ]
                 
-                for tariff in default_tariffs:
-                    session.add(tariff)
+                # Один multi-VALUES INSERT; ON CONFLICT по имени делает
+                # seed безопасным при одновременном старте нескольких процессов
+                await conn.execute(
+                    pg_insert(Tariff)
+                    .values(default_tariffs)
+                    .on_conflict_do_nothing(index_elements=[Tariff.name])
+                )
                 
-                await session.commit()
                 logger.info(f"✅ Создано {len(default_tariffs)} тарифов по умолчанию")
             else:
                 logger.info(f"Тарифы уже существуют ({count} шт.)")
@@ -130,7 +428,11 @@ async def _init_default_tariffs():
 
 async def close_database():
     """Закрытие подключения к базе данных"""
-    global engine
+    global engine, partitions_task
+    
+    if partitions_task:
+        partitions_task.cancel()
+        partitions_task = None
     
     if engine:
         await engine.dispose()
@@ -149,7 +451,7 @@ async def health_check() -> bool:
     """Проверка работоспособности базы данных"""
     try:
         async with get_session() as session:
-            result = await session.execute(text("SELECT 1 as health"))
+            result = await session.execute(PING_QUERY)
             return result.scalar() == 1
     except Exception as e:
         logger.error(f"Database health check failed: {e}")
@@ -196,19 +498,15 @@ class DatabaseManager:
         try:
             async with self.create_session() as session:
                 # Версия PostgreSQL
-                result = await session.execute(text("SELECT version()"))
+                result = await session.execute(DB_VERSION_QUERY)
                 version = result.scalar()
                 
                 # Размер базы данных
-                result = await session.execute(
-                    text("SELECT pg_size_pretty(pg_database_size(current_database()))")
-                )
+                result = await session.execute(DB_SIZE_QUERY)
                 size = result.scalar()
                 
                 # Количество подключений
-                result = await session.execute(
-                    text("SELECT count(*) FROM pg_stat_activity WHERE datname = current_database()")
-                )
+                result = await session.execute(DB_CONNECTIONS_QUERY)
                 connections = result.scalar()
                 
                 return {
@@ -259,13 +557,7 @@ def with_database_session(func):
 async def create_migration_table():
     """Создание таблицы миграций"""
     async with get_session() as session:
-        await session.execute(text("""
-            CREATE TABLE IF NOT EXISTS migrations (
-                id SERIAL PRIMARY KEY,
-                name VARCHAR(255) NOT NULL UNIQUE,
-                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """))
+        await session.execute(MIGRATIONS_TABLE_DDL)
         await session.commit()
 
 
@@ -274,7 +566,7 @@ async def apply_migration(migration_name: str, migration_sql: str):
     async with get_session() as session:
         # Проверяем, была ли миграция уже применена
         result = await session.execute(
-            text("SELECT id FROM migrations WHERE name = :name"),
+            MIGRATION_EXISTS_QUERY,
             {"name": migration_name}
         )
         
@@ -288,7 +580,7 @@ async def apply_migration(migration_name: str, migration_sql: str):
             
             # Записываем в таблицу миграций
             await session.execute(
-                text("INSERT INTO migrations (name) VALUES (:name)"),
+                MIGRATION_INSERT_QUERY,
                 {"name": migration_name}
             )
             
@@ -306,7 +598,7 @@ async def get_applied_migrations():
     try:
         async with get_session() as session:
             result = await session.execute(
-                text("SELECT name, applied_at FROM migrations ORDER BY applied_at")
+                MIGRATIONS_LIST_QUERY
             )
             return result.fetchall()
     except Exception as e:
@@ -317,8 +609,8 @@ async def get_applied_migrations():
 # Функции для бекапа и восстановления
 async def backup_database(backup_path: str):
     """Создание бекапа базы данных"""
-    import subprocess
     import os
+    from collections import deque
     
     try:
         # Извлекаем параметры подключения из URL
@@ -340,13 +632,27 @@ async def backup_database(backup_path: str):
             '--no-privileges'
         ]
         
-        result = subprocess.run(command, env=env, capture_output=True, text=True)
+        # pg_dump в отдельном процессе без блокировки event loop; stderr
+        # (--verbose) читаем построчно, для ошибки храним только хвост
+        proc = await asyncio.create_subprocess_exec(
+            *command,
+            env=env,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stderr_tail = deque(maxlen=20)
+        async for line in proc.stderr:
+            line = line.decode(errors='replace').rstrip()
+            stderr_tail.append(line)
+            logger.debug(f"pg_dump: {line}")
+        returncode = await proc.wait()
         
-        if result.returncode == 0:
+        if returncode == 0:
             logger.info(f"✅ Database backup created: {backup_path}")
             return True
         else:
-            logger.error(f"❌ Backup failed: {result.stderr}")
+            stderr = "\n".join(stderr_tail)
+            logger.error(f"❌ Backup failed: {stderr}")
             return False
             
     except Exception as e:
@@ -359,41 +665,13 @@ async def get_database_stats():
     """Получение статистики базы данных"""
     try:
         async with get_session() as session:
-            # Статистика таблиц
-            tables_stats = await session.execute(text("""
-                SELECT 
-                    schemaname,
-                    tablename,
-                    n_tup_ins,
-                    n_tup_upd,
-                    n_tup_del,
-                    n_live_tup,
-                    n_dead_tup
-                FROM pg_stat_user_tables
-                ORDER BY n_live_tup DESC
-            """))
-            
-            # Статистика подключений
-            connections_stats = await session.execute(text("""
-                SELECT 
-                    count(*) as total_connections,
-                    count(*) FILTER (WHERE state = 'active') as active_connections,
-                    count(*) FILTER (WHERE state = 'idle') as idle_connections
-                FROM pg_stat_activity 
-                WHERE datname = current_database()
-            """))
-            
-            # Размер базы данных
-            db_size = await session.execute(text("""
-                SELECT 
-                    pg_size_pretty(pg_database_size(current_database())) as db_size,
-                    pg_database_size(current_database()) as db_size_bytes
-            """))
+            result = await session.execute(DATABASE_STATS_QUERY)
+            row = result.one()
             
             return {
-                "tables": tables_stats.fetchall(),
-                "connections": connections_stats.fetchone(),
-                "size": db_size.fetchone()
+                "tables": row.tables,
+                "connections": row.connections,
+                "size": row.size
             }
             
     except Exception as e:
@@ -1,48 +1,90 @@
-from datetime import datetime, timezone
+import time
 from decimal import Decimal
-from typing import Optional, List
-from sqlalchemy import select, update, delete, func
+from typing import Optional, List, NamedTuple
+from sqlalchemy import select, insert, update, delete, func, cast, Numeric
+from sqlalchemy.dialects.postgresql import JSONB, insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncSession
-from src.database.connection import get_session
 from src.database.models import User, Payment, PaymentStatus, Tariff, Generation
 
 class UserCRUD:
-    async def get_or_create_user(self, **kwargs):
-        async with get_session() as s:
-            user = await s.get(User, kwargs["telegram_id"])
-            if not user:
-                user = User(**kwargs)
-                s.add(user); await s.commit()
-            return user
-
-    async def get_by_telegram_id(self, tid: int):
-        async with get_session() as s:
-            return await s.get(User, tid)
-
-    async def update_balance(self, tid: int, new_balance: int):
-        async with get_session() as s:
-            await s.execute(update(User).where(User.telegram_id==tid).values(balance=new_balance, last_activity=datetime.now(timezone.utc)))
-            await s.commit()
-
-    async def update_total_spent(self, tid: int, add: float):
-        async with get_session() as s:
-            await s.execute(update(User).where(User.telegram_id==tid).values(total_spent=User.total_spent+Decimal(str(add))))
-            await s.commit()
-    
-    async def update_last_activity(self, tid: int):
-        async with get_session() as s:
-            await s.execute(update(User).where(User.telegram_id==tid).values(last_activity=datetime.now(timezone.utc)))
-            await s.commit()
+    async def get_or_create_user(self, session: AsyncSession, **kwargs):
+        # Один INSERT ... ON CONFLICT DO UPDATE RETURNING: создание нового пользователя
+        # или отметка активности существующего за один запрос (и строка возвращается всегда)
+        stmt = (
+            pg_insert(User)
+            .values(**kwargs)
+            .on_conflict_do_update(index_elements=[User.telegram_id], set_={"last_activity": func.now()})
+            .returning(User)
+            .execution_options(populate_existing=True)
+        )
+        return (await session.execute(stmt)).scalar_one()
+
+    async def get_by_telegram_id(self, session: AsyncSession, tid: int):
+        return await session.get(User, tid)
+
+    async def update_balance(self, session: AsyncSession, tid: int, new_balance: int):
+        await session.execute(update(User).where(User.telegram_id==tid).values(balance=new_balance, last_activity=func.now()))
+
+    async def update_total_spent(self, session: AsyncSession, tid: int, add: float):
+        await session.execute(update(User).where(User.telegram_id==tid).values(total_spent=User.total_spent+cast(add, Numeric(10, 2)), last_activity=func.now()))
+
+    async def add_purchase(self, session: AsyncSession, tid: int, images: int, amount: float) -> bool:
+        """Зачисление покупки: баланс, сумма трат и активность одним UPDATE.
+        False - пользователь не найден (отдельный SELECT для проверки не нужен)"""
+        q = await session.execute(
+            update(User)
+            .where(User.telegram_id==tid)
+            .values(
+                balance=User.balance+images,
+                total_spent=User.total_spent+cast(amount, Numeric(10, 2)),
+                last_activity=func.now()
+            )
+            .returning(User.telegram_id)
+        )
+        return q.scalar_one_or_none() is not None
+
+class TariffInfo(NamedTuple):
+    """Снимок тарифа, не привязанный к сессии"""
+    id: int
+    name: str
+    price: Decimal
+    generations: int
+    image_size: str
+    priority: bool
+    is_active: bool
+
+# Кэш активных тарифов в памяти процесса: (время истечения, список, индекс по id).
+# Тарифы меняются только вне бота (сидирование при старте, правка в БД), а кэш
+# у каждого воркера свой, поэтому изменения подхватываются по истечении TTL
+TARIFF_CACHE_TTL = 60
+_tariff_cache: tuple[float, list[TariffInfo], dict[int, TariffInfo]] | None = None
 
 class TariffCRUD:
-    async def get_active_tariffs(self):
-        async with get_session() as s:
-            query = await s.execute(select(Tariff).where(Tariff.is_active == True).order_by(Tariff.price))
-            return query.scalars().all()
+    async def get_active_tariffs(self, session: AsyncSession) -> list[TariffInfo]:
+        return list((await self._load_active_tariffs(session))[1])
+
+    async def get_active_tariff(self, session: AsyncSession, tariff_id: int) -> TariffInfo | None:
+        """Активный тариф по id из кэша: без выборки и перебора всего каталога"""
+        return (await self._load_active_tariffs(session))[2].get(tariff_id)
+
+    async def _load_active_tariffs(self, session: AsyncSession):
+        global _tariff_cache
+        if _tariff_cache and _tariff_cache[0] > time.monotonic():
+            return _tariff_cache
+        query = await session.execute(
+            select(
+                Tariff.id, Tariff.name, Tariff.price, Tariff.generations,
+                Tariff.image_size, Tariff.priority, Tariff.is_active
+            )
+            .where(Tariff.is_active == True)
+            .order_by(Tariff.price)
+        )
+        tariffs = [TariffInfo(*row) for row in query]
+        _tariff_cache = (time.monotonic() + TARIFF_CACHE_TTL, tariffs, {t.id: t for t in tariffs})
+        return _tariff_cache
 
-    async def get_by_id(self, tariff_id: int):
-        async with get_session() as s:
-            return await s.get(Tariff, tariff_id)
+    async def get_by_id(self, session: AsyncSession, tariff_id: int):
+        return await session.get(Tariff, tariff_id)
 
 class GenerationCRUD:
     """CRUD операции для генераций изображений"""
@@ -58,19 +100,20 @@ class GenerationCRUD:
         status: str = "pending"
     ) -> Generation:
         """Создание новой генерации"""
-        generation = Generation(
-            user_id=user_id,
-            prompt=prompt,
-            style=style,
-            quality=quality,
-            size=size,
-            status=status,
-            created_at=datetime.now(timezone.utc)
+        # INSERT ... RETURNING: строка со всеми колонками за один запрос
+        result = await session.execute(
+            insert(Generation)
+            .values(
+                user_id=user_id,
+                prompt=prompt,
+                style=style,
+                quality=quality,
+                size=size,
+                status=status
+            )
+            .returning(Generation)
         )
-        session.add(generation)
-        await session.commit()
-        await session.refresh(generation)
-        return generation
+        return result.scalar_one()
     
     @staticmethod
     async def get_generation(session: AsyncSession, generation_id: int) -> Optional[Generation]:
@@ -107,22 +150,27 @@ class GenerationCRUD:
         if image_url:
             values["image_url"] = image_url
         if status == "completed":
-            values["completed_at"] = datetime.now(timezone.utc)
+            values["completed_at"] = func.now()
         
         await session.execute(
             update(Generation)
             .where(Generation.id == generation_id)
             .values(**values)
         )
-        await session.commit()
     
     @staticmethod
-    async def get_pending_generations(session: AsyncSession) -> List[Generation]:
-        """Получение всех ожидающих генераций"""
+    async def get_pending_generations(session: AsyncSession, batch_size: int = 10) -> List[Generation]:
+        """Захват пачки ожидающих генераций.
+
+        Строки блокируются до конца транзакции сессии; SKIP LOCKED
+        отдает параллельным воркерам непересекающиеся пачки.
+        """
         result = await session.execute(
             select(Generation)
             .where(Generation.status == "pending")
             .order_by(Generation.created_at.asc())
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
         )
         return result.scalars().all()
     
@@ -132,27 +180,74 @@ class GenerationCRUD:
         await session.execute(
             delete(Generation).where(Generation.id == generation_id)
         )
-        await session.commit()
 
 class PaymentCRUD:
-    async def create_payment(self, **data):
-        async with get_session() as s:
-            p = Payment(**data)
-            s.add(p); await s.commit(); await s.refresh(p)
-            return p
-
-    async def get_by_payment_id(self, pid: str):
-        async with get_session() as s:
-            q = await s.execute(select(Payment).where(Payment.payment_id==pid))
-            return q.scalar_one_or_none()
-
-    async def update_status(self, db_id, status: PaymentStatus, payment_metadata: dict | None = None):
-        async with get_session() as s:
-            await s.execute(update(Payment).where(Payment.id==db_id).values(status=status, payment_metadata=payment_metadata))
-            await s.commit()
+    async def create_payment(self, session: AsyncSession, **data):
+        q = await session.execute(insert(Payment).values(**data).returning(Payment))
+        return q.scalar_one()
+
+    async def get_by_payment_id(self, session: AsyncSession, pid: str):
+        q = await session.execute(select(Payment).where(Payment.payment_id==pid))
+        return q.scalar_one_or_none()
+
+    async def update_status(self, session: AsyncSession, db_id, status: PaymentStatus, metadata_patch: dict | None = None):
+        values = {"status": status}
+        if metadata_patch:
+            values["payment_metadata"] = _merge_metadata(metadata_patch)
+        await session.execute(update(Payment).where(Payment.id==db_id).values(**values))
     
-    async def update_metadata(self, db_id, payment_metadata: dict):
-        """Обновление метаданных платежа"""
-        async with get_session() as s:
-            await s.execute(update(Payment).where(Payment.id==db_id).values(payment_metadata=payment_metadata))
-            await s.commit()
+    async def patch_metadata(self, session: AsyncSession, db_id, patch: dict):
+        """Слияние ключей в метаданные платежа на стороне БД (jsonb ||)"""
+        await session.execute(update(Payment).where(Payment.id==db_id).values(payment_metadata=_merge_metadata(patch)))
+
+    async def finalize_success(self, session: AsyncSession, db_id, images: int, amount: Decimal, metadata_patch: dict):
+        """Успешный платеж одним запросом: статус и метаданные платежа, баланс и траты
+        пользователя (UPDATE payments в CTE + UPDATE users).
+
+        Уже проведенный платеж CTE не обновляет, поэтому и баланс повторно не
+        начисляется: None - платеж уже был проведен раньше (повторная доставка)"""
+        paid = (
+            update(Payment)
+            .where(Payment.id==db_id, Payment.status!=PaymentStatus.SUCCEEDED)
+            .values(status=PaymentStatus.SUCCEEDED, payment_metadata=_merge_metadata(metadata_patch))
+            .returning(Payment.user_id)
+            .cte("paid")
+        )
+        stmt = (
+            update(User)
+            .where(User.telegram_id==paid.c.user_id)
+            .values(
+                balance=User.balance+images,
+                total_spent=User.total_spent+cast(amount, Numeric(10, 2)),
+                last_activity=func.now()
+            )
+            .returning(User.telegram_id)
+        )
+        return (await session.execute(stmt)).scalar_one_or_none()
+
+    async def get_provider_statistics(self, session: AsyncSession, provider: str) -> dict:
+        """Количество, успешные, сумма и средний чек платежей провайдера одним запросом"""
+        succeeded = Payment.status==PaymentStatus.SUCCEEDED
+        row = (await session.execute(
+            select(
+                func.count(),
+                func.count().filter(succeeded),
+                func.coalesce(func.sum(Payment.amount).filter(succeeded), 0),
+                func.coalesce(func.avg(Payment.amount).filter(succeeded), 0)
+            ).where(Payment.provider==provider)
+        )).one()
+        total, successful, total_amount, average_amount = row
+        return {
+            "total_payments": total,
+            "successful_payments": successful,
+            "total_amount": total_amount,
+            "success_rate": round(successful / total * 100, 2) if total else 0.0,
+            "average_amount": average_amount
+        }
+
+
+def _merge_metadata(patch: dict):
+    """payment_metadata || patch: по сети идут только изменившиеся ключи,
+    поля, записанные параллельно другими обработчиками, не теряются.
+    NULL в metadata заменяется на '{}', иначе NULL || patch дал бы NULL"""
+    return func.coalesce(Payment.payment_metadata, cast({}, JSONB)).op("||")(cast(patch, JSONB))
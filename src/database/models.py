@@ -1,7 +1,8 @@
 import enum, uuid
-from datetime import datetime, timezone
+from datetime import datetime
 from decimal import Decimal
-from sqlalchemy import Enum, DateTime, Boolean, String, Integer, BigInteger, Numeric, ForeignKey, JSON
+from sqlalchemy import Enum, DateTime, Boolean, String, Integer, BigInteger, Numeric, ForeignKey, Index, text, func
+from sqlalchemy.dialects.postgresql import JSONB, UUID
 from sqlalchemy.orm import mapped_column, Mapped, relationship, DeclarativeBase
 from typing import Optional
 
@@ -21,8 +22,9 @@ class User(Base):
     last_name:   Mapped[str | None]
     balance:     Mapped[int] = mapped_column(Integer, default=0)
     is_admin:    Mapped[bool] = mapped_column(Boolean, default=False)
-    created_at:  Mapped[datetime] = mapped_column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
-    last_activity: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    # Время проставляет PostgreSQL: без Python-вызова на каждую строку
+    created_at:  Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+    last_activity: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
     # — Подписка
     subscription_type: Mapped[str | None] = mapped_column(String, default=None)
     subscription_expires_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True, default=None)
@@ -30,7 +32,8 @@ class User(Base):
     total_generations: Mapped[int] = mapped_column(Integer, default=0)
     total_spent: Mapped[Decimal] = mapped_column(Numeric(10,2), default=0)
 
-    payments: Mapped[list["Payment"]] = relationship(back_populates="user")
+    # Неявная ленивая загрузка запрещена: загружать через selectinload(User.payments)
+    payments: Mapped[list["Payment"]] = relationship(back_populates="user", lazy="raise_on_sql")
     
     @property
     def full_name(self) -> str:
@@ -47,7 +50,7 @@ class User(Base):
 class Tariff(Base):
     __tablename__ = "tariffs"
     id:          Mapped[int] = mapped_column(primary_key=True)
-    name:        Mapped[str]
+    name:        Mapped[str] = mapped_column(String, unique=True)
     price:       Mapped[Decimal] = mapped_column(Numeric(10,2))
     generations: Mapped[int]
     image_size:  Mapped[str]
@@ -56,27 +59,56 @@ class Tariff(Base):
 
 class Payment(Base):
     __tablename__ = "payments"
-    id:          Mapped[uuid.UUID] = mapped_column(primary_key=True, default=uuid.uuid4)
+    __table_args__ = (
+        # Платежи пользователя по статусу; ведущий user_id покрывает и выборку по user_id
+        Index("ix_payments_user_status", "user_id", "status"),
+        # Выборки по времени (статистика, отчеты)
+        Index("ix_payments_created", "created_at"),
+        # Поиск по содержимому metadata (@>): jsonb_path_ops компактнее
+        # jsonb_ops и быстрее на containment-запросах
+        Index(
+            "ix_payments_metadata_gin", "metadata",
+            postgresql_using="gin", postgresql_ops={"metadata": "jsonb_path_ops"}
+        ),
+    )
+    id:          Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), primary_key=True, server_default=text("gen_random_uuid()"))
     payment_id:  Mapped[str]       = mapped_column(String, unique=True, index=True)
     user_id:     Mapped[int]       = mapped_column(BigInteger, ForeignKey("users.telegram_id"))
     tariff_id:   Mapped[int | None] = mapped_column(ForeignKey("tariffs.id"))
     provider:    Mapped[str]
     amount:      Mapped[Decimal]   = mapped_column(Numeric(10,2))
-    status:      Mapped[PaymentStatus] = mapped_column(Enum(PaymentStatus))
-    created_at:  Mapped[datetime]  = mapped_column(DateTime, default=lambda: datetime.now(timezone.utc))
-    payment_metadata: Mapped[Optional[dict]] = mapped_column(JSON, nullable=True, default=None)
+    # Нативный enum payment_status с метками-значениями (миграция типа - в connection.py)
+    status:      Mapped[PaymentStatus] = mapped_column(
+        Enum(PaymentStatus, name="payment_status", native_enum=True, values_callable=lambda e: [m.value for m in e])
+    )
+    created_at:  Mapped[datetime]  = mapped_column(DateTime, server_default=func.now())
+    # Атрибут не может называться metadata (занято DeclarativeBase), колонка в БД - "metadata"
+    payment_metadata: Mapped[dict] = mapped_column("metadata", JSONB, default=dict, server_default=text("'{}'::jsonb"))
 
-    user: Mapped[User] = relationship(back_populates="payments")
+    user: Mapped[User] = relationship(back_populates="payments", lazy="raise_on_sql")
 
 class Generation(Base):
     __tablename__ = "generations"
-    id:           Mapped[int] = mapped_column(primary_key=True)
+    __table_args__ = (
+        # История пользователя: WHERE user_id = ? ORDER BY created_at DESC
+        Index("ix_gen_user_created", "user_id", text("created_at DESC")),
+        # Очередь ожидающих: частичный индекс только по pending-строкам
+        Index("ix_gen_pending", "status", "created_at", postgresql_where=text("status = 'pending'")),
+        # Помесячные партиции по created_at (создаются в connection.py);
+        # ключ партиционирования обязан входить в первичный ключ
+        {"postgresql_partition_by": "RANGE (created_at)"},
+    )
+    id:           Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     user_id:      Mapped[int] = mapped_column(BigInteger, ForeignKey("users.telegram_id"))
     prompt:       Mapped[str] = mapped_column(String(1000))
     style:        Mapped[str]
     quality:      Mapped[str]
     size:         Mapped[str] = mapped_column(default="512x512")
-    status:       Mapped[GenerationStatus] = mapped_column(Enum(GenerationStatus), default=GenerationStatus.PENDING)
+    # Нативный enum PostgreSQL (4 байта) с метками-значениями: 'pending', 'completed', ...
+    status:       Mapped[GenerationStatus] = mapped_column(
+        Enum(GenerationStatus, name="gen_status", native_enum=True, values_callable=lambda e: [m.value for m in e]),
+        default=GenerationStatus.PENDING
+    )
     image_url:    Mapped[Optional[str]] = mapped_column(String, nullable=True)
-    created_at:   Mapped[datetime] = mapped_column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    created_at:   Mapped[datetime] = mapped_column(DateTime(timezone=True), primary_key=True, server_default=func.now())
     completed_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
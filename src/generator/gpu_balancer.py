@@ -1,11 +1,23 @@
 """
 Балансировщик нагрузки GPU для AI генерации
 """
+import os
+import heapq
 import threading
 import logging
 import asyncio
+from bisect import bisect_left
+from functools import lru_cache
+from collections import deque
+from dataclasses import dataclass, asdict
 from typing import Dict, Any, List, Optional
-from datetime import datetime
+import time
+
+import orjson
+
+# Расширяемые сегменты аллокатора: меньше фрагментации без empty_cache в
+# установившемся режиме. Читается при первой аллокации CUDA
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
 
 import torch
 
@@ -14,28 +26,88 @@ from src.shared.redis_client import redis_client
 
 logger = logging.getLogger(__name__)
 
+# Прямые ссылки на функции опроса памяти (без поиска атрибутов на каждый вызов)
+_mem_alloc = torch.cuda.memory_allocated
+_mem_reserved = torch.cuda.memory_reserved
+
+# Архитектура GPU по compute capability (major, minor)
+_ARCH_TABLE = {
+    (7, 5): "turing",
+    (8, 0): "ampere",
+    (8, 6): "ampere",
+    (8, 9): "ada",
+    (9, 0): "hopper",
+    (12, 0): "blackwell",
+}
+
+# Оценка памяти на одну генерацию 512x512 (активации UNet/VAE сверх весов модели)
+BASE_GENERATION_MEMORY = int(1.5 * 1024**3)
+# Множитель памяти по качеству (ultra/high используют более тяжелые модели)
+QUALITY_MEMORY_FACTOR = {"fast": 1.0, "standard": 1.0, "high": 1.2, "ultra": 1.5}
+# Прирост на каждое следующее изображение батча (доля оценки одного изображения):
+# рабочие буферы UNet/VAE общие, растут только латенты и активации по batch-оси
+BATCH_IMAGE_MEMORY_FACTOR = 0.25
+# Штраф за каждую задачу в очереди GPU при выборе по свободной памяти (байты)
+QUEUE_MEMORY_PENALTY = 256 * 1024**2
+# Размер окна последних времен генерации (для перцентилей)
+GENERATION_TIMES_WINDOW = 1024
+# Минимальный интервал между записями статистики в Redis (секунды)
+STATS_SAVE_INTERVAL = 1.0
+# Рекомендуемое качество по длине очереди: 0 -> ultra, <=2 -> high, <=5 -> standard, иначе fast
+_QUALITY_QUEUE_BOUNDS = (0, 2, 5)
+_QUALITY_LADDER = ("ultra", "high", "standard", "fast")
+# Задача без освобождения GPU дольше этого времени считается зависшей (секунды)
+STALE_TASK_TIMEOUT = 600
+
+
+@dataclass(slots=True)
+class GPUSnapshot:
+    """Снимок состояния GPU для статистики"""
+    arch: str
+    queue_length: int
+    busy: bool
+    total_generations: int
+    error_count: int
+    total_memory_gb: float
+    memory_allocated_gb: float = 0.0
+    memory_reserved_gb: float = 0.0
+
 
 class GPUBalancer:
     """Балансировщик нагрузки между GPU для оптимального использования RTX 5080"""
     
     def __init__(self):
+        # Свойства GPU, полученные при старте (name, total_memory, ...)
+        self._device_props = {}
+        
         # Получаем список доступных GPU
         self.gpu_devices = self._get_gpu_devices()
         
         # Состояние каждого GPU
         self.gpu_status = {}
         
-        # Блокировка для thread-safety
+        # Min-heap нагрузки (busy, queue_length, total_generations, gpu_id);
+        # устаревшие записи отбрасываются лениво при выборе GPU
+        self._load_heap: list[tuple[bool, int, int, int]] = []
+        
+        # Одна блокировка на gpu_status, _load_heap и stats: секции короткие
+        # и без await, а release_gpu/mark_gpu_error зовутся и из потоков генерации
         self.lock = threading.Lock()
         
+        # Фоновая запись статистики в Redis (см. save_stats_to_redis)
+        self._save_task: Optional[asyncio.Task] = None
+        self._last_save = 0.0
+        
         # Инициализируем состояние GPU
         self._initialize_gpu_status()
         
         # Статистика использования
         self.stats = {
             'total_generations': 0,
-            'gpu_usage_time': {},
-            'generation_times': [],
+            # Последние времена генерации; среднее - по накопительным сумме и счетчику
+            'generation_times': deque(maxlen=GENERATION_TIMES_WINDOW),
+            'gen_time_sum': 0.0,
+            'gen_time_count': 0,
             'error_count': 0
         }
     
@@ -56,24 +128,21 @@ class GPUBalancer:
             else:
                 available_devices = list(range(gpu_count))
             
-            # Проверяем RTX 5080 и архитектуру Blackwell
             validated_devices = []
             for gpu_id in available_devices:
                 props = torch.cuda.get_device_properties(gpu_id)
+                self._device_props[gpu_id] = props
+                arch = _ARCH_TABLE.get((props.major, props.minor), "unknown")
                 
                 logger.info(
                     f"GPU {gpu_id}: {props.name}, "
-                    f"Compute: {props.major}.{props.minor}, "
+                    f"Compute: {props.major}.{props.minor} ({arch}), "
                     f"Memory: {props.total_memory / 1024**3:.1f} GB"
                 )
                 
                 # Проверяем минимальные требования
                 if props.total_memory >= 8 * 1024**3:  # Минимум 8GB
                     validated_devices.append(gpu_id)
-                    
-                    # Отмечаем RTX 5080 с архитектурой Blackwell
-                    if "RTX 5080" in props.name or (props.major == 12 and props.minor == 0):
-                        logger.info(f"🚀 RTX 5080 с архитектурой Blackwell обнаружена на GPU {gpu_id}")
                 else:
                     logger.warning(f"GPU {gpu_id} не соответствует минимальным требованиям")
             
@@ -86,7 +155,10 @@ class GPUBalancer:
     def _initialize_gpu_status(self):
         """Инициализация статуса GPU"""
         for gpu_id in self.gpu_devices:
+            props = self._device_props.get(gpu_id)
             self.gpu_status[gpu_id] = {
+                # Архитектура для выбора ядер (torch.compile, FlashAttention) ниже по стеку
+                "arch": _ARCH_TABLE.get((props.major, props.minor), "unknown") if props else "unknown",
                 "busy": False,
                 "queue_length": 0,
                 "current_task": None,
@@ -94,64 +166,125 @@ class GPUBalancer:
                 "total_time": 0.0,
                 "error_count": 0,
                 "memory_usage": 0.0,
+                "total_memory": props.total_memory if props else 0,
                 "temperature": 0.0,
-                "last_used": None
+                # time.monotonic() последнего освобождения GPU
+                "last_used_mono": None
             }
+            self._push_load(gpu_id)
+            
+            try:
+                torch.cuda.set_per_process_memory_fraction(settings.GPU_MEMORY_FRACTION, gpu_id)
+            except RuntimeError as e:
+                logger.warning(f"Не удалось ограничить память GPU {gpu_id}: {e}")
         
         logger.info(f"Инициализированы GPU: {list(self.gpu_status.keys())}")
     
-    async def get_available_gpu(self, priority: bool = False) -> Optional[int]:
+    def _load_key(self, gpu_id: int) -> tuple[bool, int, int, int]:
+        """Ключ нагрузки GPU: сначала свободные, затем по очереди и числу генераций"""
+        status = self.gpu_status[gpu_id]
+        return (status["busy"], status["queue_length"], status["total_generations"], gpu_id)
+    
+    def _push_load(self, gpu_id: int):
+        """Запись актуальной нагрузки GPU в heap (вызывать после каждого изменения)"""
+        # Периодически пересобираем heap, чтобы устаревшие записи не копились
+        if len(self._load_heap) > 4 * len(self.gpu_status):
+            self._load_heap = [self._load_key(g) for g in self.gpu_status]
+            heapq.heapify(self._load_heap)
+        else:
+            heapq.heappush(self._load_heap, self._load_key(gpu_id))
+    
+    @staticmethod
+    def estimate_memory(size: str = "512x512", quality: str = "standard", batch_size: int = 1) -> int:
+        """Оценка видеопамяти (байты), нужной одному проходу пайплайна на batch_size изображений"""
+        try:
+            width, height = (int(x) for x in size.split("x"))
+        except ValueError:
+            width, height = 512, 512
+        factor = QUALITY_MEMORY_FACTOR.get(quality, 1.0)
+        single = BASE_GENERATION_MEMORY * factor * width * height / (512 * 512)
+        return int(single * (1 + BATCH_IMAGE_MEMORY_FACTOR * (batch_size - 1)))
+    
+    def _free_memory(self) -> Optional[Dict[int, int]]:
+        """Доступная видеопамять по GPU или None, если недоступно.
+
+        cudaMemGetInfo считает занятыми и блоки, которые кеширующий аллокатор
+        PyTorch этого процесса держит в резерве без использования, - они
+        доступны генерации, поэтому добавляются к свободной памяти драйвера.
+        """
+        if not self.gpu_devices:
+            return None
+        try:
+            return {
+                gpu_id: torch.cuda.mem_get_info(gpu_id)[0] + _mem_reserved(gpu_id) - _mem_alloc(gpu_id)
+                for gpu_id in self.gpu_devices
+            }
+        except Exception as e:
+            logger.warning(f"Не удалось получить свободную память GPU: {e}")
+            return None
+    
+    def _select_by_memory(self, free_memory: Dict[int, int], mem_required: int) -> Optional[int]:
+        """Best-fit: максимум free - mem_required - штраф за очередь среди GPU,
+        где модель помещается"""
+        best_gpu, best_score = None, None
+        for gpu_id, free in free_memory.items():
+            if free < mem_required:
+                continue
+            score = free - mem_required - QUEUE_MEMORY_PENALTY * self.gpu_status[gpu_id]["queue_length"]
+            if best_score is None or score > best_score:
+                best_gpu, best_score = gpu_id, score
+        return best_gpu
+    
+    def _select_by_load(self) -> Optional[int]:
+        """Наименее загруженный GPU по heap; устаревшие записи пропускаем"""
+        while self._load_heap:
+            entry = heapq.heappop(self._load_heap)
+            if entry == self._load_key(entry[3]):
+                return entry[3]
+        return None
+    
+    async def get_available_gpu(self, priority: bool = False, mem_required: int = 0) -> Optional[int]:
         """
         Получение оптимального GPU для задачи
         
         Args:
             priority: Приоритетная задача (для премиум пользователей)
+            mem_required: Оценка видеопамяти задачи (см. estimate_memory)
         
         Returns:
             ID доступного GPU или None
         """
-        try:
-            with self.lock:
-                available_gpus = []
-                
-                # Сначала ищем полностью свободные GPU
-                for gpu_id, status in self.gpu_status.items():
-                    if not status["busy"] and status["queue_length"] == 0:
-                        available_gpus.append((gpu_id, 0))
-                
-                # Если нет свободных, ищем с минимальной очередью
-                if not available_gpus:
-                    for gpu_id, status in self.gpu_status.items():
-                        if not status["busy"]:
-                            available_gpus.append((gpu_id, status["queue_length"]))
-                
-                # Если все заняты, выбираем с минимальной очередью
-                if not available_gpus:
-                    for gpu_id, status in self.gpu_status.items():
-                        available_gpus.append((gpu_id, status["queue_length"]))
-                
-                if not available_gpus:
+        # Опрос драйвера - до блокировки и в потоке, не блокируя event loop
+        free_memory = None
+        if mem_required:
+            free_memory = await asyncio.get_running_loop().run_in_executor(None, self._free_memory)
+            
+        with self.lock:
+            selected_gpu = None
+            if free_memory is not None:
+                selected_gpu = self._select_by_memory(free_memory, mem_required)
+                if selected_gpu is None:
+                    # Оценка памяти приблизительная: задача не теряется, а встает
+                    # в очередь наименее загруженного GPU
+                    logger.warning(
+                        f"Нет GPU с {mem_required / 1024**3:.1f} GB свободной памяти, выбор по нагрузке"
+                    )
+            if selected_gpu is None:
+                selected_gpu = self._select_by_load()
+                if selected_gpu is None:
                     return None
                 
-                # Сортируем по нагрузке и выбираем оптимальный
-                available_gpus.sort(key=lambda x: (x[1], self.gpu_status[x[0]]["total_generations"]))
-                
-                selected_gpu = available_gpus[0][0]
-                
-                # Обновляем статус
-                if priority:
-                    # Приоритетные задачи идут в начало очереди
-                    self.gpu_status[selected_gpu]["busy"] = True
-                    self.gpu_status[selected_gpu]["current_task"] = f"priority_{datetime.now().isoformat()}"
-                else:
-                    self.gpu_status[selected_gpu]["queue_length"] += 1
-                
-                logger.info(f"Выделен GPU {selected_gpu} (приоритет: {priority})")
-                return selected_gpu
+            # Обновляем статус
+            if priority:
+                # Приоритетные задачи идут в начало очереди
+                self.gpu_status[selected_gpu]["busy"] = True
+                self.gpu_status[selected_gpu]["current_task"] = f"priority_{time.monotonic_ns()}"
+            else:
+                self.gpu_status[selected_gpu]["queue_length"] += 1
+            self._push_load(selected_gpu)
                 
-        except Exception as e:
-            logger.error(f"Ошибка выбора GPU: {e}")
-            return None
+            logger.info(f"Выделен GPU {selected_gpu} (приоритет: {priority})")
+            return selected_gpu
     
     def release_gpu(self, gpu_id: int, generation_time: float = 0.0):
         """
@@ -161,92 +294,98 @@ class GPUBalancer:
             gpu_id: ID GPU для освобождения
             generation_time: Время генерации в секундах
         """
-        try:
-            with self.lock:
-                if gpu_id in self.gpu_status:
-                    status = self.gpu_status[gpu_id]
-                    
-                    if status["queue_length"] > 0:
-                        status["queue_length"] -= 1
-                    else:
-                        status["busy"] = False
-                        status["current_task"] = None
+        with self.lock:
+            if gpu_id in self.gpu_status:
+                status = self.gpu_status[gpu_id]
                     
-                    # Обновляем статистику
-                    status["total_generations"] += 1
-                    status["total_time"] += generation_time
-                    status["last_used"] = datetime.now()
+                if status["queue_length"] > 0:
+                    status["queue_length"] -= 1
+                else:
+                    status["busy"] = False
+                    status["current_task"] = None
                     
-                    if generation_time > 0:
-                        self.stats["generation_times"].append(generation_time)
-                        self.stats["total_generations"] += 1
+                # Обновляем статистику
+                status["total_generations"] += 1
+                status["total_time"] += generation_time
+                status["last_used_mono"] = time.monotonic()
+                self._push_load(gpu_id)
                     
-                    logger.info(f"Освобожден GPU {gpu_id}, время: {generation_time:.1f}с")
+                if generation_time > 0:
+                    self.stats["generation_times"].append(generation_time)
+                    self.stats["gen_time_sum"] += generation_time
+                    self.stats["gen_time_count"] += 1
+                    self.stats["total_generations"] += 1
                     
-        except Exception as e:
-            logger.error(f"Ошибка освобождения GPU {gpu_id}: {e}")
+                logger.info(f"Освобожден GPU {gpu_id}, время: {generation_time:.1f}с")
     
     def mark_gpu_error(self, gpu_id: int, error: str):
         """Отметка ошибки на GPU"""
-        try:
-            with self.lock:
-                if gpu_id in self.gpu_status:
-                    self.gpu_status[gpu_id]["error_count"] += 1
-                    self.stats["error_count"] += 1
+        with self.lock:
+            if gpu_id in self.gpu_status:
+                self.gpu_status[gpu_id]["error_count"] += 1
+                self.stats["error_count"] += 1
                     
-                    logger.error(f"Ошибка на GPU {gpu_id}: {error}")
+                logger.error(f"Ошибка на GPU {gpu_id}: {error}")
                     
-                    # Если много ошибок, временно исключаем GPU
-                    if self.gpu_status[gpu_id]["error_count"] > 5:
-                        logger.warning(f"GPU {gpu_id} временно отключен из-за множественных ошибок")
-                        # Можно добавить логику временного отключения
-                        
+                # Если много ошибок, временно исключаем GPU
+                if self.gpu_status[gpu_id]["error_count"] > 5:
+                    logger.warning(f"GPU {gpu_id} временно отключен из-за множественных ошибок")
+                    # Можно добавить логику временного отключения
+    
+    @staticmethod
+    def _snapshot_cuda_mem(devices: List[int]) -> Dict[int, tuple[float, float]]:
+        """Выделенная и зарезервированная память (GB) по GPU.
+
+        Индекс устройства передается явно, поэтому set_device (переключение
+        контекста) не нужен.
+        """
+        memory = {}
+        try:
+            for gpu_id in devices:
+                memory[gpu_id] = (
+                    round(_mem_alloc(gpu_id) / 1024**3, 2),
+                    round(_mem_reserved(gpu_id) / 1024**3, 2)
+                )
         except Exception as e:
-            logger.error(f"Ошибка отметки ошибки GPU {gpu_id}: {e}")
+            logger.warning(f"Не удалось получить статистику памяти GPU: {e}")
+        return memory
     
     async def get_gpu_stats(self) -> Dict[str, Any]:
         """Получение статистики использования GPU"""
         try:
+            # Под блокировкой копируем только примитивы - один проход по gpu_status
             with self.lock:
-                stats = {
-                    "gpu_count": len(self.gpu_devices),
-                    "gpu_status": self.gpu_status.copy(),
-                    "total_generations": self.stats["total_generations"],
-                    "total_errors": self.stats["error_count"],
-                    "average_generation_time": 0.0,
-                    "queue_lengths": {},
-                    "memory_usage": {},
-                    "availability": {}
+                snapshots = {
+                    gpu_id: GPUSnapshot(
+                        arch=status["arch"],
+                        queue_length=status["queue_length"],
+                        busy=status["busy"],
+                        total_generations=status["total_generations"],
+                        error_count=status["error_count"],
+                        total_memory_gb=round(status["total_memory"] / 1024**3, 2)
+                    )
+                    for gpu_id, status in self.gpu_status.items()
                 }
-                
-                # Вычисляем среднее время генерации
-                if self.stats["generation_times"]:
-                    stats["average_generation_time"] = sum(self.stats["generation_times"]) / len(self.stats["generation_times"])
-                
-                # Получаем текущую информацию о GPU
-                for gpu_id in self.gpu_devices:
-                    try:
-                        # Длина очереди
-                        stats["queue_lengths"][gpu_id] = self.gpu_status[gpu_id]["queue_length"]
-                        
-                        # Использование памяти GPU
-                        if torch.cuda.is_available():
-                            torch.cuda.set_device(gpu_id)
-                            memory_allocated = torch.cuda.memory_allocated(gpu_id) / 1024**3
-                            memory_reserved = torch.cuda.memory_reserved(gpu_id) / 1024**3
-                            
-                            stats["memory_usage"][gpu_id] = {
-                                "allocated_gb": round(memory_allocated, 2),
-                                "reserved_gb": round(memory_reserved, 2)
-                            }
-                        
-                        # Доступность
-                        stats["availability"][gpu_id] = not self.gpu_status[gpu_id]["busy"]
-                        
-                    except Exception as e:
-                        logger.warning(f"Не удалось получить статистику GPU {gpu_id}: {e}")
-                
-                return stats
+                total_generations = self.stats["total_generations"]
+                total_errors = self.stats["error_count"]
+                gen_time_count = self.stats["gen_time_count"]
+                gen_time_sum = self.stats["gen_time_sum"]
+            
+            # Опрос памяти CUDA - без блокировки и в потоке, не блокируя event loop
+            memory = await asyncio.get_running_loop().run_in_executor(
+                None, self._snapshot_cuda_mem, list(snapshots)
+            )
+            for gpu_id, (allocated_gb, reserved_gb) in memory.items():
+                snapshots[gpu_id].memory_allocated_gb = allocated_gb
+                snapshots[gpu_id].memory_reserved_gb = reserved_gb
+            
+            return {
+                "gpu_count": len(self.gpu_devices),
+                "gpu_status": {gpu_id: asdict(snapshot) for gpu_id, snapshot in snapshots.items()},
+                "total_generations": total_generations,
+                "total_errors": total_errors,
+                "average_generation_time": gen_time_sum / gen_time_count if gen_time_count else 0.0
+            }
                 
         except Exception as e:
             logger.error(f"Ошибка получения статистики GPU: {e}")
@@ -256,31 +395,28 @@ class GPUBalancer:
         """Оптимизация распределения нагрузки между GPU"""
         try:
             with self.lock:
-                # Находим перегруженные и недогруженные GPU
-                total_load = sum(status["queue_length"] for status in self.gpu_status.values())
-                
-                if total_load == 0:
-                    return
-                
-                average_load = total_load / len(self.gpu_devices)
-                
-                overloaded_gpus = []
-                underloaded_gpus = []
-                
-                for gpu_id, status in self.gpu_status.items():
-                    if status["queue_length"] > average_load * 1.5:
-                        overloaded_gpus.append(gpu_id)
-                    elif status["queue_length"] < average_load * 0.5:
-                        underloaded_gpus.append(gpu_id)
-                
-                # Логируем информацию для мониторинга
-                if overloaded_gpus or underloaded_gpus:
-                    logger.info(
-                        f"GPU балансировка: перегружены {overloaded_gpus}, "
-                        f"недогружены {underloaded_gpus}"
-                    )
-                
-                # Можно добавить логику перебалансировки задач
+                # Под блокировкой только снимок длин очередей (один проход по gpu_status)
+                queue_lengths = tuple(
+                    (gpu_id, status["queue_length"]) for gpu_id, status in self.gpu_status.items()
+                )
+            
+            # Находим перегруженные и недогруженные GPU - без блокировки
+            total_load = sum(length for _, length in queue_lengths)
+            if total_load == 0:
+                return
+            
+            average_load = total_load / len(queue_lengths)
+            overloaded_gpus = [gpu_id for gpu_id, length in queue_lengths if length > average_load * 1.5]
+            underloaded_gpus = [gpu_id for gpu_id, length in queue_lengths if length < average_load * 0.5]
+            
+            # Логируем информацию для мониторинга
+            if overloaded_gpus or underloaded_gpus:
+                logger.info(
+                    f"GPU балансировка: перегружены {overloaded_gpus}, "
+                    f"недогружены {underloaded_gpus}"
+                )
+            
+            # Можно добавить логику перебалансировки задач
                 
         except Exception as e:
             logger.error(f"Ошибка оптимизации GPU: {e}")
@@ -288,14 +424,15 @@ class GPUBalancer:
     async def cleanup_stale_tasks(self):
         """Очистка зависших задач"""
         try:
+            stale_gpus = []
             with self.lock:
-                current_time = datetime.now()
+                current_time = time.monotonic()
                 
                 for gpu_id, status in self.gpu_status.items():
                     # Проверяем задачи, которые выполняются слишком долго
                     if (status["current_task"] and 
-                        status["last_used"] and 
-                        (current_time - status["last_used"]).seconds > 600):  # 10 минут
+                        status["last_used_mono"] and 
+                        current_time - status["last_used_mono"] > STALE_TASK_TIMEOUT):
                         
                         logger.warning(f"Обнаружена зависшая задача на GPU {gpu_id}")
                         
@@ -303,23 +440,42 @@ class GPUBalancer:
                         status["busy"] = False
                         status["current_task"] = None
                         status["error_count"] += 1
-                        
-                        # Очищаем память GPU
-                        try:
-                            torch.cuda.empty_cache()
-                        except:
-                            pass
+                        self._push_load(gpu_id)
+                        stale_gpus.append(gpu_id)
+            
+            # Возвращаем кеш аллокатора только освобожденных GPU - вне блокировки
+            for gpu_id in stale_gpus:
+                try:
+                    with torch.cuda.device(gpu_id):
+                        torch.cuda.empty_cache()
+                except RuntimeError as e:
+                    logger.warning(f"Не удалось очистить кеш GPU {gpu_id}: {e}")
                 
         except Exception as e:
             logger.error(f"Ошибка очистки зависших задач: {e}")
     
     async def save_stats_to_redis(self):
-        """Сохранение статистики в Redis для мониторинга"""
+        """Сохранение статистики в Redis для мониторинга.
+
+        Запись выполняется в фоновой задаче не чаще раза в STATS_SAVE_INTERVAL
+        секунд; вызовы во время ожидания сливаются в одну запись.
+        """
+        if self._save_task is not None and not self._save_task.done():
+            return
+        delay = max(0.0, STATS_SAVE_INTERVAL - (time.monotonic() - self._last_save))
+        self._save_task = asyncio.create_task(self._do_save_stats(delay))
+    
+    async def _do_save_stats(self, delay: float):
+        """Запись статистики в Redis после задержки (снимок берется в момент записи)"""
+        if delay:
+            await asyncio.sleep(delay)
+        self._last_save = time.monotonic()
         try:
             stats = await self.get_gpu_stats()
-            await redis_client.set(
+            # orjson: быстрее json; ключи GPU - int
+            await redis_client.redis.set(
                 "gpu_balancer_stats",
-                stats,
+                orjson.dumps(stats, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_NAIVE_UTC),
                 ex=300  # 5 минут
             )
             
@@ -328,28 +484,17 @@ class GPUBalancer:
     
     def get_recommended_quality(self, gpu_id: int) -> str:
         """Рекомендация качества генерации в зависимости от нагрузки GPU"""
-        try:
-            with self.lock:
-                if gpu_id not in self.gpu_status:
-                    return "standard"
-                
-                status = self.gpu_status[gpu_id]
-                queue_length = status["queue_length"]
-                
-                # Рекомендуем качество в зависимости от нагрузки
-                if queue_length == 0:
-                    return "ultra"
-                elif queue_length <= 2:
-                    return "high"
-                elif queue_length <= 5:
-                    return "standard"
-                else:
-                    return "fast"
-                    
-        except Exception as e:
-            logger.error(f"Ошибка определения рекомендуемого качества: {e}")
+        status = self.gpu_status.get(gpu_id)
+        if status is None:
             return "standard"
+        
+        # Без блокировки: чтение int из dict атомарно под GIL, устаревшее
+        # на одну задачу значение безвредно
+        return _QUALITY_LADDER[bisect_left(_QUALITY_QUEUE_BOUNDS, status["queue_length"])]
 
 
-# Глобальный экземпляр балансировщика
-gpu_balancer = GPUBalancer()
\ No newline at end of file
+# Глобальный экземпляр балансировщика: создается при первом обращении,
+# чтобы импорт модуля не инициализировал CUDA
+@lru_cache(maxsize=1)
+def get_gpu_balancer() -> GPUBalancer:
+    return GPUBalancer()
@@ -3,12 +3,17 @@
 Оптимизирован для RTX 5080 с архитектурой Blackwell
 """
 import os
+import gc
 import logging
 import asyncio
+import time
+from collections import deque
+from io import BytesIO
 from typing import Dict, Any, Optional, List
-from datetime import datetime
 
 import torch
+import torch._dynamo.config
+import torch._inductor.config
 import torch.nn.functional as F
 from diffusers import (
     StableDiffusionXLPipeline, 
@@ -16,15 +21,44 @@ from diffusers import (
     LCMScheduler,
     DiffusionPipeline
 )
-from diffusers.models import AutoencoderKL
+from diffusers.models import AutoencoderKL, UNet2DConditionModel
+from huggingface_hub import hf_hub_download
 from safetensors.torch import load_file
-import xformers
 
-from src.shared.config import settings, QUALITY_SETTINGS, IMAGE_STYLES
-from src.generator.gpu_balancer import gpu_balancer
+from src.shared.config import settings, ALLOWED_SIZES, QUALITY_SETTINGS, IMAGE_STYLES
+from src.generator.gpu_balancer import get_gpu_balancer, GENERATION_TIMES_WINDOW
 
 logger = logging.getLogger(__name__)
 
+# Внимание через F.scaled_dot_product_attention (диффузоры используют его по
+# умолчанию): cuDNN/Flash/mem-efficient ядра компилируются Inductor без разрывов графа
+torch.backends.cuda.enable_cudnn_sdp(True)
+torch.backends.cuda.enable_flash_sdp(True)
+torch.backends.cuda.enable_mem_efficient_sdp(True)
+
+# Настройки Inductor для сверточных UNet/VAE (1x1 свертки как GEMM, донастройка тайлов)
+torch._inductor.config.conv_1x1_as_mm = True
+torch._inductor.config.coordinate_descent_tuning = True
+# Шаги UNet и декодирование VAE воспроизводятся как CUDA Graphs (без запуска ядер с CPU).
+# max-autotune включает это и сам; флаг задан явно, чтобы не зависеть от режима
+torch._inductor.config.triton.cudagraphs = True
+# Скомпилированные графы переживают перезапуск воркера (кеш на диске рядом с моделями)
+torch._inductor.config.fx_graph_cache = True
+os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", str(settings.MODEL_CACHE_DIR / "torch_compile_cache"))
+
+# Резерв видеопамяти под активации генерации при загрузке моделей (GB)
+MODEL_MEMORY_RESERVE_GB = 2.0
+# Максимум промптов в одном батче пайплайна (ограничен видеопамятью)
+GENERATION_BATCH_SIZE = 4
+# Размеры батча, под которые компилируются графы: одиночная задача и полный батч.
+# Неполный батч дополняется до GENERATION_BATCH_SIZE, иначе каждый размер 2..N-1
+# компилировался бы (max-autotune + запись CUDA Graph) прямо в запросе пользователя
+COMPILED_BATCH_SIZES = (1, GENERATION_BATCH_SIZE)
+# Каждая пара (размер, батч) - свой статический граф; кеш Dynamo должен вместить все
+torch._dynamo.config.cache_size_limit = max(
+    torch._dynamo.config.cache_size_limit, len(ALLOWED_SIZES) * len(COMPILED_BATCH_SIZES)
+)
+
 
 class ModelManager:
     """Менеджер загрузки и управления AI моделями"""
@@ -34,9 +68,18 @@ class ModelManager:
         self.model_cache_dir = getattr(settings, 'MODEL_CACHE_DIR', './models')
         os.makedirs(self.model_cache_dir, exist_ok=True)
         
+        # Квантование весов UNet перед компиляцией (см. _quantize_unet)
+        self.quantization_mode = settings.GPU_QUANTIZATION
+        
         # Загруженные модели по GPU
         self.loaded_models: Dict[int, Dict[str, Any]] = {}
         
+        # GPU, на которых SDXL Base не поместилась в видеопамять и работает с CPU offload
+        self.enable_cpu_offload_on_gpus: set[int] = set()
+        
+        # Эмбеддинги негативных промптов: gpu_id -> модель -> стиль -> (embeds, pooled)
+        self.style_embeds: Dict[int, Dict[str, Dict[str, tuple]]] = {}
+        
         # Конфигурация моделей
         self.model_configs = {
             "sdxl_base": {
@@ -51,7 +94,7 @@ class ModelManager:
                 "memory_gb": 6.0,
                 "recommended_steps": 4
             },
-            "lcm_sdxl": {
+            "lcm": {
                 "model_id": "latent-consistency/lcm-sdxl",
                 "type": "text2img", 
                 "memory_gb": 6.0,
@@ -63,27 +106,115 @@ class ModelManager:
         self.model_stats = {
             "total_generations": 0,
             "model_usage": {},
-            "generation_times": [],
+            # Последние времена генерации (ограниченное окно, как в GPUBalancer)
+            "generation_times": deque(maxlen=GENERATION_TIMES_WINDOW),
             "memory_usage": {}
         }
     
+    def _optimize_pipeline(self, pipeline: DiffusionPipeline, device: str) -> DiffusionPipeline:
+        """Слияние QKV, channels-last и torch.compile для UNet и декодера VAE.
+
+        Компиляция прогревается сразу, чтобы ее не ждал первый пользователь;
+        при ошибке остаются некомпилированные модули.
+        """
+        # Q/K/V одним GEMM вместо трех - до квантования и компиляции,
+        # чтобы Inductor видел уже слитые проекции (UNet и VAE)
+        pipeline.fuse_qkv_projections()
+        
+        pipeline.unet.to(memory_format=torch.channels_last)
+        pipeline.vae.to(memory_format=torch.channels_last)
+        
+        self._quantize_unet(pipeline, device)
+        
+        eager_unet, eager_decode = pipeline.unet, pipeline.vae.decode
+        try:
+            pipeline.unet = torch.compile(
+                pipeline.unet, mode="max-autotune", fullgraph=True, dynamic=False
+            )
+            pipeline.vae.decode = torch.compile(
+                pipeline.vae.decode, mode="max-autotune", fullgraph=True, dynamic=False
+            )
+            # Загрузка идет в рабочем потоке: текущее устройство задаем явно
+            with torch.cuda.device(device):
+                self._warmup_pipeline(pipeline)
+            logger.info(f"Модель скомпилирована для ускорения на {device}")
+        except Exception as e:
+            logger.warning(f"Не удалось скомпилировать модель: {e}")
+            pipeline.unet, pipeline.vae.decode = eager_unet, eager_decode
+        
+        return pipeline
+    
+    def _quantize_unet(self, pipeline: DiffusionPipeline, device: str):
+        """Квантование весов UNet согласно self.quantization_mode"""
+        mode = self.quantization_mode
+        if mode == "none":
+            return
+        
+        # NVFP4 есть только на Blackwell (SM100+), на остальных GPU - int8
+        if mode == "nvfp4" and torch.cuda.get_device_capability(device) < (10, 0):
+            logger.warning(f"NVFP4 не поддерживается на {device}, используется int8")
+            mode = "int8"
+        
+        try:
+            if mode == "nvfp4":
+                import modelopt.torch.quantization as mtq
+                mtq.quantize(pipeline.unet, mtq.NVFP4_DEFAULT_CFG)
+            elif mode == "int8":
+                from torchao.quantization import quantize_, int8_dynamic_activation_int8_weight
+                quantize_(pipeline.unet, int8_dynamic_activation_int8_weight())
+            else:
+                logger.warning(f"Неизвестный режим квантования: {mode}")
+                return
+        except ImportError as e:
+            logger.warning(f"Квантование {mode} недоступно ({e}), UNet остается в fp16")
+            return
+        
+        logger.info(f"UNet квантован ({mode}) на {device}")
+    
+    @staticmethod
+    def _warmup_pipeline(pipeline: DiffusionPipeline):
+        """Прогон на каждом размере из ALLOWED_SIZES и каждом батче из COMPILED_BATCH_SIZES:
+        компиляция графов и запись CUDA Graphs.
+
+        CUDA Graph записывается на втором вызове скомпилированного модуля
+        (первый - разогрев), поэтому пайплайн прогоняется дважды.
+        """
+        for size in ALLOWED_SIZES:
+            width, height = map(int, size.split('x'))
+            for batch_size in COMPILED_BATCH_SIZES:
+                for _ in range(2):
+                    with torch.inference_mode():
+                        # guidance_scale как в generate_image: та же форма батча с CFG;
+                        # декодирование в PIL, чтобы прогреть и vae.decode
+                        pipeline(
+                            prompt=["warmup"] * batch_size,
+                            num_inference_steps=1,
+                            guidance_scale=7.5,
+                            width=width,
+                            height=height
+                        )
+    
     async def load_models_on_gpus(self) -> Dict[int, bool]:
-        """Загрузка моделей на доступные GPU"""
-        results = {}
+        """Загрузка моделей на доступные GPU (параллельно: каждый GPU грузится в своем потоке)"""
+        gpu_devices = get_gpu_balancer().gpu_devices
+        for gpu_id in gpu_devices:
+            logger.info(f"Загрузка моделей на GPU {gpu_id}...")
         
-        for gpu_id in gpu_balancer.gpu_devices:
-            try:
-                logger.info(f"Загрузка моделей на GPU {gpu_id}...")
-                success = await self.load_models_on_gpu(gpu_id)
-                results[gpu_id] = success
-                
-                if success:
-                    logger.info(f"✅ Модели успешно загружены на GPU {gpu_id}")
-                else:
-                    logger.error(f"❌ Не удалось загрузить модели на GPU {gpu_id}")
-                    
-            except Exception as e:
-                logger.error(f"❌ Ошибка загрузки моделей на GPU {gpu_id}: {e}")
+        outcomes = await asyncio.gather(
+            *(self.load_models_on_gpu(gpu_id) for gpu_id in gpu_devices),
+            return_exceptions=True
+        )
+        
+        results = {}
+        for gpu_id, outcome in zip(gpu_devices, outcomes):
+            if isinstance(outcome, BaseException):
+                logger.error(f"❌ Ошибка загрузки моделей на GPU {gpu_id}: {outcome}")
+                results[gpu_id] = False
+            elif outcome:
+                logger.info(f"✅ Модели успешно загружены на GPU {gpu_id}")
+                results[gpu_id] = True
+            else:
+                logger.error(f"❌ Не удалось загрузить модели на GPU {gpu_id}")
                 results[gpu_id] = False
         
         return results
@@ -91,12 +222,11 @@ class ModelManager:
     async def load_models_on_gpu(self, gpu_id: int) -> bool:
         """Загрузка моделей на конкретный GPU"""
         try:
-            # Устанавливаем устройство
+            # Устройство передается явно: set_device гонялся бы с загрузкой на других GPU
             device = f"cuda:{gpu_id}"
-            torch.cuda.set_device(gpu_id)
             
-            # Очищаем кеш памяти
-            torch.cuda.empty_cache()
+            # Кеш аллокатора не очищаем: с expandable_segments (см. gpu_balancer)
+            # сегменты растут на месте, а освобождать перед загрузкой нечего
             
             # Проверяем доступную память
             memory_gb = torch.cuda.get_device_properties(gpu_id).total_memory / 1024**3
@@ -104,21 +234,40 @@ class ModelManager:
             
             models = {}
             
+            # CPU offload - только если SDXL Base не помещается в свободную видеопамять
+            free_gb = torch.cuda.mem_get_info(gpu_id)[0] / 1024**3
+            if free_gb < self.model_configs["sdxl_base"]["memory_gb"]:
+                logger.warning(f"GPU {gpu_id}: свободно {free_gb:.1f}GB, SDXL Base загружается с CPU offload")
+                self.enable_cpu_offload_on_gpus.add(gpu_id)
+            else:
+                self.enable_cpu_offload_on_gpus.discard(gpu_id)
+            
             # Загружаем SDXL Base (основная модель)
             logger.info(f"Загрузка SDXL Base на GPU {gpu_id}...")
-            models["sdxl_base"] = await self._load_sdxl_base(device)
-            
-            # Если достаточно памяти, загружаем дополнительные модели
-            current_memory = torch.cuda.memory_allocated(gpu_id) / 1024**3
-            available_memory = memory_gb - current_memory - 2  # Резерв 2GB
-            
-            if available_memory > 6:
-                logger.info(f"Загрузка SDXL Turbo на GPU {gpu_id}...")
-                models["sdxl_turbo"] = await self._load_sdxl_turbo(device)
-            
-            if available_memory > 4:
-                logger.info(f"Загрузка LCM на GPU {gpu_id}...")
-                models["lcm"] = await self._load_lcm_model(device)
+            models["sdxl_base"] = await asyncio.to_thread(self._load_sdxl_base, device)
+            
+            # Дополнительные модели - пока фактически свободная видеопамять (cudaMemGetInfo)
+            # за вычетом резерва под активации покрывает memory_gb из model_configs
+            if gpu_id not in self.enable_cpu_offload_on_gpus:
+                available_gb = torch.cuda.mem_get_info(gpu_id)[0] / 1024**3 - MODEL_MEMORY_RESERVE_GB
+                extra_loaders = {
+                    "sdxl_turbo": (self._load_sdxl_turbo, device),
+                    "lcm": (self._load_lcm_model, device, models["sdxl_base"]),
+                }
+                for name, (loader, *args) in extra_loaders.items():
+                    need_gb = self.model_configs[name]["memory_gb"]
+                    if available_gb < need_gb:
+                        logger.info(f"GPU {gpu_id}: {name} не загружается, свободно {available_gb:.1f}GB из {need_gb:.1f}GB")
+                        continue
+                    logger.info(f"Загрузка {name} на GPU {gpu_id}...")
+                    models[name] = await asyncio.to_thread(loader, *args)
+                    available_gb -= need_gb
+            
+            # Негативные промпты стилей кодируем один раз, а не в каждом запросе
+            self.style_embeds[gpu_id] = {
+                name: await asyncio.to_thread(self._encode_style_negatives, pipeline, device)
+                for name, pipeline in models.items()
+            }
             
             # Сохраняем загруженные модели
             self.loaded_models[gpu_id] = models
@@ -135,110 +284,142 @@ class ModelManager:
             logger.error(f"Ошибка загрузки моделей на GPU {gpu_id}: {e}")
             return False
     
-    async def _load_sdxl_base(self, device: str) -> DiffusionPipeline:
+    def _from_pretrained(self, model_id: str, device: str, **kwargs) -> StableDiffusionXLPipeline:
+        """Загрузка fp16 safetensors: тензоры читаются сразу на устройство, минуя копию в RAM"""
+        return StableDiffusionXLPipeline.from_pretrained(
+            model_id,
+            cache_dir=self.model_cache_dir,
+            torch_dtype=torch.float16,
+            variant="fp16",
+            use_safetensors=True,
+            low_cpu_mem_usage=True,
+            device_map={"": device},
+            **kwargs
+        )
+    
+    def _load_sdxl_base(self, device: str) -> DiffusionPipeline:
         """Загрузка основной модели SDXL"""
         try:
-            # Настройки для RTX 5080 и архитектуры Blackwell
-            torch_dtype = torch.float16
-            variant = "fp16"
-            
-            pipeline = StableDiffusionXLPipeline.from_pretrained(
-                "stabilityai/stable-diffusion-xl-base-1.0",
-                cache_dir=self.model_cache_dir,
-                torch_dtype=torch_dtype,
-                variant=variant,
-                use_safetensors=True,
-                add_watermarker=False
-            ).to(device)
-            
-            # Оптимизации для RTX 5080
-            pipeline.enable_xformers_memory_efficient_attention()
-            pipeline.enable_model_cpu_offload() if device != "cuda:0" else None
+            gpu_id = torch.device(device).index
+            if gpu_id in self.enable_cpu_offload_on_gpus:
+                # Веса остаются в RAM, модули переносятся на GPU по мере вызова.
+                # Без компиляции: хуки offload разрывают граф
+                pipeline = self._from_pretrained(
+                    "stabilityai/stable-diffusion-xl-base-1.0", "cpu", add_watermarker=False
+                )
+                pipeline.enable_model_cpu_offload(gpu_id=gpu_id)
+                return pipeline
             
-            # Компиляция для ускорения на Blackwell
-            if hasattr(torch, 'compile'):
-                try:
-                    pipeline.unet = torch.compile(pipeline.unet, mode="reduce-overhead")
-                    logger.info(f"Модель скомпилирована для ускорения на {device}")
-                except Exception as e:
-                    logger.warning(f"Не удалось скомпилировать модель: {e}")
+            pipeline = self._from_pretrained(
+                "stabilityai/stable-diffusion-xl-base-1.0", device, add_watermarker=False
+            )
             
-            return pipeline
+            # Компиляция для ускорения на Blackwell
+            return self._optimize_pipeline(pipeline, device)
             
         except Exception as e:
             logger.error(f"Ошибка загрузки SDXL Base: {e}")
             raise
     
-    async def _load_sdxl_turbo(self, device: str) -> DiffusionPipeline:
+    def _load_sdxl_turbo(self, device: str) -> DiffusionPipeline:
         """Загрузка быстрой модели SDXL Turbo"""
         try:
-            pipeline = StableDiffusionXLPipeline.from_pretrained(
-                "stabilityai/sdxl-turbo",
-                cache_dir=self.model_cache_dir,
-                torch_dtype=torch.float16,
-                variant="fp16",
-                use_safetensors=True
-            ).to(device)
+            pipeline = self._from_pretrained("stabilityai/sdxl-turbo", device)
             
-            pipeline.enable_xformers_memory_efficient_attention()
-            
-            return pipeline
+            return self._optimize_pipeline(pipeline, device)
             
         except Exception as e:
             logger.error(f"Ошибка загрузки SDXL Turbo: {e}")
             raise
     
-    async def _load_lcm_model(self, device: str) -> DiffusionPipeline:
-        """Загрузка LCM модели для сверхбыстрой генерации"""
+    def _load_lcm_model(self, device: str, base: StableDiffusionXLPipeline) -> DiffusionPipeline:
+        """Загрузка LCM модели для сверхбыстрой генерации.
+
+        LCM - та же SDXL Base с LoRA, поэтому текстовые энкодеры и токенизаторы
+        берутся из уже загруженной base; с диска читаются только UNet (в него
+        вливается LoRA) и VAE (у base он слит и скомпилирован).
+        """
         try:
-            # Загружаем базовую SDXL и заменяем планировщик на LCM
-            pipeline = StableDiffusionXLPipeline.from_pretrained(
-                "stabilityai/stable-diffusion-xl-base-1.0",
-                cache_dir=self.model_cache_dir,
-                torch_dtype=torch.float16,
-                variant="fp16",
-                use_safetensors=True
+            model_id = "stabilityai/stable-diffusion-xl-base-1.0"
+            component_kwargs = {
+                "cache_dir": self.model_cache_dir,
+                "torch_dtype": torch.float16,
+                "variant": "fp16",
+                "use_safetensors": True,
+                "low_cpu_mem_usage": True,
+                "device_map": {"": device}
+            }
+            pipeline = StableDiffusionXLPipeline(
+                vae=AutoencoderKL.from_pretrained(model_id, subfolder="vae", **component_kwargs),
+                unet=UNet2DConditionModel.from_pretrained(model_id, subfolder="unet", **component_kwargs),
+                text_encoder=base.text_encoder,
+                text_encoder_2=base.text_encoder_2,
+                tokenizer=base.tokenizer,
+                tokenizer_2=base.tokenizer_2,
+                # Заменяем планировщик на LCM
+                scheduler=LCMScheduler.from_config(base.scheduler.config)
             )
             
-            # Заменяем планировщик на LCM
-            pipeline.scheduler = LCMScheduler.from_config(pipeline.scheduler.config)
-            
-            # Загружаем LoRA адаптер LCM
-            pipeline.load_lora_weights("latent-consistency/lcm-lora-sdxl")
-            
-            pipeline = pipeline.to(device)
-            pipeline.enable_xformers_memory_efficient_attention()
+            # Загружаем LoRA адаптер LCM - тензоры читаются сразу на GPU
+            lora_path = hf_hub_download(
+                "latent-consistency/lcm-lora-sdxl",
+                "pytorch_lora_weights.safetensors",
+                cache_dir=self.model_cache_dir
+            )
+            pipeline.load_lora_weights(load_file(lora_path, device=device))
+            # Вливаем LoRA в веса: иначе адаптер ломает граф для torch.compile
+            pipeline.fuse_lora()
             
-            return pipeline
+            return self._optimize_pipeline(pipeline, device)
             
         except Exception as e:
             logger.error(f"Ошибка загрузки LCM модели: {e}")
             raise
     
+    def _select_model_name(self, gpu_id: int, quality: str) -> Optional[str]:
+        """Имя оптимальной загруженной модели для заданного качества"""
+        if gpu_id not in self.loaded_models:
+            logger.error(f"Модели не загружены на GPU {gpu_id}")
+            return None
+        
+        models = self.loaded_models[gpu_id]
+        
+        # Выбираем модель в зависимости от качества
+        if quality == "fast" and "lcm" in models:
+            return "lcm"
+        elif quality in ["fast", "standard"] and "sdxl_turbo" in models:
+            return "sdxl_turbo"
+        elif "sdxl_base" in models:
+            return "sdxl_base"
+        else:
+            # Возвращаем любую доступную модель
+            return next(iter(models), None)
+    
     def get_optimal_model(self, gpu_id: int, quality: str) -> Optional[DiffusionPipeline]:
         """Получение оптимальной модели для заданного качества"""
         try:
-            if gpu_id not in self.loaded_models:
-                logger.error(f"Модели не загружены на GPU {gpu_id}")
-                return None
-            
-            models = self.loaded_models[gpu_id]
-            
-            # Выбираем модель в зависимости от качества
-            if quality == "fast" and "lcm" in models:
-                return models["lcm"]
-            elif quality in ["fast", "standard"] and "sdxl_turbo" in models:
-                return models["sdxl_turbo"]
-            elif "sdxl_base" in models:
-                return models["sdxl_base"]
-            else:
-                # Возвращаем любую доступную модель
-                return next(iter(models.values())) if models else None
+            model_name = self._select_model_name(gpu_id, quality)
+            return self.loaded_models[gpu_id][model_name] if model_name else None
                 
         except Exception as e:
             logger.error(f"Ошибка выбора модели: {e}")
             return None
     
+    @staticmethod
+    def _encode_style_negatives(pipeline: DiffusionPipeline, device: str) -> Dict[str, tuple]:
+        """Эмбеддинги негативных промптов всех стилей (текст фиксирован для стиля)"""
+        embeds = {}
+        with torch.inference_mode():
+            for style, style_config in IMAGE_STYLES.items():
+                prompt_embeds, _, pooled_embeds, _ = pipeline.encode_prompt(
+                    prompt=style_config.get('negative', ''),
+                    device=device,
+                    num_images_per_prompt=1,
+                    do_classifier_free_guidance=False
+                )
+                embeds[style] = (prompt_embeds, pooled_embeds)
+        return embeds
+    
     def apply_style_to_prompt(self, prompt: str, style: str) -> str:
         """Применение стиля к промпту"""
         try:
@@ -288,37 +469,122 @@ class ModelManager:
         Returns:
             Байты изображения или None при ошибке
         """
-        generation_start = datetime.now()
+        # Пайплайн и кодирование JPEG - в потоке, не блокируя event loop
+        return await asyncio.to_thread(
+            self.generate_image_sync, gpu_id, prompt, style, quality, size, guidance_scale, seed
+        )
+    
+    def generate_image_sync(
+        self,
+        gpu_id: int,
+        prompt: str,
+        style: str = "realistic",
+        quality: str = "standard",
+        size: str = "512x512",
+        guidance_scale: float = 7.5,
+        seed: Optional[int] = None
+    ) -> Optional[bytes]:
+        """Синхронная генерация изображения (для Celery и потоков), см. generate_image"""
+        images = self.generate_images_batch_sync(
+            gpu_id, [prompt], style, quality, size, guidance_scale, seed
+        )
+        return images[0] if images else None
+    
+    async def generate_images_batch(
+        self,
+        gpu_id: int,
+        prompts: List[str],
+        style: str = "realistic",
+        quality: str = "standard",
+        size: str = "512x512",
+        guidance_scale: float = 7.5,
+        seed: Optional[int] = None
+    ) -> Optional[List[bytes]]:
+        """Генерация батча изображений в потоке, см. generate_images_batch_sync"""
+        return await asyncio.to_thread(
+            self.generate_images_batch_sync, gpu_id, prompts, style, quality, size, guidance_scale, seed
+        )
+    
+    def generate_images_batch_sync(
+        self,
+        gpu_id: int,
+        prompts: List[str],
+        style: str = "realistic",
+        quality: str = "standard",
+        size: str = "512x512",
+        guidance_scale: float = 7.5,
+        seed: Optional[int] = None
+    ) -> Optional[List[bytes]]:
+        """
+        Синхронная генерация нескольких изображений одним батчем пайплайна
+        
+        Промпты с одинаковыми стилем, качеством и размером проходят через
+        UNet одним forward на шаг - веса читаются один раз на весь батч.
+        
+        Args:
+            gpu_id: ID GPU для генерации
+            prompts: Текстовые промпты
+            style: Стиль изображений
+            quality: Качество генерации
+            size: Размер изображений
+            guidance_scale: Степень следования промпту
+            seed: Семя для воспроизводимости
+        
+        Returns:
+            Байты изображений в порядке промптов или None при ошибке
+        """
+        generation_start = time.perf_counter()
         
         try:
             # Получаем модель
-            model = self.get_optimal_model(gpu_id, quality)
-            if not model:
+            model_name = self._select_model_name(gpu_id, quality)
+            if not model_name:
                 raise ValueError(f"Нет доступной модели на GPU {gpu_id}")
-            
-            # Применяем стиль к промпту
-            styled_prompt, negative_prompt = self.apply_style_to_prompt(prompt, style)
+            model = self.loaded_models[gpu_id][model_name]
+            
+            if len(prompts) > GENERATION_BATCH_SIZE:
+                raise ValueError(f"Батч {len(prompts)} больше GENERATION_BATCH_SIZE={GENERATION_BATCH_SIZE}")
+            
+            # Применяем стиль к промптам; неполный батч дополняем повтором последнего
+            # промпта до скомпилированного размера (лишние изображения отбрасываются)
+            styled = [self.apply_style_to_prompt(prompt, style) for prompt in prompts]
+            batch_size = 1 if len(styled) == 1 else GENERATION_BATCH_SIZE
+            styled += [styled[-1]] * (batch_size - len(styled))
+            styled_prompts = [styled_prompt for styled_prompt, _ in styled]
+            
+            # Негативный промпт стиля - из кеша эмбеддингов, без текстовых энкодеров
+            cached = self.style_embeds.get(gpu_id, {}).get(model_name, {}).get(style)
+            if cached:
+                negative_embeds, negative_pooled = cached
+                negative_kwargs = {
+                    "negative_prompt_embeds": negative_embeds.expand(batch_size, -1, -1),
+                    "negative_pooled_prompt_embeds": negative_pooled.expand(batch_size, -1)
+                }
+            else:
+                negative_kwargs = {"negative_prompt": [negative_prompt for _, negative_prompt in styled]}
             
             # Определяем параметры генерации
             quality_config = QUALITY_SETTINGS.get(quality, QUALITY_SETTINGS["standard"])
             num_inference_steps = quality_config["steps"]
             
-            # Парсим размер
+            # Парсим размер: только размеры, под которые скомпилированы графы
+            if size not in ALLOWED_SIZES:
+                raise ValueError(f"Неподдерживаемый размер {size}, допустимы: {ALLOWED_SIZES}")
             width, height = map(int, size.split('x'))
             
-            # Устанавливаем устройство
-            torch.cuda.set_device(gpu_id)
-            
-            # Генерируем изображение
-            with torch.cuda.amp.autocast():
+            # Генерируем изображения: веса уже fp16, autocast не нужен; inference_mode
+            # не строит граф autograd и не хранит активации для backward.
+            # Текущее устройство задаем контекстом - вызов может идти из рабочего потока
+            with torch.inference_mode(), torch.cuda.device(gpu_id):
                 if seed is not None:
                     generator = torch.Generator(device=f"cuda:{gpu_id}").manual_seed(seed)
                 else:
                     generator = None
                 
                 result = model(
-                    prompt=styled_prompt,
-                    negative_prompt=negative_prompt,
+                    prompt=styled_prompts,
+                    **negative_kwargs,
+                    num_images_per_prompt=1,
                     num_inference_steps=num_inference_steps,
                     guidance_scale=guidance_scale,
                     width=width,
@@ -326,43 +592,53 @@ class ModelManager:
                     generator=generator,
                     output_type="pil"
                 )
-                
-                image = result.images[0]
             
-            # Конвертируем в байты
-            from io import BytesIO
-            img_bytes = BytesIO()
-            image.save(img_bytes, format='JPEG', quality=90, optimize=True)
-            img_bytes.seek(0)
+            # Кодируем в JPEG только запрошенные изображения
+            images = self._encode_jpeg(result.images[:len(prompts)])
             
             # Обновляем статистику
-            generation_time = (datetime.now() - generation_start).total_seconds()
-            await self._update_generation_stats(gpu_id, quality, generation_time, True)
+            generation_time = time.perf_counter() - generation_start
+            self._update_generation_stats(gpu_id, quality, generation_time, True, len(images))
             
             logger.info(
-                f"✅ Изображение сгенерировано на GPU {gpu_id}: "
+                f"✅ Сгенерировано изображений: {len(images)} на GPU {gpu_id}: "
                 f"{quality}/{style}/{size}, время: {generation_time:.1f}с"
             )
             
-            return img_bytes.getvalue()
+            return images
             
         except Exception as e:
-            generation_time = (datetime.now() - generation_start).total_seconds()
-            await self._update_generation_stats(gpu_id, quality, generation_time, False)
+            generation_time = time.perf_counter() - generation_start
+            self._update_generation_stats(gpu_id, quality, generation_time, False, len(prompts))
             
             logger.error(f"❌ Ошибка генерации на GPU {gpu_id}: {e}")
             return None
     
-    async def _update_generation_stats(
+    @staticmethod
+    def _encode_jpeg(images: list) -> List[bytes]:
+        """Кодирование PIL-изображений в JPEG.
+
+        Колеса Pillow собраны с libjpeg-turbo (SIMD DCT); optimize=True не
+        используем - это второй проход для таблиц Хаффмана ради ~5% размера.
+        """
+        encoded = []
+        for image in images:
+            img_bytes = BytesIO()
+            image.save(img_bytes, format='JPEG', quality=90)
+            encoded.append(img_bytes.getvalue())
+        return encoded
+    
+    def _update_generation_stats(
         self, 
         gpu_id: int, 
         quality: str, 
         generation_time: float, 
-        success: bool
+        success: bool,
+        images: int = 1
     ):
-        """Обновление статистики генерации"""
+        """Обновление статистики генерации (один вызов на батч из images изображений)"""
         try:
-            self.model_stats["total_generations"] += 1
+            self.model_stats["total_generations"] += images
             self.model_stats["generation_times"].append(generation_time)
             
             # Статистика по качеству
@@ -374,14 +650,14 @@ class ModelManager:
                 }
             
             stats = self.model_stats["model_usage"][quality]
-            stats["count"] += 1
+            stats["count"] += images
             stats["total_time"] += generation_time
             
             if success:
-                stats["success_count"] += 1
+                stats["success_count"] += images
             
             # Освобождаем GPU в балансировщике
-            gpu_balancer.release_gpu(gpu_id, generation_time)
+            get_gpu_balancer().release_gpu(gpu_id, generation_time)
             
         except Exception as e:
             logger.error(f"Ошибка обновления статистики: {e}")
@@ -427,24 +703,18 @@ class ModelManager:
     async def cleanup_models(self):
         """Очистка неиспользуемых моделей из памяти"""
         try:
-            for gpu_id in list(self.loaded_models.keys()):
-                torch.cuda.set_device(gpu_id)
-                
-                # Удаляем модели из памяти
-                if gpu_id in self.loaded_models:
-                    for model_name, model in self.loaded_models[gpu_id].items():
-                        try:
-                            del model
-                            logger.info(f"Модель {model_name} удалена с GPU {gpu_id}")
-                        except Exception as e:
-                            logger.warning(f"Не удалось удалить модель {model_name}: {e}")
-                    
-                    del self.loaded_models[gpu_id]
-                
-                # Очищаем кеш CUDA
-                torch.cuda.empty_cache()
+            # Забираем последние ссылки на пайплайны (del переменной цикла их не освобождал)
+            released = {gpu_id: list(self.loaded_models.pop(gpu_id)) for gpu_id in list(self.loaded_models)}
+            self.style_embeds.clear()
+            # Скомпилированные модули держат циклические ссылки - собираем их до empty_cache
+            gc.collect()
+            
+            for gpu_id, model_names in released.items():
+                # Возвращаем кеш аллокатора только этого GPU, без set_device
+                with torch.cuda.device(gpu_id):
+                    torch.cuda.empty_cache()
                 
-                logger.info(f"Очищена память GPU {gpu_id}")
+                logger.info(f"Модели {model_names} удалены, очищена память GPU {gpu_id}")
             
         except Exception as e:
             logger.error(f"Ошибка очистки моделей: {e}")
@@ -2,13 +2,38 @@ import logging
 import json
 import asyncio
 from src.shared.celery_app import celery_app
-from src.generator.models_manager import model_manager
-from src.generator.gpu_balancer import gpu_balancer
+from src.generator.models_manager import model_manager, GENERATION_BATCH_SIZE
+from src.generator.gpu_balancer import get_gpu_balancer
 from src.storage.minio_client import minio_client
 from src.shared.redis_client import redis_client
+from src.shared.config import ALLOWED_SIZES
 
 logger = logging.getLogger(__name__)
 
+# Очереди задач в порядке обработки и размер пачки одного BLMPOP
+GENERATION_QUEUES = ("priority_queue", "generation_queue")
+QUEUE_POP_BATCH = 32
+# Сколько ждать задачу на пустых очередях перед завершением (секунды)
+QUEUE_BLOCK_TIMEOUT = 5
+
+
+def _publish_result(task: dict, img_bytes: bytes) -> str:
+    """Загрузка изображения в MinIO и публикация результата в очередь для бота"""
+    filename = f"{task['task_id']}.jpg"
+    url = minio_client.upload_bytes_sync(img_bytes, filename)
+    logger.info(f"Image for task {task['task_id']} saved to {url}")
+    
+    result_data = {
+        "user_id": task['user_id'],
+        "chat_id": task['chat_id'],
+        "message_id": task['message_id'],
+        "prompt": task['prompt'],
+        "image_url": url
+    }
+    redis_client.sync_redis.lpush("results_queue", json.dumps(result_data))
+    return url
+
+
 @celery_app.task(bind=True, max_retries=3, default_retry_delay=60)
 def generate_image_task(self, task_data: str):
     """Celery задача для генерации изображения"""
@@ -16,36 +41,33 @@ def generate_image_task(self, task_data: str):
         task = json.loads(task_data)
         logger.info(f"Processing task: {task['task_id']}")
 
+        # Неверный размер - ошибка входных данных, а не GPU: без retry и mark_gpu_error
+        if task.get("size", "512x512") not in ALLOWED_SIZES:
+            logger.error(f"Rejected task {task['task_id']}: unsupported size {task.get('size')}")
+            return {"status": "rejected", "error": "unsupported size"}
+
         # Получаем доступный GPU через балансировщик
-        gpu_id = asyncio.run(gpu_balancer.get_available_gpu(priority=task.get("priority", False)))
+        gpu_balancer = get_gpu_balancer()
+        mem_required = gpu_balancer.estimate_memory(task.get("size", "512x512"), task.get("quality", "standard"))
+        gpu_id = asyncio.run(gpu_balancer.get_available_gpu(
+            priority=task.get("priority", False),
+            mem_required=mem_required
+        ))
         if gpu_id is None:
             logger.warning("No available GPU, retrying task...")
             raise self.retry()
 
         # Генерируем изображение
-        img_bytes = asyncio.run(model_manager.generate_image(
+        img_bytes = model_manager.generate_image_sync(
             gpu_id=gpu_id,
             prompt=task["prompt"],
             style=task.get("style", "realistic"),
             quality=task.get("quality", "standard"),
             size=task.get("size", "512x512")
-        ))
+        )
 
         if img_bytes:
-            filename = f"{task['task_id']}.jpg"
-            url = minio_client.upload_bytes(img_bytes, filename)
-            logger.info(f"Image for task {task['task_id']} saved to {url}")
-            
-            # Публикуем результат в очередь для бота
-            result_data = {
-                "user_id": task['user_id'],
-                "chat_id": task['chat_id'],
-                "message_id": task['message_id'],
-                "prompt": task['prompt'],
-                "image_url": url
-            }
-            redis_client.sync_redis.lpush("results_queue", json.dumps(result_data))
-            
+            url = _publish_result(task, img_bytes)
             return {"status": "completed", "url": url}
         else:
             gpu_balancer.mark_gpu_error(gpu_id, "generation failed")
@@ -53,24 +75,98 @@ def generate_image_task(self, task_data: str):
             raise Exception("Image generation failed")
 
     except Exception as e:
-        logger.error(f"Error in generate_image_task: {e}")
+        logger.exception(f"Error in generate_image_task: {e}")
         # В случае ошибки Celery автоматически повторит попытку (max_retries=3)
         raise self.retry(exc=e)
 
 
+@celery_app.task(bind=True, max_retries=3, default_retry_delay=60)
+def generate_image_batch_task(self, tasks_data: list[str]):
+    """Celery задача для генерации батча изображений с одинаковыми стилем, качеством и размером"""
+    try:
+        tasks = [json.loads(task_data) for task_data in tasks_data]
+        first = tasks[0]
+        size = first.get("size", "512x512")
+        quality = first.get("quality", "standard")
+        logger.info(f"Processing batch: {[task['task_id'] for task in tasks]}")
+
+        # Батч собран по размеру: неверный размер отклоняет весь батч без retry
+        if size not in ALLOWED_SIZES:
+            logger.error(f"Rejected batch of {len(tasks)} task(s): unsupported size {size}")
+            return {"status": "rejected", "error": "unsupported size"}
+
+        # Один GPU на весь батч: один набор рабочих буферов плюс прирост на изображение;
+        # неполный батч дополняется до GENERATION_BATCH_SIZE (см. generate_images_batch_sync)
+        gpu_balancer = get_gpu_balancer()
+        mem_required = gpu_balancer.estimate_memory(size, quality, batch_size=GENERATION_BATCH_SIZE)
+        gpu_id = asyncio.run(gpu_balancer.get_available_gpu(
+            priority=any(task.get("priority", False) for task in tasks),
+            mem_required=mem_required
+        ))
+        if gpu_id is None:
+            logger.warning("No available GPU, retrying batch...")
+            raise self.retry()
+
+        images = model_manager.generate_images_batch_sync(
+            gpu_id=gpu_id,
+            prompts=[task["prompt"] for task in tasks],
+            style=first.get("style", "realistic"),
+            quality=quality,
+            size=size
+        )
+
+        if images:
+            urls = [_publish_result(task, img_bytes) for task, img_bytes in zip(tasks, images)]
+            return {"status": "completed", "urls": urls}
+        else:
+            gpu_balancer.mark_gpu_error(gpu_id, "batch generation failed")
+            logger.error(f"Batch generation failed for {len(tasks)} task(s)")
+            raise Exception("Batch generation failed")
+
+    except Exception as e:
+        logger.exception(f"Error in generate_image_batch_task: {e}")
+        raise self.retry(exc=e)
+
+
 @celery_app.task
 def process_generation_queue():
     """Периодическая задача для обработки очереди генерации"""
     try:
-        # Читаем задачи из Redis очереди
         while True:
-            task_data = redis_client.sync_redis.rpop("generation_queue")
-            if not task_data:
+            # BLMPOP: пачка из первой непустой очереди (приоритетная - первой) за один
+            # round-trip; на пустых очередях ждет задачу, а не опрашивает Redis
+            popped = redis_client.sync_redis.blmpop(
+                QUEUE_BLOCK_TIMEOUT, len(GENERATION_QUEUES), *GENERATION_QUEUES,
+                direction="RIGHT", count=QUEUE_POP_BATCH
+            )
+            if not popped:
                 break
+            queue, batch = popped
+            
+            # Группируем по (quality, size, style): такие задачи идут одним батчем пайплайна
+            groups: dict[tuple, list[str]] = {}
+            for task_data in batch:
+                # Битая запись не должна терять уже извлеченную пачку
+                try:
+                    task = json.loads(task_data)
+                    key = (task.get("quality", "standard"), task.get("size", "512x512"), task.get("style", "realistic"))
+                except (TypeError, ValueError, AttributeError) as e:
+                    logger.error(f"Skipping malformed task from {queue}: {e}: {task_data!r:.200}")
+                    continue
+                if key[1] not in ALLOWED_SIZES:
+                    logger.error(f"Skipping task {task.get('task_id')} from {queue}: unsupported size {key[1]}")
+                    continue
+                groups.setdefault(key, []).append(task_data)
             
             # Отправляем на генерацию
-            generate_image_task.delay(task_data)
-            logger.info("Task sent to generate_image_task")
+            for group in groups.values():
+                for i in range(0, len(group), GENERATION_BATCH_SIZE):
+                    chunk = group[i:i + GENERATION_BATCH_SIZE]
+                    if len(chunk) == 1:
+                        generate_image_task.delay(chunk[0])
+                    else:
+                        generate_image_batch_task.delay(chunk)
+            logger.info(f"{len(batch)} task(s) from {queue} sent to generation in {len(groups)} group(s)")
             
     except Exception as e:
         logger.error(f"Error in process_generation_queue: {e}")
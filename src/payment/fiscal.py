@@ -2,23 +2,53 @@ import logging
 import aiohttp
 from datetime import datetime, timezone
 from src.shared.config import settings
+from src.shared.redis_client import redis_client
+from src.shared.utils import SSL_CONTEXT, json_dumps, json_loads
 
 logger = logging.getLogger(__name__)
 
+# Токен АТОЛ живет 24 часа; кешируем с запасом
+ATOL_TOKEN_KEY = "atol:token"
+ATOL_TOKEN_TTL = 23 * 3600
+
 class AtolFiscalService:
     API_URL = "https://online.atol.ru/possystem/v4"
 
+    def __init__(self):
+        # Одна сессия на процесс: keep-alive без TLS-рукопожатия на каждый чек
+        self._session: aiohttp.ClientSession | None = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Сессия создается при первом вызове - внутри работающего event loop"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=32, ttl_dns_cache=300, ssl=SSL_CONTEXT),
+                json_serialize=json_dumps
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
     async def _get_token(self):
+        token = await redis_client.get(ATOL_TOKEN_KEY)
+        if token:
+            return token
+
         url = f"{self.API_URL}/getToken"
         payload = {"login": settings.ATOL_LOGIN, "pass": settings.ATOL_PASSWORD}
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=payload) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    return data.get("token")
-                else:
-                    logger.error(f"Atol getToken failed: {await resp.text()}")
-                    return None
+        session = await self._get_session()
+        async with session.post(url, json=payload) as resp:
+            if resp.status == 200:
+                data = await resp.json(loads=json_loads)
+                token = data.get("token")
+                if token:
+                    await redis_client.set(ATOL_TOKEN_KEY, token, ex=ATOL_TOKEN_TTL)
+                return token
+            else:
+                logger.error(f"Atol getToken failed: {await resp.text()}")
+                return None
 
     async def create_receipt(self, payment_id: str, user_email: str, items: list):
         if not all([settings.ATOL_LOGIN, settings.ATOL_PASSWORD, settings.ATOL_GROUP_CODE]):
@@ -49,14 +79,17 @@ class AtolFiscalService:
             }
         }
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=receipt) as resp:
-                response_data = await resp.json()
-                if resp.status == 200 and response_data.get("status") == "wait":
-                    logger.info(f"Atol receipt created for payment {payment_id}")
-                    return {"success": True, "uuid": response_data.get("uuid")}
-                else:
-                    logger.error(f"Atol create_receipt failed: {response_data}")
-                    return {"success": False, "error": response_data.get("error", {}).get("text")}
+        session = await self._get_session()
+        async with session.post(url, json=receipt) as resp:
+            response_data = await resp.json(loads=json_loads)
+            if resp.status == 200 and response_data.get("status") == "wait":
+                logger.info(f"Atol receipt created for payment {payment_id}")
+                return {"success": True, "uuid": response_data.get("uuid")}
+            else:
+                if resp.status == 401:
+                    # Токен отозван или истек раньше TTL - следующий вызов получит новый
+                    await redis_client.delete(ATOL_TOKEN_KEY)
+                logger.error(f"Atol create_receipt failed: {response_data}")
+                return {"success": False, "error": response_data.get("error", {}).get("text")}
 
 atol_fiscal_service = AtolFiscalService()
@@ -2,32 +2,101 @@
 CloudPayments провайдер для обработки платежей
 Резервный способ оплаты после ЮKassa
 """
-import json
+import binascii
 import logging
-import hashlib
 import hmac
-import base64
-from datetime import datetime, timedelta
+import time
+from datetime import datetime, timezone
 from typing import Dict, Any, Optional
+from urllib.parse import urlencode
 
 import aiohttp
 from decimal import Decimal
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from src.shared.config import settings, PACKAGES
+from src.database.connection import DatabaseSession
 from src.database.crud import PaymentCRUD, UserCRUD
 from src.database.models import PaymentStatus
+from src.shared.redis_client import redis_client
+from src.shared.utils import SSL_CONTEXT, json_dumps, json_loads
+
+try:
+    # SIMD-кодек base64 (AVX2/SSSE3/NEON), API совпадает со стандартным base64
+    import pybase64 as base64
+except ImportError:
+    import base64
 
 logger = logging.getLogger(__name__)
 
+# Настройки читаются один раз при импорте
+CP_PUBLIC_ID = settings.CLOUDPAYMENTS_PUBLIC_ID
+CP_SECRET_KEY = settings.CLOUDPAYMENTS_SECRET_KEY
+CP_WEBHOOK_SECRET = settings.CLOUDPAYMENTS_WEBHOOK_SECRET or ''
+
+# Постоянная часть JsonData и закодированное описание для виджета - по пакету,
+# на запрос остается подставить только данные пользователя
+_JSONDATA_TEMPLATE = {
+    pkg: {"package": pkg, "images_count": info['images'], "cloudPayments": True}
+    for pkg, info in PACKAGES.items()
+}
+_PAYMENT_DESCRIPTION = {pkg: f"Пополнение баланса - {info['name']}" for pkg, info in PACKAGES.items()}
+_WIDGET_DESCRIPTION = {pkg: urlencode({'description': info['name']}) for pkg, info in PACKAGES.items()}
+
+# ISO-время (UTC) с точностью до секунды: [строка, секунда, для которой она посчитана]
+_now_iso_cache = ['', 0]
+
+
+def _now_iso() -> str:
+    """Текущее время для метаданных; строка форматируется не чаще раза в секунду"""
+    second = int(time.time())
+    if second != _now_iso_cache[1]:
+        _now_iso_cache[0] = datetime.fromtimestamp(second, tz=timezone.utc).isoformat()
+        _now_iso_cache[1] = second
+    return _now_iso_cache[0]
+
+
+# Метод API по способу оплаты (по умолчанию - карты)
+_CP_API_METHODS = {"card": "payments/cards/charge", "sbp": "payments/qr/charge"}
+
+# Сколько секунд отдавать статистику провайдера из памяти, не обращаясь к БД
+PROVIDER_STATS_TTL = 30
+
+# Сколько помнить обработанные webhook (CloudPayments повторяет их при не-2xx)
+WEBHOOK_DEDUP_TTL = 3600
+
+# Маппинг статусов CloudPayments
+_CP_STATUS_MAP = {
+    "completed": "succeeded",
+    "authorized": "succeeded",
+    "cancelled": "canceled",
+    "declined": "failed",
+    "refunded": "refunded"
+}
+
 
 class CloudPaymentsProvider:
     """Провайдер для работы с CloudPayments API"""
     
     def __init__(self):
         self.api_url = "https://api.cloudpayments.ru"
-        self.public_id = settings.CLOUDPAYMENTS_PUBLIC_ID
-        self.secret_key = settings.CLOUDPAYMENTS_SECRET_KEY
-        self.webhook_secret = getattr(settings, 'CLOUDPAYMENTS_WEBHOOK_SECRET', '')
+        self.public_id = CP_PUBLIC_ID
+        self.secret_key = CP_SECRET_KEY
+        self.webhook_secret = CP_WEBHOOK_SECRET
+        self._webhook_secret_bytes = CP_WEBHOOK_SECRET.encode('utf-8')
+        
+        # Неизменная часть URL виджета оплаты
+        self._widget_base = (
+            "https://widget.cloudpayments.ru/widgets/cpay?"
+            + urlencode({'publicid': self.public_id or '', 'currency': 'RUB'})
+        )
+        
+        # Ключи не меняются - заголовок Basic-авторизации считаем один раз
+        auth_b64 = base64.b64encode(f"{self.public_id}:{self.secret_key}".encode('utf-8')).decode('utf-8')
+        self._auth_headers = {
+            'Authorization': f'Basic {auth_b64}',
+            'Content-Type': 'application/json'
+        }
         
         # CRUD сервисы
         self.payment_crud = PaymentCRUD()
@@ -36,32 +105,52 @@ class CloudPaymentsProvider:
         # Настройки
         self.timeout = 30
         self.max_retries = 3
+        
+        # Одна сессия на процесс: keep-alive без TCP+TLS рукопожатия на каждый запрос
+        self._session: Optional[aiohttp.ClientSession] = None
+        
+        # Кэш статистики: (время истечения, результат)
+        self._stats_cache: tuple[float, Dict[str, Any]] | None = None
+    
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Сессия создается при первом вызове - внутри работающего event loop"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=100,
+                    limit_per_host=20,
+                    # DNS api.cloudpayments.ru резолвится раз в 10 минут, а не на каждый запрос
+                    use_dns_cache=True,
+                    ttl_dns_cache=600,
+                    enable_cleanup_closed=True,
+                    keepalive_timeout=60,
+                    ssl=SSL_CONTEXT
+                ),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                json_serialize=json_dumps
+            )
+        return self._session
+    
+    async def aclose(self):
+        """Закрытие сессии при остановке приложения"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
     
     def _get_auth_headers(self) -> Dict[str, str]:
-        """Получение заголовков авторизации"""
-        auth_string = f"{self.public_id}:{self.secret_key}"
-        auth_bytes = auth_string.encode('utf-8')
-        auth_b64 = base64.b64encode(auth_bytes).decode('utf-8')
-        
-        return {
-            'Authorization': f'Basic {auth_b64}',
-            'Content-Type': 'application/json'
-        }
+        """Получение заголовков авторизации (общий dict, только для чтения)"""
+        return self._auth_headers
     
-    def _calculate_signature(self, data: str) -> str:
-        """Вычисление подписи для webhook"""
-        if not self.webhook_secret:
-            return ""
-        
-        signature = base64.b64encode(
-            hmac.new(
-                self.webhook_secret.encode('utf-8'),
-                data.encode('utf-8'),
-                hashlib.sha256
-            ).digest()
-        ).decode('utf-8')
+    def _verify_signature(self, data: bytes, signature: str) -> bool:
+        """Проверка подписи webhook по сырому телу запроса"""
+        try:
+            received = base64.b64decode(signature, validate=True)
+        except (binascii.Error, ValueError):
+            return False
         
-        return signature
+        # hmac.digest - one-shot HMAC из OpenSSL без Python-объекта hmac.HMAC;
+        # сравниваем 32 байта дайджеста, а не base64-строки
+        expected = hmac.digest(self._webhook_secret_bytes, data, 'sha256')
+        return hmac.compare_digest(received, expected)
     
     async def create_payment(
         self,
@@ -91,35 +180,40 @@ class CloudPaymentsProvider:
             
             package_info = PACKAGES[package]
             amount = Decimal(str(package_info['price']))
+            # Деньги храним в Decimal; строку и число для API/ответа считаем один раз
+            amount_str = f"{amount:.2f}"
+            amount_float = float(amount)
             
-            # Создаем запись платежа в БД
-            payment_id = f"cp_{user_id}_{int(datetime.now().timestamp())}"
+            # Создаем запись платежа в БД; наносекунды - два платежа за одну секунду не совпадут
+            payment_id = f"cp_{user_id}_{time.time_ns()}"
             
             payment_data = {
                 'user_id': user_id,
                 'payment_id': payment_id,
                 'amount': amount,
-                'package_type': package,
                 'provider': 'cloudpayments',
-                'method': method,
                 'status': PaymentStatus.PENDING,
-                'metadata': {
+                # Пакет и способ оплаты - не колонки payments, храним в metadata
+                'payment_metadata': {
+                    'package': package,
+                    'method': method,
                     'images_count': package_info['images'],
                     'return_url': return_url,
                     'created_via': 'telegram_bot'
                 }
             }
             
-            payment = await self.payment_crud.create_payment(**payment_data)
-            
-            if not payment:
-                return {
-                    'success': False,
-                    'error': 'Не удалось создать запись платежа'
-                }
-            
-            # Получаем данные пользователя
-            user = await self.user_crud.get_by_telegram_id(user_id)
+            async with DatabaseSession() as db:
+                payment = await self.payment_crud.create_payment(db, **payment_data)
+                
+                if not payment:
+                    return {
+                        'success': False,
+                        'error': 'Не удалось создать запись платежа'
+                    }
+                
+                # Получаем данные пользователя
+                user = await self.user_crud.get_by_telegram_id(db, user_id)
             if not user:
                 return {
                     'success': False,
@@ -128,18 +222,16 @@ class CloudPaymentsProvider:
             
             # Параметры платежа для CloudPayments
             payment_params = {
-                "Amount": float(amount),
+                "Amount": amount_float,
                 "Currency": "RUB",
                 "InvoiceId": payment_id,
-                "Description": f"Пополнение баланса - {package_info['name']}",
+                "Description": _PAYMENT_DESCRIPTION[package],
                 "AccountId": str(user_id),
                 "Email": user.email or f"user{user_id}@telegram.bot",
-                "JsonData": json.dumps({
-                    "package": package,
-                    "images_count": package_info['images'],
+                "JsonData": json_dumps({
+                    **_JSONDATA_TEMPLATE[package],
                     "telegram_user_id": user_id,
-                    "telegram_username": user.username or "",
-                    "cloudPayments": True
+                    "telegram_username": user.username or ""
                 }),
                 "RequireConfirmation": False,  # Без 3DS если возможно
                 "SendEmail": True,
@@ -152,96 +244,93 @@ class CloudPaymentsProvider:
                 payment_params["FailRedirectUrl"] = f"{return_url}?error=payment_failed"
             
             # Определяем метод оплаты
-            api_method = "payments/cards/charge"  # По умолчанию карты
+            api_method = _CP_API_METHODS.get(method, _CP_API_METHODS["card"])
             
             if method == "sbp":
-                api_method = "payments/qr/charge"
                 payment_params["QrId"] = payment_id
             
             # Отправляем запрос к CloudPayments
-            async with aiohttp.ClientSession(
-                timeout=aiohttp.ClientTimeout(total=self.timeout)
-            ) as session:
-                
-                url = f"{self.api_url}/{api_method}"
-                headers = self._get_auth_headers()
+            session = await self._get_session()
+            url = f"{self.api_url}/{api_method}"
+            headers = self._get_auth_headers()
+            
+            logger.info(f"Создание платежа CloudPayments: {payment_id}, сумма: {amount_str}₽")
+            
+            async with session.post(
+                url,
+                json=payment_params,
+                headers=headers
+            ) as response:
                 
-                logger.info(f"Создание платежа CloudPayments: {payment_id}, сумма: {amount}₽")
+                response_data = json_loads(await response.read())
                 
-                async with session.post(
-                    url,
-                    json=payment_params,
-                    headers=headers
-                ) as response:
+                if response.status == 200 and response_data.get("Success"):
+                    # Платеж создан успешно
+                    model = response_data.get("Model", {})
                     
-                    response_data = await response.json()
-                    
-                    if response.status == 200 and response_data.get("Success"):
-                        # Платеж создан успешно
-                        model = response_data.get("Model", {})
-                        
-                        # Обновляем метаданные платежа
-                        await self.payment_crud.update_metadata(
+                    # Обновляем метаданные платежа: только нужные поля, без всего ответа API
+                    async with DatabaseSession() as db:
+                        await self.payment_crud.patch_metadata(
+                            db,
                             payment.id,
                             {
-                                **(payment.payment_metadata or {}),
                                 'cloudpayments_transaction_id': model.get('TransactionId'),
-                                'cloudpayments_response': response_data,
                                 'payment_url': model.get('PaReq')  # URL для оплаты
                             }
                         )
-                        
-                        # Формируем URL для оплаты
-                        if method == "card":
-                            # Для карт возвращаем URL на форму оплаты
-                            payment_url = (
-                                f"https://widget.cloudpayments.ru/widgets/cpay?"
-                                f"publicid={self.public_id}&"
-                                f"invoiceid={payment_id}&"
-                                f"amount={amount}&"
-                                f"currency=RUB&"
-                                f"accountid={user_id}&"
-                                f"description={package_info['name']}&"
-                                f"email={payment_params['Email']}"
-                            )
-                        elif method == "sbp":
-                            # Для СБП возвращаем QR код
-                            payment_url = model.get("QrCodeUrl", "")
-                        else:
-                            payment_url = model.get("Url", "")
-                        
-                        result = {
-                            'success': True,
-                            'payment_id': payment_id,
-                            'confirmation_url': payment_url,
-                            'amount': float(amount),
-                            'transaction_id': model.get('TransactionId'),
-                            'provider': 'cloudpayments'
-                        }
-                        
-                        logger.info(f"✅ Платеж CloudPayments создан: {payment_id}")
-                        return result
-                        
+                    
+                    # Формируем URL для оплаты
+                    if method == "card":
+                        # Для карт возвращаем URL на форму оплаты
+                        payment_url = "&".join((
+                            self._widget_base,
+                            urlencode({
+                                'invoiceid': payment_id,
+                                'amount': amount_str,
+                                'accountid': user_id,
+                                'email': payment_params['Email']
+                            }),
+                            _WIDGET_DESCRIPTION[package]
+                        ))
+                    elif method == "sbp":
+                        # Для СБП возвращаем QR код
+                        payment_url = model.get("QrCodeUrl", "")
                     else:
-                        # Ошибка создания платежа
-                        error_message = response_data.get("Message", "Неизвестная ошибка")
-                        
+                        payment_url = model.get("Url", "")
+                    
+                    result = {
+                        'success': True,
+                        'payment_id': payment_id,
+                        'confirmation_url': payment_url,
+                        'amount': amount_float,
+                        'transaction_id': model.get('TransactionId'),
+                        'provider': 'cloudpayments'
+                    }
+                    
+                    logger.info(f"✅ Платеж CloudPayments создан: {payment_id}")
+                    return result
+                    
+                else:
+                    # Ошибка создания платежа
+                    error_message = response_data.get("Message", "Неизвестная ошибка")
+                    
+                    async with DatabaseSession() as db:
                         await self.payment_crud.update_status(
+                            db,
                             payment.id,
                             PaymentStatus.FAILED,
                             {
-                                **(payment.payment_metadata or {}),
                                 'error': error_message,
                                 'cloudpayments_response': response_data
                             }
                         )
-                        
-                        logger.error(f"❌ Ошибка создания платежа CloudPayments: {error_message}")
-                        
-                        return {
-                            'success': False,
-                            'error': f'CloudPayments: {error_message}'
-                        }
+                    
+                    logger.error(f"❌ Ошибка создания платежа CloudPayments: {error_message}")
+                    
+                    return {
+                        'success': False,
+                        'error': f'CloudPayments: {error_message}'
+                    }
             
         except aiohttp.ClientTimeout:
             logger.error("Таймаут запроса к CloudPayments")
@@ -260,7 +349,8 @@ class CloudPaymentsProvider:
         """Проверка статуса платежа"""
         try:
             # Получаем платеж из базы
-            payment = await self.payment_crud.get_by_payment_id(payment_id)
+            async with DatabaseSession() as db:
+                payment = await self.payment_crud.get_by_payment_id(db, payment_id)
             if not payment:
                 return None
             
@@ -269,42 +359,30 @@ class CloudPaymentsProvider:
                 return {'status': 'pending'}
             
             # Запрашиваем статус у CloudPayments
-            async with aiohttp.ClientSession(
-                timeout=aiohttp.ClientTimeout(total=self.timeout)
-            ) as session:
-                
-                url = f"{self.api_url}/payments/get"
-                headers = self._get_auth_headers()
-                params = {"TransactionId": transaction_id}
+            session = await self._get_session()
+            url = f"{self.api_url}/payments/get"
+            headers = self._get_auth_headers()
+            params = {"TransactionId": transaction_id}
+            
+            async with session.post(
+                url,
+                json=params,
+                headers=headers
+            ) as response:
                 
-                async with session.post(
-                    url,
-                    json=params,
-                    headers=headers
-                ) as response:
+                if response.status == 200:
+                    data = json_loads(await response.read())
                     
-                    if response.status == 200:
-                        data = await response.json()
+                    if data.get("Success"):
+                        model = data.get("Model", {})
+                        status = model.get("Status", "").lower()
                         
-                        if data.get("Success"):
-                            model = data.get("Model", {})
-                            status = model.get("Status", "").lower()
-                            
-                            # Маппинг статусов CloudPayments
-                            status_mapping = {
-                                "completed": "succeeded",
-                                "authorized": "succeeded", 
-                                "cancelled": "canceled",
-                                "declined": "failed",
-                                "refunded": "refunded"
-                            }
-                            
-                            return {
-                                'status': status_mapping.get(status, status),
-                                'transaction_id': transaction_id,
-                                'amount': model.get('Amount'),
-                                'provider_response': data
-                            }
+                        return {
+                            'status': _CP_STATUS_MAP.get(status, status),
+                            'transaction_id': transaction_id,
+                            'amount': model.get('Amount'),
+                            'provider_response': data
+                        }
             
             return {'status': 'pending'}
             
@@ -316,70 +394,71 @@ class CloudPaymentsProvider:
         """Отмена платежа"""
         try:
             # Получаем платеж из базы
-            payment = await self.payment_crud.get_by_payment_id(payment_id)
-            if not payment:
-                return {
-                    'success': False,
-                    'error': 'Платеж не найден'
-                }
+            async with DatabaseSession() as db:
+                payment = await self.payment_crud.get_by_payment_id(db, payment_id)
+                if not payment:
+                    return {
+                        'success': False,
+                        'error': 'Платеж не найден'
+                    }
+                
+                transaction_id = payment.payment_metadata.get('cloudpayments_transaction_id')
+                if not transaction_id:
+                    # Платеж еще не был отправлен в CloudPayments
+                    await self.payment_crud.update_status(
+                        db,
+                        payment.id,
+                        PaymentStatus.CANCELED
+                    )
             
-            transaction_id = payment.payment_metadata.get('cloudpayments_transaction_id')
             if not transaction_id:
-                # Платеж еще не был отправлен в CloudPayments
-                await self.payment_crud.update_status(
-                    payment.id,
-                    PaymentStatus.CANCELED
-                )
-                
                 return {
                     'success': True,
                     'message': 'Платеж отменен локально'
                 }
             
             # Отменяем платеж в CloudPayments
-            async with aiohttp.ClientSession(
-                timeout=aiohttp.ClientTimeout(total=self.timeout)
-            ) as session:
-                
-                url = f"{self.api_url}/payments/void"
-                headers = self._get_auth_headers()
-                params = {"TransactionId": transaction_id}
+            session = await self._get_session()
+            url = f"{self.api_url}/payments/void"
+            headers = self._get_auth_headers()
+            params = {"TransactionId": transaction_id}
+            
+            async with session.post(
+                url,
+                json=params,
+                headers=headers
+            ) as response:
                 
-                async with session.post(
-                    url,
-                    json=params,
-                    headers=headers
-                ) as response:
+                if response.status == 200:
+                    data = json_loads(await response.read())
                     
-                    if response.status == 200:
-                        data = await response.json()
-                        
-                        if data.get("Success"):
-                            # Обновляем статус в базе
+                    if data.get("Success"):
+                        # Обновляем статус в базе
+                        async with DatabaseSession() as db:
                             await self.payment_crud.update_status(
+                                db,
                                 payment.id,
                                 PaymentStatus.CANCELED,
                                 {
-                                    **(payment.payment_metadata or {}),
-                                    'canceled_at': datetime.now().isoformat(),
+                                    'canceled_at': _now_iso(),
                                     'cancel_response': data
                                 }
                             )
-                            
-                            return {
-                                'success': True,
-                                'message': 'Платеж успешно отменен'
-                            }
-                        else:
-                            return {
-                                'success': False,
-                                'error': data.get('Message', 'Не удалось отменить платеж')
-                            }
+                        
+                        return {
+                            'success': True,
+                            'message': 'Платеж успешно отменен'
+                        }
                     else:
                         return {
                             'success': False,
-                            'error': f'HTTP {response.status}'
+                            'error': data.get('Message', 'Не удалось отменить платеж')
                         }
+                else:
+                    return {
+                        'success': False,
+                        'error': f'HTTP {response.status}'
+                    }
             
         except Exception as e:
             logger.error(f"Ошибка отмены платежа CloudPayments: {e}")
@@ -388,25 +467,26 @@ class CloudPaymentsProvider:
                 'error': f'Внутренняя ошибка: {str(e)}'
             }
     
-    async def process_webhook(self, webhook_data: Dict[str, Any], signature: str) -> bool:
+    async def process_webhook(self, raw_body: bytes, signature: str) -> bool:
         """
         Обработка webhook уведомлений от CloudPayments
         
         Args:
-            webhook_data: Данные webhook
+            raw_body: Тело запроса как есть (подпись считается по этим байтам)
             signature: Подпись запроса
         
         Returns:
             True если успешно обработано
         """
         try:
-            # Проверяем подпись
+            # Проверяем подпись: по исходным байтам, а не по повторно сериализованному dict
             if self.webhook_secret:
-                expected_signature = self._calculate_signature(json.dumps(webhook_data))
-                if not hmac.compare_digest(signature, expected_signature):
+                if not self._verify_signature(raw_body, signature):
                     logger.warning("Неверная подпись webhook CloudPayments")
                     return False
             
+            webhook_data = json_loads(raw_body)
+            
             # Извлекаем данные
             invoice_id = webhook_data.get("InvoiceId")
             transaction_id = webhook_data.get("TransactionId")
@@ -419,53 +499,63 @@ class CloudPaymentsProvider:
                 logger.error("Отсутствует InvoiceId в webhook CloudPayments")
                 return False
             
-            # Получаем платеж из базы
-            payment = await self.payment_crud.get_by_payment_id(invoice_id)
+            # Повторы одного и того же уведомления отсекаем в Redis (SET NX), без запроса к БД
+            dedup_key = f"cp:wh:{transaction_id}:{status}" if transaction_id else None
+            if dedup_key and not await redis_client.set(dedup_key, 1, ex=WEBHOOK_DEDUP_TTL, nx=True):
+                logger.info(f"Повторный webhook CloudPayments пропущен: {invoice_id}, статус: {status}")
+                return True
+            
+            processed = False
+            try:
+                processed = await self._apply_webhook(invoice_id, status, webhook_data)
+                return processed
+            finally:
+                if dedup_key and not processed:
+                    # Не обработали - освобождаем ключ, чтобы повтор от CloudPayments прошел
+                    await redis_client.delete(dedup_key)
+            
+        except Exception as e:
+            logger.error(f"Ошибка обработки webhook CloudPayments: {e}")
+            return False
+    
+    async def _apply_webhook(self, invoice_id: str, status: str, webhook_data: Dict[str, Any]) -> bool:
+        """Применение статуса из webhook к платежу"""
+        # Платеж и все изменения по нему - в одной транзакции
+        async with DatabaseSession() as db:
+            payment = await self.payment_crud.get_by_payment_id(db, invoice_id)
             if not payment:
                 logger.warning(f"Платеж не найден в базе: {invoice_id}")
                 return False
             
             # Обрабатываем в зависимости от статуса
             if status == "completed":
-                return await self._handle_payment_success(payment, webhook_data)
+                return await self._handle_payment_success(db, payment, webhook_data)
             elif status in ["cancelled", "declined"]:
-                return await self._handle_payment_failed(payment, webhook_data)
+                return await self._handle_payment_failed(db, payment, webhook_data)
             else:
                 logger.info(f"Неизвестный статус CloudPayments: {status}")
                 return True
-            
-        except Exception as e:
-            logger.error(f"Ошибка обработки webhook CloudPayments: {e}")
-            return False
     
-    async def _handle_payment_success(self, payment, webhook_data: Dict[str, Any]) -> bool:
+    async def _handle_payment_success(self, db: AsyncSession, payment, webhook_data: Dict[str, Any]) -> bool:
         """Обработка успешного платежа"""
         try:
-            # Обновляем статус платежа
-            await self.payment_crud.update_status(
+            images_count = (payment.payment_metadata or {}).get('images_count', 1)
+            
+            # Статус платежа, баланс и статистика пользователя - одним запросом
+            user_id = await self.payment_crud.finalize_success(
+                db,
                 payment.id,
-                PaymentStatus.SUCCEEDED,
+                images_count,
+                payment.amount,
                 {
-                    **(payment.payment_metadata or {}),
                     'cloudpayments_webhook': webhook_data,
-                    'completed_at': datetime.now().isoformat()
+                    'completed_at': _now_iso()
                 }
             )
             
-            # Пополняем баланс пользователя
-            user = await self.user_crud.get_by_telegram_id(payment.user_id)
-            if user:
-                images_count = (payment.payment_metadata or {}).get('images_count', 1)
-                new_balance = user.balance + images_count
-                
-                await self.user_crud.update_balance(payment.user_id, new_balance)
-                
-                # Обновляем статистику пользователя
-                await self.user_crud.update_total_spent(
-                    payment.user_id,
-                    float(payment.amount)
-                )
-                
+            if user_id is None:
+                logger.info(f"CloudPayments: платеж {payment.payment_id} уже проведен, повтор пропущен")
+            else:
                 logger.info(
                     f"✅ CloudPayments: Пользователь {payment.user_id} пополнил баланс на {images_count} изображений"
                 )
@@ -476,18 +566,18 @@ class CloudPaymentsProvider:
             logger.error(f"Ошибка обработки успешного платежа CloudPayments: {e}")
             return False
     
-    async def _handle_payment_failed(self, payment, webhook_data: Dict[str, Any]) -> bool:
+    async def _handle_payment_failed(self, db: AsyncSession, payment, webhook_data: Dict[str, Any]) -> bool:
         """Обработка неуспешного платежа"""
         try:
             status = PaymentStatus.CANCELED if webhook_data.get("Status") == "Cancelled" else PaymentStatus.FAILED
             
             await self.payment_crud.update_status(
+                db,
                 payment.id,
                 status,
                 {
-                    **(payment.payment_metadata or {}),
                     'cloudpayments_webhook': webhook_data,
-                    'failed_at': datetime.now().isoformat(),
+                    'failed_at': _now_iso(),
                     'failure_reason': webhook_data.get('Reason', 'Unknown')
                 }
             )
@@ -509,11 +599,15 @@ class CloudPaymentsProvider:
     
     async def get_provider_statistics(self) -> Dict[str, Any]:
         """Статистика провайдера"""
+        if self._stats_cache and self._stats_cache[0] > time.monotonic():
+            return self._stats_cache[1]
+        
         try:
             # Получаем статистику платежей CloudPayments из базы
-            stats = await self.payment_crud.get_provider_statistics('cloudpayments')
+            async with DatabaseSession() as db:
+                stats = await self.payment_crud.get_provider_statistics(db, 'cloudpayments')
             
-            return {
+            result = {
                 'provider': 'CloudPayments',
                 'configured': self.is_configured(),
                 'total_payments': stats.get('total_payments', 0),
@@ -522,6 +616,8 @@ class CloudPaymentsProvider:
                 'success_rate': stats.get('success_rate', 0.0),
                 'average_amount': float(stats.get('average_amount', 0))
             }
+            self._stats_cache = (time.monotonic() + PROVIDER_STATS_TTL, result)
+            return result
             
         except Exception as e:
             logger.error(f"Ошибка получения статистики CloudPayments: {e}")
@@ -1,8 +1,9 @@
-import json, logging, aiohttp, uuid
+import asyncio, json, logging, uuid
 from decimal import Decimal
 from datetime import datetime
 from yookassa import Configuration, Payment  # pip install yookassa
 from src.shared.config import settings, PACKAGES
+from src.database.connection import DatabaseSession
 from src.database.crud import PaymentCRUD
 from src.database.models import PaymentStatus
 
@@ -19,7 +20,8 @@ class YooKassaProvider:
             return {"success": False, "error": "unknown package"}
         pack = PACKAGES[package]
         amount = Decimal(str(pack["price"]))
-        payment_obj = Payment.create({
+        # SDK синхронный (requests): вызовы уходят в поток, чтобы не блокировать event loop
+        payment_obj = await asyncio.to_thread(Payment.create, {
             "amount": {"value": f"{amount:.2f}", "currency": "RUB"},
             "payment_method_data": {"type": method},
             "confirmation": {"type": "redirect", "return_url": return_url},
@@ -29,15 +31,17 @@ class YooKassaProvider:
         }, uuid.uuid4())
         data = json.loads(payment_obj.json())
 
-        await self.crud.create_payment(
-            user_id=user_id,
-            payment_id=data["id"],
-            provider="yookassa",
-            amount=amount,
-            package_type=package,
-            status=PaymentStatus.PENDING,
-            metadata=data
-        )
+        async with DatabaseSession() as session:
+            await self.crud.create_payment(
+                session,
+                user_id=user_id,
+                payment_id=data["id"],
+                provider="yookassa",
+                amount=amount,
+                status=PaymentStatus.PENDING,
+                # Пакет уже лежит в metadata ответа ЮKassa (data["metadata"]["package"])
+                payment_metadata=data
+            )
         return {
             "success": True,
             "payment_id": data["id"],
@@ -46,12 +50,12 @@ class YooKassaProvider:
         }
 
     async def check_payment_status(self, pid: str):
-        payment_obj = Payment.find_one(pid)
+        payment_obj = await asyncio.to_thread(Payment.find_one, pid)
         data = json.loads(payment_obj.json())
         return {"status": data["status"]}
 
     async def cancel_payment(self, pid: str):
-        Payment.cancel(pid)
+        await asyncio.to_thread(Payment.cancel, pid)
         return {"success": True}
 
 yookassa_provider = YooKassaProvider()
@@ -1,12 +1,16 @@
 """
 Единый сервис для работы с платежами
 """
+import asyncio
 import logging
 from typing import Dict, Any, Optional
 from decimal import Decimal
 
 from src.payment.providers.yookassa import yookassa_provider
 from src.payment.providers.cloudpayments import cloudpayments_provider
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.database.connection import DatabaseSession
 from src.database.crud import PaymentCRUD, UserCRUD, TariffCRUD
 from src.payment.fiscal import atol_fiscal_service
 
@@ -25,9 +29,9 @@ class PaymentService:
         self.tariff_crud = TariffCRUD()
         self.default_provider = "yookassa"
     
-    async def get_tariffs(self):
+    async def get_tariffs(self, session: AsyncSession):
         """Получение списка активных тарифов"""
-        return await self.tariff_crud.get_active_tariffs()
+        return await self.tariff_crud.get_active_tariffs(session)
 
     async def create_payment(
         self,
@@ -39,12 +43,6 @@ class PaymentService:
     ) -> Dict[str, Any]:
         """Создание платежа через выбранный провайдер"""
         try:
-            # Валидация тарифа
-            tariffs = await self.get_tariffs()
-            tariff = next((t for t in tariffs if t.id == tariff_id), None)
-            if not tariff:
-                return {"success": False, "error": "Unknown tariff"}
-            
             # Выбор провайдера
             if not provider:
                 provider = self.default_provider
@@ -52,10 +50,16 @@ class PaymentService:
             if provider not in self.providers:
                 return {"success": False, "error": "Unknown payment provider"}
             
-            # Проверка пользователя
-            user = await self.user_crud.get_by_telegram_id(user_id)
-            if not user:
-                return {"success": False, "error": "User not found"}
+            async with DatabaseSession() as session:
+                # Валидация тарифа (из кэша активных тарифов, индекс по id)
+                tariff = await self.tariff_crud.get_active_tariff(session, tariff_id)
+                if not tariff:
+                    return {"success": False, "error": "Unknown tariff"}
+                
+                # Проверка пользователя
+                user = await self.user_crud.get_by_telegram_id(session, user_id)
+                if not user:
+                    return {"success": False, "error": "User not found"}
             
             # Создание платежа через провайдер
             provider_service = self.providers[provider]
@@ -84,7 +88,8 @@ class PaymentService:
         """Проверка статуса платежа"""
         try:
             # Получаем информацию о платеже из БД
-            payment = await self.payment_crud.get_by_payment_id(payment_id)
+            async with DatabaseSession() as session:
+                payment = await self.payment_crud.get_by_payment_id(session, payment_id)
             if not payment:
                 return None
             
@@ -102,7 +107,8 @@ class PaymentService:
     async def cancel_payment(self, payment_id: str) -> Dict[str, Any]:
         """Отмена платежа"""
         try:
-            payment = await self.payment_crud.get_by_payment_id(payment_id)
+            async with DatabaseSession() as session:
+                payment = await self.payment_crud.get_by_payment_id(session, payment_id)
             if not payment:
                 return {"success": False, "error": "Payment not found"}
             
@@ -124,29 +130,31 @@ class PaymentService:
     async def process_successful_payment(self, payment_id: str) -> bool:
         """Обработка успешного платежа"""
         try:
-            payment = await self.payment_crud.get_by_payment_id(payment_id)
-            if not payment:
-                logger.error(f"Payment not found: {payment_id}")
-                return False
-            
-            # Получаем информацию о тарифе
-            tariff = await self.tariff_crud.get_by_id(payment.tariff_id)
-            if not tariff:
-                logger.error(f"Unknown tariff_id: {payment.tariff_id}")
-                return False
-            
-            # Пополняем баланс пользователя
-            user = await self.user_crud.get_by_telegram_id(payment.user_id)
-            if user:
-                new_balance = user.balance + tariff.generations
-                await self.user_crud.update_balance(payment.user_id, new_balance)
+            async with DatabaseSession() as session:
+                payment = await self.payment_crud.get_by_payment_id(session, payment_id)
+                if not payment:
+                    logger.error(f"Payment not found: {payment_id}")
+                    return False
                 
-                # Обновляем статистику
-                await self.user_crud.update_total_spent(
+                # Тариф - из кэша активных тарифов, снятый с продажи - из БД
+                tariff = (
+                    await self.tariff_crud.get_active_tariff(session, payment.tariff_id)
+                    or await self.tariff_crud.get_by_id(session, payment.tariff_id)
+                )
+                if not tariff:
+                    logger.error(f"Unknown tariff_id: {payment.tariff_id}")
+                    return False
+                
+                # Пополняем баланс и статистику пользователя одним UPDATE;
+                # он же проверяет, что пользователь существует
+                credited = await self.user_crud.add_purchase(
+                    session,
                     payment.user_id,
+                    tariff.generations,
                     float(payment.amount)
                 )
-                
+            
+            if credited:
                 logger.info(
                     f"Balance updated for user {payment.user_id}: "
                     f"+{tariff.generations} images"
@@ -162,15 +170,16 @@ class PaymentService:
                     "payment_object": "service",
                     "vat": {"type": "none"} # или другая ставка НДС
                 }]
-                await atol_fiscal_service.create_receipt(
-                    payment_id=payment.payment_id,
-                    user_email=f"{user.telegram_id}@telegram.user", # Заглушка, нужно реальное мыло
-                    items=receipt_items
+                # Чек и дополнительные действия друг от друга не зависят - параллельно
+                await asyncio.gather(
+                    atol_fiscal_service.create_receipt(
+                        payment_id=payment.payment_id,
+                        user_email=f"{payment.user_id}@telegram.user", # Заглушка, нужно реальное мыло
+                        items=receipt_items
+                    ),
+                    self._track_successful_payment(payment_id, payment.user_id, tariff)
                 )
                 
-                # Дополнительные действия
-                await self._track_successful_payment(payment_id, payment.user_id, tariff)
-                
                 return True
             
             return False
@@ -203,11 +212,11 @@ class PaymentService:
         """Трекинг отмены платежа"""
         logger.info(f"Payment tracking: cancelled {payment_id}")
     
-    async def _track_successful_payment(self, payment_id: str, user_id: int, package_info: dict):
+    async def _track_successful_payment(self, payment_id: str, user_id: int, tariff):
         """Трекинг успешного платежа"""
         logger.info(
             f"Payment tracking: success {payment_id}, "
-            f"user {user_id}, package {package_info['name']}"
+            f"user {user_id}, package {tariff.name}"
         )
 
 # Глобальный экземпляр
@@ -1,7 +1,6 @@
 """
 Обработчик webhook уведомлений от платежных систем
 """
-import json
 import logging
 from typing import Dict, Any
 from fastapi import FastAPI, Request, HTTPException
@@ -11,11 +10,17 @@ from src.payment.providers.yookassa import yookassa_provider
 from src.payment.providers.cloudpayments import cloudpayments_provider
 from src.payment.service import payment_service
 from src.shared.security import security_manager
+from src.shared.utils import json_loads
 
 logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Payment Webhook Service")
 
+@app.on_event("shutdown")
+async def on_shutdown():
+    """Закрытие HTTP-сессий провайдеров"""
+    await cloudpayments_provider.aclose()
+
 @app.post("/webhook/yookassa")
 async def yookassa_webhook(request: Request):
     """Webhook для ЮKassa уведомлений"""
@@ -35,7 +40,7 @@ async def yookassa_webhook(request: Request):
             raise HTTPException(status_code=403, detail="Invalid signature")
         
         # Парсим данные
-        webhook_data = json.loads(body.decode())
+        webhook_data = json_loads(body)
         
         # Обрабатываем через провайдер
         success = await yookassa_provider.process_webhook(webhook_data)
@@ -59,14 +64,13 @@ async def cloudpayments_webhook(request: Request):
         body = await request.body()
         headers = request.headers
         
-        # Проверяем подпись
+        # Подпись проверяет провайдер по сырому телу запроса
         signature = headers.get("Content-HMAC", "")
-        webhook_data = json.loads(body.decode())
         
-        success = await cloudpayments_provider.process_webhook(webhook_data, signature)
+        success = await cloudpayments_provider.process_webhook(body, signature)
         
         if success:
-            logger.info(f"CloudPayments webhook processed: {webhook_data.get('InvoiceId')}")
+            logger.info("CloudPayments webhook processed")
             return PlainTextResponse("OK")
         else:
             logger.error("Failed to process CloudPayments webhook")
@@ -1,14 +1,10 @@
 from celery import Celery
-from src.shared.config import settings
-
-# Для Celery будем использовать отдельные базы данных в Redis
-celery_broker_url = settings.REDIS_URL.replace('/0', '/1')
-celery_backend_url = settings.REDIS_URL.replace('/0', '/2')
+from src.shared.config import CELERY_BROKER_URL, CELERY_BACKEND_URL
 
 celery_app = Celery(
     "telegram_ai_bot",
-    broker=celery_broker_url,
-    backend=celery_backend_url,
+    broker=CELERY_BROKER_URL,
+    backend=CELERY_BACKEND_URL,
     include=["src.generator.tasks"]  # Путь к модулю с задачами
 )
 
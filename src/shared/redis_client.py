@@ -3,7 +3,7 @@ import redis.asyncio as aioredis
 import redis
 from typing import Any
 
-from src.shared.config import settings
+from src.shared.config import REDIS_URL
 
 logger = logging.getLogger(__name__)
 
@@ -14,9 +14,9 @@ class RedisClient:
 
     async def connect(self):
         if not self.redis:
-            self.redis = aioredis.from_url(str(settings.REDIS_URL), decode_responses=True)
+            self.redis = aioredis.from_url(REDIS_URL, decode_responses=True)
             await self.redis.ping()
-            self.sync_redis = redis.from_url(str(settings.REDIS_URL), decode_responses=True)
+            self.sync_redis = redis.from_url(REDIS_URL, decode_responses=True)
             logger.info("✅ Redis connected")
 
     async def disconnect(self):
@@ -24,8 +24,9 @@ class RedisClient:
             await self.redis.close()
 
     # ——— Обёртки ———
-    async def set(self, key: str, value: Any, ex: int | None = None):
-        await self.redis.set(key, json.dumps(value, default=str), ex=ex)
+    async def set(self, key: str, value: Any, ex: int | None = None, nx: bool = False):
+        """SET; с nx=True возвращает False, если ключ уже существует"""
+        return bool(await self.redis.set(key, json.dumps(value, default=str), ex=ex, nx=nx))
 
     async def get(self, key: str):
         data = await self.redis.get(key)
@@ -34,12 +35,35 @@ class RedisClient:
     async def lpush(self, key: str, value: Any):
         await self.redis.lpush(key, json.dumps(value, default=str))
 
-    async def increment_counter(self, key: str):
-        return await self.redis.incr(key)
+    async def increment_counter(self, key: str, ttl: int | None = None):
+        """INCR; с ttl новый ключ получает TTL в том же round-trip (SET NX + INCR)"""
+        if ttl is None:
+            return await self.redis.incr(key)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.set(key, 0, ex=ttl, nx=True)
+            pipe.incr(key)
+            _, current = await pipe.execute()
+        return current
 
     async def expire(self, key: str, ttl: int):
         await self.redis.expire(key, ttl)
 
+    async def delete(self, *keys: str):
+        await self.redis.delete(*keys)
+
+    async def hgetall(self, key: str) -> dict:
+        return await self.redis.hgetall(key)
+
+    async def hdel(self, key: str, *fields: str):
+        await self.redis.hdel(key, *fields)
+
+    # Redis Functions (Redis 7+)
+    async def function_load(self, code: str, replace: bool = True):
+        return await self.redis.function_load(code, replace=replace)
+
+    async def fcall(self, function: str, numkeys: int, *keys_and_args: Any):
+        return await self.redis.fcall(function, numkeys, *keys_and_args)
+
     # Очереди генерации
     async def add_to_generation_queue(self, task: dict, priority=False):
         q = "priority_queue" if priority else "generation_queue"
@@ -1,4 +1,22 @@
-import hashlib, uuid
+import hashlib, json, ssl, uuid
+from typing import Any
+
+try:
+    import orjson
+
+    def json_dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+
+    json_loads = orjson.loads
+except ImportError:
+    json_dumps = json.dumps
+    json_loads = json.loads
+
+# Общий TLS-контекст для HTTP-клиентов: CA-сертификаты загружаются один раз,
+# а не при создании каждого клиента. Рукопожатия экономит keep-alive пула
+# соединений aiohttp; aiohttp говорит только по HTTP/1.1 - h2 в ALPN не объявляем
+SSL_CONTEXT = ssl.create_default_context()
+SSL_CONTEXT.set_alpn_protocols(["http/1.1"])
 
 def idempotency_key() -> str:
     """Ключ идемпотентности для платежей ЯКассы."""
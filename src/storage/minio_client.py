@@ -1,4 +1,4 @@
-import asyncio, logging
+import asyncio, io, logging
 from minio import Minio
 from minio.error import S3Error
 from src.shared.config import settings
@@ -14,15 +14,29 @@ class MinioClient:
             secure=False  # внутренняя сеть
         )
         self.bucket = "ai-images"
+        self._bucket_ready = False
 
-    async def ensure_bucket(self):
+    def _ensure_bucket_sync(self):
+        # bucket_exists - лишний round-trip; после первой проверки не повторяем
+        if self._bucket_ready:
+            return
         if not self.client.bucket_exists(self.bucket):
             self.client.make_bucket(self.bucket)
             logger.info("🗄️  MinIO bucket created")
+        self._bucket_ready = True
+
+    async def ensure_bucket(self):
+        await asyncio.to_thread(self._ensure_bucket_sync)
 
-    async def upload_bytes(self, data: bytes, object_name: str, content_type="image/jpeg"):
-        await self.ensure_bucket()
-        self.client.put_object(self.bucket, object_name, data, len(data), content_type=content_type)
+    def upload_bytes_sync(self, data: bytes | memoryview, object_name: str, content_type="image/jpeg"):
+        """Загрузка в MinIO потоком из буфера: BytesIO над bytes не копирует данные"""
+        self._ensure_bucket_sync()
+        stream = io.BytesIO(data)
+        self.client.put_object(self.bucket, object_name, stream, stream.getbuffer().nbytes, content_type=content_type)
         return f"{self.bucket}/{object_name}"
 
+    async def upload_bytes(self, data: bytes | memoryview, object_name: str, content_type="image/jpeg"):
+        # Клиент minio синхронный - выполняем в потоке, не блокируя event loop
+        return await asyncio.to_thread(self.upload_bytes_sync, data, object_name, content_type)
+
 minio_client = MinioClient()
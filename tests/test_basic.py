@@ -5,6 +5,7 @@ import pytest
 import asyncio
 import os
 import sys
+import threading
 from datetime import datetime, timedelta
 
 # Добавляем путь к проекту
@@ -13,9 +14,10 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from src.shared.config import settings
 from src.shared.security import security_manager
 from src.shared.redis_client import redis_client
-from src.database.connection import init_database, get_session
+from src.database.connection import init_database, get_session, DatabaseSession
 from src.database.crud import UserCRUD, PaymentCRUD
-from src.generator.gpu_balancer import gpu_balancer
+from src.generator import gpu_balancer as gpu_balancer_module
+from src.generator.gpu_balancer import GPUBalancer, get_gpu_balancer
 from src.payment.providers.yookassa import YooKassaProvider
 
 
@@ -145,30 +147,32 @@ class TestDatabase:
         try:
             user_crud = UserCRUD()
             
-            # Создаем тестового пользователя
-            test_user = await user_crud.get_or_create_user(
-                telegram_id=999999999,
-                username="test_user",
-                first_name="Test",
-                last_name="User",
-                language_code="en"
-            )
-            
-            assert test_user is not None, "Пользователь должен быть создан"
-            assert test_user.telegram_id == 999999999, "ID пользователя должен совпадать"
-            assert test_user.username == "test_user", "Username должен совпадать"
-            
-            # Проверяем получение пользователя
-            fetched_user = await user_crud.get_by_telegram_id(999999999)
-            assert fetched_user is not None, "Пользователь должен быть найден"
-            assert fetched_user.telegram_id == test_user.telegram_id, "ID должны совпадать"
-            
-            # Обновляем баланс
-            new_balance = 10
-            await user_crud.update_balance(999999999, new_balance)
-            
-            updated_user = await user_crud.get_by_telegram_id(999999999)
-            assert updated_user.balance == new_balance, "Баланс должен быть обновлен"
+            async with DatabaseSession() as session:
+                # Создаем тестового пользователя
+                test_user = await user_crud.get_or_create_user(
+                    session,
+                    telegram_id=999999999,
+                    username="test_user",
+                    first_name="Test",
+                    last_name="User",
+                    language_code="en"
+                )
+                
+                assert test_user is not None, "Пользователь должен быть создан"
+                assert test_user.telegram_id == 999999999, "ID пользователя должен совпадать"
+                assert test_user.username == "test_user", "Username должен совпадать"
+                
+                # Проверяем получение пользователя
+                fetched_user = await user_crud.get_by_telegram_id(session, 999999999)
+                assert fetched_user is not None, "Пользователь должен быть найден"
+                assert fetched_user.telegram_id == test_user.telegram_id, "ID должны совпадать"
+                
+                # Обновляем баланс
+                new_balance = 10
+                await user_crud.update_balance(session, 999999999, new_balance)
+                
+                updated_user = await user_crud.get_by_telegram_id(session, 999999999)
+                assert updated_user.balance == new_balance, "Баланс должен быть обновлен"
             
             print("✅ CRUD операции пользователей работают корректно")
             
@@ -214,7 +218,7 @@ class TestGPUBalancer:
     @pytest.mark.asyncio
     async def test_gpu_detection(self):
         """Тест определения GPU"""
-        gpu_devices = gpu_balancer.gpu_devices
+        gpu_devices = get_gpu_balancer().gpu_devices
         
         # Проверяем что GPU определены (может быть пустой список если нет GPU)
         assert isinstance(gpu_devices, list), "GPU devices должен быть списком"
@@ -224,20 +228,70 @@ class TestGPUBalancer:
             
             # Проверяем статус GPU
             for gpu_id in gpu_devices:
-                assert gpu_id in gpu_balancer.gpu_status, f"Статус GPU {gpu_id} не инициализирован"
+                assert gpu_id in get_gpu_balancer().gpu_status, f"Статус GPU {gpu_id} не инициализирован"
         else:
             print("⚠️ GPU не обнаружены (возможно, система не поддерживает CUDA)")
     
     @pytest.mark.asyncio
     async def test_gpu_stats(self):
         """Тест получения статистики GPU"""
-        stats = await gpu_balancer.get_gpu_stats()
+        stats = await get_gpu_balancer().get_gpu_stats()
         
         assert isinstance(stats, dict), "Статистика должна быть словарем"
         assert 'gpu_count' in stats, "Статистика должна содержать количество GPU"
         assert 'total_generations' in stats, "Статистика должна содержать общее количество генераций"
         
         print("✅ Получение статистики GPU работает корректно")
+    
+    @staticmethod
+    def _make_balancer(queue_lengths: dict, monkeypatch, free: dict, reserved: dict, allocated: dict) -> GPUBalancer:
+        """Балансировщик без опроса CUDA: состояние GPU и счетчики памяти заданы вручную"""
+        balancer = GPUBalancer.__new__(GPUBalancer)
+        balancer._device_props = {}
+        balancer.gpu_devices = list(queue_lengths)
+        balancer.gpu_status = {
+            gpu_id: {"busy": False, "queue_length": length, "total_generations": 0, "current_task": None}
+            for gpu_id, length in queue_lengths.items()
+        }
+        balancer._load_heap = []
+        balancer.lock = threading.Lock()
+        for gpu_id in queue_lengths:
+            balancer._push_load(gpu_id)
+        
+        monkeypatch.setattr(gpu_balancer_module.torch.cuda, "mem_get_info", lambda gpu_id: (free[gpu_id], 16 * 1024**3))
+        monkeypatch.setattr(gpu_balancer_module, "_mem_reserved", lambda gpu_id: reserved[gpu_id])
+        monkeypatch.setattr(gpu_balancer_module, "_mem_alloc", lambda gpu_id: allocated[gpu_id])
+        return balancer
+    
+    def test_free_memory_counts_allocator_cache(self, monkeypatch):
+        """Кеш аллокатора PyTorch (reserved - allocated) считается доступной памятью"""
+        gb = 1024**3
+        balancer = self._make_balancer(
+            {0: 0, 1: 0}, monkeypatch,
+            free={0: 1 * gb, 1: 2 * gb},
+            reserved={0: 10 * gb, 1: 8 * gb},
+            allocated={0: 4 * gb, 1: 8 * gb}
+        )
+        
+        assert balancer._free_memory() == {0: 7 * gb, 1: 2 * gb}
+        # GPU 0 драйвер считает почти занятым, но 6 GB из кеша аллокатора доступны
+        assert balancer._select_by_memory(balancer._free_memory(), 5 * gb) == 0
+    
+    @pytest.mark.asyncio
+    async def test_available_gpu_falls_back_to_load(self, monkeypatch):
+        """Если задача не помещается ни на один GPU по оценке памяти - выбор по нагрузке, а не None"""
+        gb = 1024**3
+        balancer = self._make_balancer(
+            {0: 3, 1: 1}, monkeypatch,
+            free={0: 1 * gb, 1: 1 * gb},
+            reserved={0: 2 * gb, 1: 2 * gb},
+            allocated={0: 2 * gb, 1: 2 * gb}
+        )
+        
+        selected = await balancer.get_available_gpu(mem_required=24 * gb)
+        
+        assert selected == 1, "Должен быть выбран наименее загруженный GPU"
+        assert balancer.gpu_status[1]["queue_length"] == 2
 
 
 class TestRedisConnection:
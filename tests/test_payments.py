@@ -1,10 +1,20 @@
 import pytest
 import os
 import sys
+import uuid
+from decimal import Decimal
+from types import SimpleNamespace
+
+from sqlalchemy.dialects import postgresql
 
 # Add project root to path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+from src.database.connection import DatabaseSession
+from src.database.crud import PaymentCRUD
+from src.database.models import PaymentStatus
+from src.payment.providers import cloudpayments
+from src.payment.providers.cloudpayments import CloudPaymentsProvider
 from src.payment.service import payment_service
 from src.shared.config import PACKAGES
 
@@ -14,7 +24,8 @@ async def test_get_tariffs():
     # This test requires a real database connection
     # Skip if database is not available
     try:
-        tariffs = await payment_service.get_tariffs()
+        async with DatabaseSession() as session:
+            tariffs = await payment_service.get_tariffs(session)
         assert isinstance(tariffs, list), "Tariffs should return a list"
     except (RuntimeError, ConnectionRefusedError, Exception) as e:
         if "Database not initialized" in str(e) or "ConnectionRefused" in str(e.__class__.__name__):
@@ -39,3 +50,159 @@ def test_payment_service_providers():
     assert hasattr(payment_service, 'providers'), "Payment service should have providers"
     assert "yookassa" in payment_service.providers, "YooKassa provider should be available"
     assert "cloudpayments" in payment_service.providers, "CloudPayments provider should be available"
+
+
+# --- CloudPayments webhook: повторы, ошибки применения, отмена (без БД и Redis) ---
+
+class _FakeRedis:
+    """SET NX / DELETE поверх dict - как redis_client для дедупликации webhook"""
+    def __init__(self):
+        self.store = {}
+
+    async def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.store:
+            return False
+        self.store[key] = value
+        return True
+
+    async def delete(self, *keys):
+        for key in keys:
+            self.store.pop(key, None)
+
+
+class _FakeDatabaseSession:
+    async def __aenter__(self):
+        return object()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+class _FakePaymentCRUD:
+    """PaymentCRUD в памяти: finalize_success повторяет условие status != SUCCEEDED из CTE"""
+    def __init__(self, payment, fail_finalize: bool = False):
+        self.payment = payment
+        self.fail_finalize = fail_finalize
+        self.credited = 0
+
+    async def get_by_payment_id(self, db, pid):
+        return self.payment if self.payment and self.payment.payment_id == pid else None
+
+    async def finalize_success(self, db, db_id, images, amount, metadata_patch):
+        if self.fail_finalize:
+            raise RuntimeError("database is unavailable")
+        if self.payment.status == PaymentStatus.SUCCEEDED:
+            return None
+        self.payment.status = PaymentStatus.SUCCEEDED
+        self.credited += images
+        return self.payment.user_id
+
+    async def update_status(self, db, db_id, status, metadata_patch=None):
+        self.payment.status = status
+
+
+def _make_payment():
+    return SimpleNamespace(
+        id=uuid.uuid4(),
+        payment_id="cp_1_1",
+        user_id=1,
+        amount=Decimal("100.00"),
+        status=PaymentStatus.PENDING,
+        payment_metadata={"images_count": 5}
+    )
+
+
+def _webhook_body(status: str, transaction_id: int = 42) -> bytes:
+    return cloudpayments.json_dumps({
+        "InvoiceId": "cp_1_1",
+        "TransactionId": transaction_id,
+        "Status": status,
+        "Amount": 100
+    }).encode("utf-8")
+
+
+@pytest.fixture
+def cp_provider(monkeypatch):
+    """Провайдер без подписи webhook, с Redis и сессией БД в памяти"""
+    fake_redis = _FakeRedis()
+    monkeypatch.setattr(cloudpayments, "redis_client", fake_redis)
+    monkeypatch.setattr(cloudpayments, "DatabaseSession", _FakeDatabaseSession)
+    provider = CloudPaymentsProvider()
+    provider.webhook_secret = ""
+    return provider, fake_redis
+
+
+class _CapturingSession:
+    def __init__(self):
+        self.statements = []
+
+    async def execute(self, stmt):
+        self.statements.append(stmt)
+        return SimpleNamespace(scalar_one_or_none=lambda: None)
+
+
+@pytest.mark.asyncio
+async def test_finalize_success_guards_already_succeeded():
+    """The payments CTE only matches payments that are not SUCCEEDED yet"""
+    session = _CapturingSession()
+    result = await PaymentCRUD().finalize_success(session, uuid.uuid4(), 5, Decimal("100.00"), {})
+
+    assert result is None
+    sql = str(session.statements[0].compile(dialect=postgresql.dialect()))
+    assert "payments.status !=" in sql, "Повторная доставка не должна снова начислять баланс"
+
+
+@pytest.mark.asyncio
+async def test_repeated_webhook_credits_once(cp_provider):
+    """A redelivered Completed webhook must not credit the balance twice"""
+    provider, fake_redis = cp_provider
+    provider.payment_crud = _FakePaymentCRUD(_make_payment())
+    body = _webhook_body("Completed")
+
+    assert await provider.process_webhook(body, "") is True
+    # Повтор в пределах WEBHOOK_DEDUP_TTL отсекается в Redis
+    assert await provider.process_webhook(body, "") is True
+    # Повтор после истечения ключа доходит до БД, но CTE платеж уже не обновляет
+    fake_redis.store.clear()
+    assert await provider.process_webhook(body, "") is True
+
+    assert provider.payment_crud.credited == 5
+    assert provider.payment_crud.payment.status == PaymentStatus.SUCCEEDED
+
+
+@pytest.mark.asyncio
+async def test_failed_apply_releases_dedup_key(cp_provider):
+    """If applying the webhook fails, the dedup key is released so the retry is processed"""
+    provider, fake_redis = cp_provider
+    provider.payment_crud = _FakePaymentCRUD(_make_payment(), fail_finalize=True)
+    body = _webhook_body("Completed")
+
+    assert await provider.process_webhook(body, "") is False
+    assert fake_redis.store == {}
+
+    # Повтор от CloudPayments после восстановления БД проводит платеж
+    provider.payment_crud.fail_finalize = False
+    assert await provider.process_webhook(body, "") is True
+    assert provider.payment_crud.credited == 5
+
+
+@pytest.mark.asyncio
+async def test_unknown_payment_releases_dedup_key(cp_provider):
+    """A webhook for a payment that is not in the database is not marked as processed"""
+    provider, fake_redis = cp_provider
+    provider.payment_crud = _FakePaymentCRUD(None)
+
+    assert await provider.process_webhook(_webhook_body("Completed"), "") is False
+    assert fake_redis.store == {}
+
+
+@pytest.mark.asyncio
+async def test_cancelled_payment_does_not_credit(cp_provider):
+    """A Cancelled webhook marks the payment CANCELED without crediting the balance"""
+    provider, _ = cp_provider
+    provider.payment_crud = _FakePaymentCRUD(_make_payment())
+
+    assert await provider.process_webhook(_webhook_body("Cancelled"), "") is True
+
+    assert provider.payment_crud.credited == 0
+    assert provider.payment_crud.payment.status == PaymentStatus.CANCELED
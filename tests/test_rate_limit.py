@@ -0,0 +1,204 @@
+"""
+Тесты rate limiting: скользящее окно rl_check (Redis Functions) и
+фиксированное окно increment_counter для Redis < 7
+"""
+import pytest
+import pytest_asyncio
+import os
+import sys
+import time
+import uuid
+
+from redis.asyncio import Redis
+from redis.exceptions import ConnectionError as RedisConnectionError, ResponseError
+
+# Добавляем путь к проекту
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.shared.config import settings
+from src.shared.redis_client import RedisClient
+from src.bot.middlewares import rate_limit
+from src.bot.middlewares.rate_limit import RATE_LIMIT_LIBRARY, RateLimitMiddleware
+
+
+@pytest_asyncio.fixture
+async def functions_redis():
+    """Redis с загруженной библиотекой ratelimit; тест пропускается без Redis 7+"""
+    redis = Redis.from_url(settings.REDIS_URL)
+    try:
+        await redis.function_load(RATE_LIMIT_LIBRARY, replace=True)
+    except (RedisConnectionError, OSError) as e:
+        await redis.close()
+        pytest.skip(f"Redis not available for testing: {e}")
+    except ResponseError as e:
+        await redis.close()
+        pytest.skip(f"Redis Functions not supported: {e}")
+
+    key = f"rl:test:{uuid.uuid4().hex}"
+    try:
+        yield redis, key
+    finally:
+        await redis.delete(key)
+        await redis.close()
+
+
+class TestSlidingWindow:
+    """rl_check на реальном Redis: время передается явно, поэтому сценарий детерминирован"""
+
+    WINDOW_MS = 60_000
+    LIMIT = 3
+
+    @classmethod
+    def _next_bucket_start(cls) -> int:
+        # Начало будущей корзины: PEXPIREAT не должен ставить срок в прошлом
+        return (int(time.time() * 1000) // cls.WINDOW_MS + 1) * cls.WINDOW_MS
+
+    @staticmethod
+    async def _check(redis: Redis, key: str, now: int, limit: int = LIMIT, window: int = WINDOW_MS):
+        allowed, count = await redis.fcall('rl_check', 1, key, limit, window, now, 'generation')
+        return allowed, count
+
+    @pytest.mark.asyncio
+    async def test_limit_within_bucket(self, functions_redis):
+        """В пределах корзины пропускается ровно limit запросов"""
+        redis, key = functions_redis
+        now = self._next_bucket_start()
+
+        results = [await self._check(redis, key, now + i) for i in range(self.LIMIT + 1)]
+
+        assert results[:self.LIMIT] == [(1, 1), (1, 2), (1, 3)]
+        assert results[self.LIMIT] == (0, 3), "Запрос сверх лимита должен отклоняться без инкремента"
+
+    @pytest.mark.asyncio
+    async def test_bucket_rollover_weights_previous(self, functions_redis):
+        """После смены корзины предыдущая учитывается с весом оставшейся доли окна"""
+        redis, key = functions_redis
+        start = self._next_bucket_start()
+        for i in range(self.LIMIT):
+            await self._check(redis, key, start + i)
+
+        # Середина следующей корзины: 3 * 0.5 + 0 -> оценка 1, запрос разрешен
+        allowed, count = await self._check(redis, key, start + self.WINDOW_MS + self.WINDOW_MS // 2)
+        assert (allowed, count) == (1, 2)
+
+        # Начало следующей корзины: вес предыдущей почти 1 (floor(3 * 0.99998) = 2),
+        # поэтому проходит только один запрос, а не снова весь лимит
+        early_key = f"{key}:early"
+        try:
+            for i in range(self.LIMIT):
+                await self._check(redis, early_key, start + i)
+            assert await self._check(redis, early_key, start + self.WINDOW_MS + 1) == (1, 3)
+            assert await self._check(redis, early_key, start + self.WINDOW_MS + 2) == (0, 3)
+        finally:
+            await redis.delete(early_key)
+
+    @pytest.mark.asyncio
+    async def test_stale_previous_bucket_is_dropped(self, functions_redis):
+        """Если с конца корзины прошло больше окна, предыдущие запросы не учитываются"""
+        redis, key = functions_redis
+        start = self._next_bucket_start()
+        for i in range(self.LIMIT):
+            await self._check(redis, key, start + i)
+
+        allowed, count = await self._check(redis, key, start + 2 * self.WINDOW_MS + self.WINDOW_MS // 2)
+
+        assert (allowed, count) == (1, 1)
+        assert await redis.hget(key, 'generation:p') == b'0'
+
+    @pytest.mark.asyncio
+    async def test_key_expires_after_window(self, functions_redis):
+        """TTL hash - конец текущей корзины плюс окно (PEXPIREAT), и он не укорачивается"""
+        redis, key = functions_redis
+        start = self._next_bucket_start()
+
+        await self._check(redis, key, start)
+        assert await redis.pexpiretime(key) == start + 2 * self.WINDOW_MS
+
+        # Действие с коротким окном не сокращает TTL, выставленный длинным окном
+        await redis.fcall('rl_check', 1, key, 30, 1000, start, 'message')
+        assert await redis.pexpiretime(key) == start + 2 * self.WINDOW_MS
+
+
+class _FallbackRedisClient:
+    """redis_client без Redis Functions: FCALL падает, INCR считает в памяти"""
+    def __init__(self):
+        self.counters = {}
+        self.ttls = {}
+
+    async def fcall(self, function, numkeys, *keys_and_args):
+        raise ResponseError("ERR unknown command 'FCALL'")
+
+    async def increment_counter(self, key, ttl=None):
+        self.counters[key] = self.counters.get(key, 0) + 1
+        self.ttls.setdefault(key, ttl)
+        return self.counters[key]
+
+
+@pytest.mark.asyncio
+async def test_fallback_fixed_window(monkeypatch):
+    """На Redis < 7 лимит считается фиксированным окном через increment_counter(ttl=)"""
+    fake = _FallbackRedisClient()
+    monkeypatch.setattr(rate_limit, "redis_client", fake)
+    middleware = RateLimitMiddleware()
+    limit = middleware.limits['generation']
+
+    results = [await middleware._check_rate_limit(7, 'generation') for _ in range(limit + 1)]
+
+    assert results == [True] * limit + [False]
+    assert fake.ttls == {"rl:7:generation": middleware.windows['generation']}
+
+
+class _FakePipeline:
+    def __init__(self, store: dict, calls: list):
+        self.store = store
+        self.calls = calls
+        self.commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def set(self, key, value, ex=None, nx=False):
+        self.commands.append(("set", key, value, ex, nx))
+
+    def incr(self, key):
+        self.commands.append(("incr", key))
+
+    async def execute(self):
+        self.calls.extend(self.commands)
+        results = []
+        for command in self.commands:
+            if command[0] == "set":
+                _, key, value, _, nx = command
+                created = not (nx and key in self.store)
+                if created:
+                    self.store[key] = value
+                results.append(created)
+            else:
+                self.store[command[1]] += 1
+                results.append(self.store[command[1]])
+        return results
+
+
+class _FakeRedis:
+    def __init__(self):
+        self.store = {}
+        self.calls = []
+
+    def pipeline(self, transaction=True):
+        return _FakePipeline(self.store, self.calls)
+
+
+@pytest.mark.asyncio
+async def test_increment_counter_sets_ttl_once():
+    """increment_counter(ttl=): SET NX EX создает ключ с TTL, повторные вызовы только INCR"""
+    client = RedisClient()
+    client.redis = _FakeRedis()
+
+    assert await client.increment_counter("rl:1:message", ttl=60) == 1
+    assert await client.increment_counter("rl:1:message", ttl=60) == 2
+
+    assert client.redis.calls[0] == ("set", "rl:1:message", 0, 60, True)
+    assert client.redis.calls[1] == ("incr", "rl:1:message")